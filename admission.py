@@ -0,0 +1,239 @@
+"""Admission control for the expensive endpoints
+
+Views opt in with @admission.limit(<class>). Each class has a token bucket
+per client IP and per logged-in user, and a bounded number of requests it
+runs at once. A request over its rate gets 429; one that cannot get a slot
+within the class's latency budget, or finds too many requests already
+waiting, gets 503. Both come with Retry-After. Slots are held until the
+response body has been sent, so streamed responses count while they stream.
+"""
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request, session
+
+from db import load_config
+
+DEFAULT_CONFIG = {
+    'ADMISSION_CONTROL': True,
+    # JSON object of class -> overrides for CLASSES, e.g. {"llm": {"concurrency": 64}}
+    'ADMISSION_LIMITS': '',
+    # Take the client address from X-Forwarded-For (only behind a trusted proxy)
+    'ADMISSION_TRUST_PROXY': False,
+}
+
+# rate: tokens per second, burst: bucket size, concurrency: requests running
+# at once, max_queue: requests allowed to wait for a slot, max_wait: latency
+# budget in seconds for getting a slot
+CLASSES = {
+    'auth': {'rate': 0.2, 'burst': 5, 'concurrency': 4, 'max_queue': 16, 'max_wait': 2.0},
+    'generate': {'rate': 1.0, 'burst': 10, 'concurrency': 8, 'max_queue': 32, 'max_wait': 5.0},
+    'llm': {'rate': 0.5, 'burst': 10, 'concurrency': 32, 'max_queue': 64, 'max_wait': 5.0},
+    'search': {'rate': 10.0, 'burst': 50, 'concurrency': 16, 'max_queue': 64, 'max_wait': 1.0},
+    'export': {'rate': 0.2, 'burst': 5, 'concurrency': 4, 'max_queue': 8, 'max_wait': 2.0},
+}
+
+# An IP may be shared by many users (a classroom behind NAT), so its bucket
+# gets this many times the per-user rate and burst
+IP_SHARE_FACTOR = 10
+
+# Idle buckets kept per class; the least recently used are dropped first
+MAX_BUCKETS = 100000
+
+
+def limit(admission_class):
+    """Put a view under the given admission class"""
+    def decorator(func):
+        func.admission_class = admission_class
+        return func
+    return decorator
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait(self, rate, burst):
+        """Refill, returning 0 when a token is available or the seconds until one is"""
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionClass:
+    def __init__(self, name, rate, burst, concurrency, max_queue, max_wait):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self._buckets = OrderedDict()
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.wait_seconds = 0.0
+
+    def check_rate(self, keys):
+        """Spend a token from every (key, scale) bucket, or from none, returning the longest wait
+
+        Buckets are only charged when all of them admit the request, so one
+        that is empty doesn't drain the others on every rejected retry.
+        """
+        with self._cond:
+            buckets = []
+            retry_after = 0.0
+            for key, scale in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(self.burst * scale)
+                    if len(self._buckets) > MAX_BUCKETS:
+                        self._buckets.popitem(last=False)
+                else:
+                    self._buckets.move_to_end(key)
+                buckets.append(bucket)
+                retry_after = max(retry_after,
+                                  bucket.wait(self.rate * scale, self.burst * scale))
+            if retry_after:
+                self.rate_limited += 1
+                return retry_after
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return 0.0
+
+    def acquire(self):
+        """Take a concurrency slot within the latency budget; False means shed the request"""
+        with self._cond:
+            if self.in_flight < self.concurrency:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.shed += 1
+                return False
+
+            self.waiting += 1
+            started = time.monotonic()
+            try:
+                got_slot = self._cond.wait_for(lambda: self.in_flight < self.concurrency,
+                                               self.max_wait)
+            finally:
+                self.waiting -= 1
+                self.wait_seconds += time.monotonic() - started
+            if not got_slot:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rate_limited': self.rate_limited,
+                'shed': self.shed,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'buckets': len(self._buckets),
+                'limits': {'rate': self.rate, 'burst': self.burst, 'concurrency': self.concurrency,
+                           'max_queue': self.max_queue, 'max_wait': self.max_wait},
+            }
+
+
+class AdmissionController:
+    def __init__(self, classes, trust_proxy=False):
+        self.classes = {name: AdmissionClass(name, **params) for name, params in classes.items()}
+        self.trust_proxy = trust_proxy
+
+    def client_keys(self):
+        address = request.access_route[0] if self.trust_proxy and request.access_route \
+            else request.remote_addr
+        keys = [(f'ip:{address}', IP_SHARE_FACTOR)]
+        if 'user_id' in session:
+            keys.append((f'user:{session["user_id"]}', 1))
+        return keys
+
+    def before_request(self, view_functions):
+        view = view_functions.get(request.endpoint)
+        name = getattr(view, 'admission_class', None)
+        if name is None:
+            return None
+        admission_class = self.classes[name]
+
+        retry_after = admission_class.check_rate(self.client_keys())
+        if retry_after:
+            return rejection('Too many requests, please slow down', 429, retry_after)
+        if not admission_class.acquire():
+            return rejection('Server busy, please retry', 503, admission_class.max_wait)
+
+        g.admission_slot = admission_class
+        return None
+
+    def stats(self):
+        return {name: c.stats() for name, c in self.classes.items()}
+
+
+def release_slot():
+    """Give back the current request's slot early, for a view that goes on to wait idle"""
+    admission_class = g.pop('admission_slot', None)
+    if admission_class is not None:
+        admission_class.release()
+
+
+def rejection(message, status, retry_after):
+    response = jsonify({'error': message})
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
+
+def init_app(app):
+    """Install admission control hooks, returning the controller (None when disabled)"""
+    load_config(app, DEFAULT_CONFIG)
+    if not app.config['ADMISSION_CONTROL']:
+        return None
+
+    classes = {name: dict(params) for name, params in CLASSES.items()}
+    if app.config['ADMISSION_LIMITS']:
+        for name, overrides in json.loads(app.config['ADMISSION_LIMITS']).items():
+            classes.setdefault(name, dict(CLASSES.get(name, CLASSES['generate']))).update(overrides)
+    controller = AdmissionController(classes, trust_proxy=app.config['ADMISSION_TRUST_PROXY'])
+
+    @app.before_request
+    def admit():
+        return controller.before_request(app.view_functions)
+
+    @app.after_request
+    def hold_slot_while_streaming(response):
+        admission_class = g.pop('admission_slot', None)
+        if admission_class is not None:
+            # Released once the body is fully sent, not when the view returns
+            response.call_on_close(admission_class.release)
+        return response
+
+    @app.teardown_request
+    def release_unsent(exception=None):
+        # Only still set when after_request didn't run
+        release_slot()
+
+    app.extensions['admission'] = controller
+    return controller
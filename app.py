@@ -1,78 +1,151 @@
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, abort, request, jsonify, session
 from flask_cors import CORS
-from datetime import datetime
+import click
+from datetime import datetime, timezone
 import secrets
+import html
 import json
+import queue
+import re
+import time
+
+import admission
+import auth
+import catalog
+import compression
+import db
+import llm
+import metrics
+import migrations
+import passwords
+import profiling
+import quizzes
+import retention
+import summaries
+import writebehind
+from db import get_db, transaction
+from pagination import CursorError, fetch_page, page_params
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(32)  # Generate secure secret key
 CORS(app, supports_credentials=True, origins=['http://localhost:8084', 'http://127.0.0.1:8084'])
+db.init_app(app)
+text_codec = compression.init_app(app)
+metrics.init_app(app)
+profiling.init_app(app)
+writebehind.init_app(app)
+purger = retention.init_app(app)
+paper_catalog = catalog.Catalog(db.get_pool(app))
+summary_cache = summaries.init_app(app)
+quiz_store = quizzes.init_app(app)
+llm_client = llm.init_app(app)
+admission.init_app(app)
+password_hasher = passwords.init_app(app)
+auth.init_app(app)
+
+# Length of the first/last message previews kept on chat_sessions
+PREVIEW_LENGTH = 120
+
+def flush_pending_writes(user_id):
+    """Make the user's queued write-behind rows visible before reading or deleting
+
+    Aborts with 503 when they aren't committed within WRITE_BEHIND_FLUSH_TIMEOUT,
+    rather than read or delete without them.
+    """
+    write_queue = app.extensions.get('write_behind')
+    if write_queue is not None and not write_queue.flush(user_id):
+        app.logger.warning('Queued writes of user %s not committed in time', user_id)
+        response, status = server_busy_response()
+        response.status_code = status
+        abort(response)
+
+def queue_write(kind, payload):
+    """Queue a row for the write-behind writer; False when write-behind is disabled"""
+    write_queue = app.extensions.get('write_behind')
+    if write_queue is None:
+        return False
+    write_queue.submit(kind, payload['user_id'], payload)
+    return True
+
+def server_busy_response():
+    response = jsonify({'error': 'Server busy, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Full-text search over the user's own history (FTS5 indexes from migration 6)
+MAX_SEARCH_RESULTS = 50
+SNIPPET_TOKENS = 12
+FTS_TERM_RE = re.compile(r'\w+')
+# highlight()/snippet() wrap matches in these private-use characters; the
+# stored text is escaped before they become <mark> tags
+MARK_START, MARK_END = '\ue000', '\ue001'
+FTS_MARKERS = f"'{MARK_START}', '{MARK_END}'"
+
+def fts_terms(text):
+    """Quote each word of a search box query for FTS5; the last word also matches as a prefix"""
+    words = FTS_TERM_RE.findall(text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def marked_html(text):
+    """HTML-escape highlight()/snippet() output, turning its markers into <mark> tags"""
+    if text is None:
+        return None
+    return html.escape(text).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+def search_params(args):
+    """Read q/limit/offset for a history search, raising ValueError on bad input"""
+    terms = fts_terms(args.get('q', ''))
+    if terms is None:
+        raise ValueError('Search query required')
+    try:
+        limit = int(args.get('limit', 20))
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        raise ValueError('Invalid limit or offset')
+    return terms, max(1, min(limit, MAX_SEARCH_RESULTS)), max(0, offset)
 
-# Database initialization
 def init_db():
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    
-    # Search history table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS search_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        query TEXT NOT NULL,
-        model_type TEXT NOT NULL,
-        response TEXT,
-        sources TEXT,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-    )
-    """)
-    
-    # Chat history table for persistent conversation storage
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS chat_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        session_id TEXT NOT NULL,
-        role TEXT NOT NULL,
-        content TEXT NOT NULL,
-        model_type TEXT,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-    )
-    """)
-    
-    # Chat sessions table to track conversation sessions
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS chat_sessions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        session_id TEXT UNIQUE NOT NULL,
-        session_name TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-    )
-    """)
-    
-    conn.commit()
-    conn.close()
+    """Apply pending schema migrations (run once per deploy, not per request)"""
+    with db.get_pool(app).connection() as conn:
+        return migrations.migrate(conn)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations to the configured database"""
+    for version, description in init_db():
+        print(f"Applied migration {version}: {description}")
+
+@app.cli.command('import-papers')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_papers_command(path):
+    """Load papers from a JSON array or NDJSON file into the catalog, keyed on DOI"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        papers = json.loads(text)
+    else:
+        papers = [json.loads(line) for line in text.splitlines() if line.strip()]
+    paper_catalog.import_papers(papers)
+    print(f"Imported {len(papers)} papers")
 
-init_db()
+@app.cli.command('bench-password-hash')
+@click.option('--rounds', default=3, show_default=True, help='Hashes timed per setting')
+def bench_password_hash_command(rounds):
+    """Time PBKDF2 and scrypt at several costs to choose PASSWORD_* settings"""
+    methods = [passwords.hash_method('pbkdf2', iterations=i) for i in (260000, 600000, 1000000)]
+    methods += [passwords.hash_method('scrypt', n=n, r=8, p=1) for n in (2 ** 14, 2 ** 15, 2 ** 16)]
+    print(f"{'method':<28}{'ms/hash':>10}{'memory MiB':>12}")
+    for method, seconds, memory in passwords.benchmark(methods, rounds):
+        print(f"{method:<28}{seconds * 1000:>10.1f}{memory / 2 ** 20:>12.0f}")
+    print(f"Configured: {password_hasher.method}; aim for roughly 100-250 ms per hash "
+          f"on production hardware")
 
 @app.route('/api/auth/register', methods=['POST'])
+@admission.limit('auth')
 def register():
     data = request.json
     username = data.get('username', '').strip()
@@ -86,29 +159,32 @@ def register():
         return jsonify({'error': 'Password must be at least 8 characters'}), 400
     
     try:
-        conn = sqlite3.connect("users.db")
-        cursor = conn.cursor()
+        # Hash password securely, in the hashing process pool
+        password_hash = password_hasher.hash(password)
         
-        # Hash password securely
-        password_hash = generate_password_hash(password, method='pbkdf2:sha256')
-        
-        cursor.execute(
-            "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
-            (username, email, password_hash)
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
+        with transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
+                (username, email, password_hash)
+            )
+            user_id = cursor.lastrowid
         
         # Set session
         session['user_id'] = user_id
         session['username'] = username
         
+        # Replaces a miss cached for this id, if any
+        profile = {'id': user_id, 'username': username, 'email': email}
+        auth.get_cache().put(user_id, profile)
+        
         return jsonify({
             'success': True,
-            'user': {'id': user_id, 'username': username, 'email': email}
+            'user': profile
         })
     
+    except passwords.HasherBusy:
+        return server_busy_response()
+    
     except sqlite3.IntegrityError as e:
         if 'username' in str(e):
             return jsonify({'error': 'Username already exists'}), 409
@@ -117,6 +193,7 @@ def register():
         return jsonify({'error': 'Registration failed'}), 500
 
 @app.route('/api/auth/login', methods=['POST'])
+@admission.limit('auth')
 def login():
     data = request.json
     username = data.get('username', '').strip()
@@ -125,26 +202,47 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    
-    cursor.execute(
+    cursor = get_db().execute(
         "SELECT id, username, email, password_hash FROM users WHERE username = ?",
         (username,)
     )
     user = cursor.fetchone()
-    conn.close()
     
-    if not user or not check_password_hash(user[3], password):
-        return jsonify({'error': 'Invalid credentials'}), 401
+    try:
+        if not user:
+            # Same response time as a wrong password, without hashing anything;
+            # the padding is idle, so it doesn't hold an auth slot
+            delay = password_hasher.unknown_user_delay()
+            admission.release_slot()
+            time.sleep(delay)
+            return jsonify({'error': 'Invalid credentials'}), 401
+        
+        if not password_hasher.verify(user[3], password):
+            return jsonify({'error': 'Invalid credentials'}), 401
+        
+        # Upgrade hashes made with an older scheme or cost while we have the
+        # password; hashed before the transaction so the writer lock isn't held for it
+        if password_hasher.needs_rehash(user[3]):
+            password_hash = password_hasher.hash(password)
+            with transaction() as conn:
+                conn.execute(
+                    "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                    (password_hash, user[0], user[3])
+                )
+    except passwords.HasherBusy:
+        return server_busy_response()
     
     # Set session
     session['user_id'] = user[0]
     session['username'] = user[1]
     
+    # Fresh from the users table; replaces whatever this process had cached
+    profile = {'id': user[0], 'username': user[1], 'email': user[2]}
+    auth.get_cache().put(user[0], profile)
+    
     return jsonify({
         'success': True,
-        'user': {'id': user[0], 'username': user[1], 'email': user[2]}
+        'user': profile
     })
 
 @app.route('/api/auth/logout', methods=['POST'])
@@ -153,65 +251,76 @@ def logout():
     return jsonify({'success': True})
 
 @app.route('/api/auth/me', methods=['GET'])
+@auth.login_required
 def get_current_user():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, username, email FROM users WHERE id = ?",
-        (session['user_id'],)
+    """Get the logged-in user's profile from the user cache"""
+    return jsonify({'user': auth.current_user()})
+
+@writebehind.handler('history')
+def store_history_entries(conn, entries):
+    """Insert search history rows; must run inside a write transaction"""
+    conn.executemany(
+        """INSERT INTO search_history (user_id, query, model_type, response, sources)
+           VALUES (?, ?, ?, ?, ?)""",
+        [(e['user_id'], e['query'], e['model_type'], text_codec.compress(e['response']),
+          text_codec.compress(e['sources'])) for e in entries]
     )
-    user = cursor.fetchone()
-    conn.close()
-    
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    return jsonify({
-        'user': {'id': user[0], 'username': user[1], 'email': user[2]}
-    })
+
+def parse_history_entry(data, user_id):
+    """Validate a search history payload, returning (entry, error)"""
+    if not isinstance(data, dict):
+        return None, 'Expected a JSON object'
+    
+    entry = {
+        'user_id': user_id,
+        'query': data.get('query', ''),
+        'model_type': data.get('model_type', 'researcher'),
+        'response': data.get('response', ''),
+        'sources': str(data.get('sources', []))
+    }
+    if not all(isinstance(entry[field], str) for field in ('query', 'model_type', 'response')):
+        return None, 'query, model_type and response must be strings'
+    return entry, None
 
 @app.route('/api/history', methods=['POST'])
+@auth.login_required
 def save_history():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    # Rejected here rather than by the write-behind writer after the 202
+    entry, error = parse_history_entry(request.json, session['user_id'])
+    if error:
+        return jsonify({'error': error}), 400
     
-    data = request.json
-    query = data.get('query', '')
-    model_type = data.get('model_type', 'researcher')
-    response = data.get('response', '')
-    sources = str(data.get('sources', []))
+    try:
+        if queue_write('history', entry):
+            return jsonify({'success': True, 'queued': True}), 202
+    except queue.Full:
+        return server_busy_response()
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO search_history (user_id, query, model_type, response, sources)
-           VALUES (?, ?, ?, ?, ?)""",
-        (session['user_id'], query, model_type, response, sources)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        store_history_entries(conn, [entry])
     
     return jsonify({'success': True})
 
 @app.route('/api/history', methods=['GET'])
+@auth.login_required
 def get_history():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT id, query, model_type, response, sources, timestamp
-           FROM search_history WHERE user_id = ?
-           ORDER BY timestamp DESC LIMIT 100""",
-        (session['user_id'],)
+    flush_pending_writes(session['user_id'])
+    
+    try:
+        page = page_params(request.args, default_limit=100)
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    rows, page_info = fetch_page(
+        get_db(),
+        "id, query, model_type, zunpack(response), zunpack(sources), timestamp",
+        "search_history", f"user_id = ? AND {retention.SEARCH_VISIBLE}",
+        (session['user_id'], session['user_id']),
+        "timestamp", page, newest_first=True
     )
     
     history = []
-    for row in cursor.fetchall():
+    for row in rows:
         history.append({
             'id': row[0],
             'query': row[1],
@@ -221,99 +330,183 @@ def get_history():
             'timestamp': row[5]
         })
     
-    conn.close()
-    return jsonify({'history': history})
+    return jsonify({'history': history, 'page': page_info})
 
 @app.route('/api/history/<int:history_id>', methods=['DELETE'])
+@auth.login_required
 def delete_history_item(history_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "DELETE FROM search_history WHERE id = ? AND user_id = ?",
-        (history_id, session['user_id'])
-    )
-    conn.commit()
-    conn.close()
+    flush_pending_writes(session['user_id'])
+    
+    with transaction() as conn:
+        conn.execute(
+            "DELETE FROM search_history WHERE id = ? AND user_id = ?",
+            (history_id, session['user_id'])
+        )
     
     return jsonify({'success': True})
 
 @app.route('/api/history/clear', methods=['DELETE'])
+@auth.login_required
 def clear_history():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    flush_pending_writes(session['user_id'])
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "DELETE FROM search_history WHERE user_id = ?",
-        (session['user_id'],)
-    )
-    conn.commit()
-    conn.close()
+    # Hidden at once, deleted in batches by the purger
+    with transaction() as conn:
+        retention.clear_user_history(conn, session['user_id'], 'search_history')
     
     return jsonify({'success': True})
 
+@app.route('/api/history/search', methods=['GET'])
+@admission.limit('search')
+@auth.login_required
+def search_history():
+    """Search the user's past queries and responses, best matches first"""
+    try:
+        terms, limit, offset = search_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    flush_pending_writes(session['user_id'])
+    
+    # user_id is matched inside the index and weighted 0 in bm25()
+    cursor = get_db().execute(
+        f"""SELECT h.id, highlight(search_history_fts, 0, {FTS_MARKERS}),
+                  snippet(search_history_fts, 1, {FTS_MARKERS}, '…', {SNIPPET_TOKENS}),
+                  h.model_type, h.timestamp
+           FROM search_history_fts
+           JOIN search_history h ON h.id = search_history_fts.rowid
+           WHERE search_history_fts MATCH ? AND h.id > {retention.SEARCH_HIDDEN_THROUGH}
+           ORDER BY bm25(search_history_fts, 2.0, 1.0, 0.0)
+           LIMIT ? OFFSET ?""",
+        (f'user_id : "{session["user_id"]}" AND {{query response}} : ({terms})',
+         session['user_id'], limit + 1, offset)
+    )
+    rows = cursor.fetchall()
+    
+    results = []
+    for row in rows[:limit]:
+        results.append({
+            'id': row[0],
+            'query': marked_html(row[1]),
+            'snippet': marked_html(row[2]),
+            'model_type': row[3],
+            'timestamp': row[4]
+        })
+    
+    return jsonify({'results': results, 'has_more': len(rows) > limit})
+
 # Chat History API Endpoints
 
+@app.route('/api/chat/search', methods=['GET'])
+@admission.limit('search')
+@auth.login_required
+def search_chat_history():
+    """Search the user's chat messages across all sessions, best matches first"""
+    try:
+        terms, limit, offset = search_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    flush_pending_writes(session['user_id'])
+    
+    cursor = get_db().execute(
+        f"""SELECT m.id, m.session_id, s.session_name, m.role, m.model_type, m.timestamp,
+                  snippet(chat_history_fts, 0, {FTS_MARKERS}, '…', {SNIPPET_TOKENS})
+           FROM chat_history_fts
+           JOIN chat_history m ON m.id = chat_history_fts.rowid
+           JOIN chat_sessions s ON s.session_id = m.session_id
+           WHERE chat_history_fts MATCH ? AND m.id > {retention.session_floor_sql('s')}
+           ORDER BY bm25(chat_history_fts, 1.0, 0.0)
+           LIMIT ? OFFSET ?""",
+        (f'user_id : "{session["user_id"]}" AND content : ({terms})', limit + 1, offset)
+    )
+    rows = cursor.fetchall()
+    
+    results = []
+    for row in rows[:limit]:
+        results.append({
+            'id': row[0],
+            'session_id': row[1],
+            'session_name': row[2] or f"Conversation {row[1][:8]}",
+            'role': row[3],
+            'model_type': row[4],
+            'timestamp': row[5],
+            'snippet': marked_html(row[6])
+        })
+    
+    return jsonify({'results': results, 'has_more': len(rows) > limit})
+
 @app.route('/api/chat/sessions', methods=['GET'])
+@auth.login_required
 def get_chat_sessions():
-    """Get all chat sessions for the current user"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT session_id, session_name, created_at, last_activity,
-           (SELECT COUNT(*) FROM chat_history WHERE session_id = cs.session_id) as message_count
-           FROM chat_sessions cs WHERE user_id = ?
-           ORDER BY last_activity DESC""",
-        (session['user_id'],)
+    """Get a page of chat sessions for the current user, most recently active first"""
+    flush_pending_writes(session['user_id'])
+    
+    try:
+        page = page_params(request.args)
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    rows, page_info = fetch_page(
+        get_db(),
+        """session_id, session_name, created_at, last_activity, message_count,
+           question_count, first_message_preview, last_message_preview""",
+        "chat_sessions", f"user_id = ? AND {retention.SESSION_VISIBLE}", (session['user_id'],),
+        "last_activity", page, newest_first=True
     )
     
     sessions = []
-    for row in cursor.fetchall():
+    for row in rows:
         sessions.append({
             'session_id': row[0],
             'session_name': row[1] or f"Conversation {row[0][:8]}",
             'created_at': row[2],
             'last_activity': row[3],
-            'message_count': row[4]
+            'message_count': row[4],
+            'question_count': row[5],
+            'first_message_preview': row[6],
+            'last_message_preview': row[7]
         })
     
-    conn.close()
-    return jsonify({'sessions': sessions})
+    return jsonify({'sessions': sessions, 'page': page_info})
 
 @app.route('/api/chat/session/<session_id>', methods=['GET'])
+@auth.login_required
 def get_chat_session(session_id):
-    """Get all messages for a specific chat session"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    """Get a page of messages for a specific chat session, oldest first
+
+    Without a cursor the latest page is returned; pass page.before back as
+    ?before= to lazy-load older messages.
+    """
+    flush_pending_writes(session['user_id'])
+    
+    try:
+        page = page_params(request.args, default_limit=100)
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+    conn = get_db()
     
     # Verify session belongs to user
-    cursor.execute(
-        "SELECT id FROM chat_sessions WHERE session_id = ? AND user_id = ?",
+    cursor = conn.execute(
+        f"""SELECT {retention.session_floor_sql()} FROM chat_sessions
+            WHERE session_id = ? AND user_id = ? AND {retention.SESSION_VISIBLE}""",
         (session_id, session['user_id'])
     )
-    if not cursor.fetchone():
+    row = cursor.fetchone()
+    if not row:
         return jsonify({'error': 'Session not found'}), 404
     
-    # Get messages
-    cursor.execute(
-        """SELECT id, role, content, model_type, timestamp
-           FROM chat_history WHERE session_id = ?
-           ORDER BY timestamp ASC""",
-        (session_id,)
+    # Get messages, leaving out those of a deleted earlier incarnation of the session
+    rows, page_info = fetch_page(
+        conn,
+        "id, role, zunpack(content), model_type, timestamp",
+        "chat_history", "session_id = ? AND id > ?", (session_id, row[0]),
+        "timestamp", page, newest_first=False
     )
     
     messages = []
-    for row in cursor.fetchall():
+    for row in rows:
         messages.append({
             'id': row[0],
             'role': row[1],
@@ -322,84 +515,201 @@ def get_chat_session(session_id):
             'timestamp': row[4]
         })
     
-    conn.close()
-    return jsonify({'messages': messages})
+    return jsonify({'messages': messages, 'page': page_info})
 
-@app.route('/api/chat/session', methods=['POST'])
-def save_chat_message():
-    """Save a chat message to the database"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+# Largest number of messages accepted by one batch request
+MAX_BATCH_MESSAGES = 1000
+
+def parse_chat_message(data, user_id):
+    """Validate one chat message payload, returning (message, error)"""
+    if not isinstance(data, dict):
+        return None, 'Each message must be an object'
     
-    data = request.json
     session_id = data.get('session_id')
     role = data.get('role')  # 'user' or 'assistant'
     content = data.get('content')
-    model_type = data.get('model_type', 'researcher')
     
     if not session_id or not role or not content:
-        return jsonify({'error': 'Missing required fields'}), 400
+        return None, 'Missing required fields'
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    
-    # Create or update session
-    cursor.execute(
+    model_type = data.get('model_type', 'researcher')
+    if not all(isinstance(value, str) for value in (session_id, role, content, model_type)):
+        return None, 'session_id, role, content and model_type must be strings'
+    
+    # Optional client-side timestamp (e.g. an offline backlog), stored as UTC like CURRENT_TIMESTAMP
+    timestamp = data.get('timestamp')
+    if timestamp:
+        try:
+            parsed = datetime.fromisoformat(str(timestamp))
+        except ValueError:
+            return None, 'Invalid timestamp'
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        timestamp = parsed.strftime('%Y-%m-%d %H:%M:%S')
+    
+    return {
+        'user_id': user_id,
+        'session_id': session_id,
+        'role': role,
+        'content': content,
+        'model_type': model_type,
+        'timestamp': timestamp or None
+    }, None
+
+def foreign_session(conn, messages):
+    """The first session_id among messages that belongs to another user, or None"""
+    for user_id, session_id in {(m['user_id'], m['session_id']) for m in messages}:
+        owner = conn.execute(
+            "SELECT user_id FROM chat_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if owner and owner[0] != user_id:
+            return session_id
+    return None
+
+@writebehind.handler('chat')
+def store_chat_messages(conn, messages):
+    """Insert messages and update each session's activity and aggregates once
+
+    Must run inside a write transaction. Returns the new message ids in
+    input order. Raises PermissionError, writing nothing, if a message names
+    another user's session.
+    """
+    # Per-session aggregates for this batch:
+    # [count, questions, first preview, last preview, last message id]
+    sessions = {}
+    for message in messages:
+        preview = message['content'][:PREVIEW_LENGTH]
+        key = (message['user_id'], message['session_id'])
+        aggregate = sessions.setdefault(key, [0, 0, preview, preview, None])
+        aggregate[0] += 1
+        aggregate[1] += 1 if message['role'] == 'user' else 0
+        aggregate[3] = preview
+    
+    # Create sessions that don't exist yet
+    conn.executemany(
         """INSERT OR IGNORE INTO chat_sessions (user_id, session_id, created_at, last_activity)
            VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)""",
-        (session['user_id'], session_id)
+        list(sessions)
+    )
+    # Checked again under the writer lock: the endpoints check before
+    # queueing, and a session may have been created since
+    session_id = foreign_session(conn, messages)
+    if session_id is not None:
+        raise PermissionError(f'Chat session {session_id} belongs to another user')
+    
+    # Sessions deleted earlier start afresh (see retention.py)
+    conn.executemany(
+        f"""UPDATE chat_sessions SET created_at = CURRENT_TIMESTAMP, session_name = NULL,
+           message_count = 0, question_count = 0,
+           first_message_preview = NULL, last_message_preview = NULL
+           WHERE session_id = ? AND user_id = ?
+           AND {retention.SESSION_LAST_MESSAGE} <= {retention.session_floor_sql()}""",
+        [(session_id, user_id) for user_id, session_id in sessions]
     )
     
-    # Update last activity
-    cursor.execute(
-        "UPDATE chat_sessions SET last_activity = CURRENT_TIMESTAMP WHERE session_id = ?",
-        (session_id,)
+    # Save messages
+    conn.executemany(
+        """INSERT INTO chat_history (user_id, session_id, role, content, model_type, timestamp)
+           VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))""",
+        [(m['user_id'], m['session_id'], m['role'], text_codec.compress(m['content']),
+          m['model_type'], m['timestamp']) for m in messages]
     )
     
-    # Save message
-    cursor.execute(
-        """INSERT INTO chat_history (user_id, session_id, role, content, model_type)
-           VALUES (?, ?, ?, ?, ?)""",
-        (session['user_id'], session_id, role, content, model_type)
+    # The writer lock is held, so AUTOINCREMENT handed out a contiguous id range
+    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    message_ids = list(range(last_id - len(messages) + 1, last_id + 1))
+    for message, message_id in zip(messages, message_ids):
+        sessions[(message['user_id'], message['session_id'])][4] = message_id
+    
+    # Update last activity and the session's message aggregates
+    conn.executemany(
+        """UPDATE chat_sessions SET last_activity = CURRENT_TIMESTAMP,
+           message_count = message_count + ?,
+           question_count = question_count + ?,
+           first_message_preview = COALESCE(first_message_preview, ?),
+           last_message_preview = ?,
+           last_message_id = ?
+           WHERE session_id = ? AND user_id = ?""",
+        [(count, questions, first, last, last_message_id, session_id, user_id)
+         for (user_id, session_id), (count, questions, first, last, last_message_id)
+         in sessions.items()]
     )
+    return message_ids
+
+@app.route('/api/chat/session', methods=['POST'])
+@auth.login_required
+def save_chat_message():
+    """Save a chat message to the database"""
+    message, error = parse_chat_message(request.json, session['user_id'])
+    if error:
+        return jsonify({'error': error}), 400
     
-    conn.commit()
-    message_id = cursor.lastrowid
-    conn.close()
+    # Checked before queueing too; store_chat_messages refusing it after the
+    # 202 would only dead-letter it (see writebehind.py)
+    if foreign_session(get_db(), [message]):
+        return jsonify({'error': 'Session belongs to another user'}), 403
+    
+    try:
+        if queue_write('chat', message):
+            return jsonify({'success': True, 'queued': True}), 202
+    except queue.Full:
+        return server_busy_response()
+    
+    try:
+        with transaction() as conn:
+            message_id = store_chat_messages(conn, [message])[0]
+    except PermissionError:
+        return jsonify({'error': 'Session belongs to another user'}), 403
     
     return jsonify({'success': True, 'message_id': message_id})
 
-@app.route('/api/chat/session/<session_id>', methods=['DELETE'])
-def delete_chat_session(session_id):
-    """Delete a chat session and all its messages"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+@app.route('/api/chat/session/batch', methods=['POST'])
+@auth.login_required
+def save_chat_messages_batch():
+    """Save many chat messages, possibly across sessions, in one transaction"""
+    flush_pending_writes(session['user_id'])
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+    data = request.json or {}
+    items = data.get('messages')
     
-    # Delete messages first (due to foreign key)
-    cursor.execute(
-        "DELETE FROM chat_history WHERE session_id = ? AND user_id = ?",
-        (session_id, session['user_id'])
-    )
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'messages must be a non-empty list'}), 400
     
-    # Delete session
-    cursor.execute(
-        "DELETE FROM chat_sessions WHERE session_id = ? AND user_id = ?",
-        (session_id, session['user_id'])
-    )
+    if len(items) > MAX_BATCH_MESSAGES:
+        return jsonify({'error': f'At most {MAX_BATCH_MESSAGES} messages per batch'}), 413
     
-    conn.commit()
-    conn.close()
+    messages = []
+    for index, item in enumerate(items):
+        message, error = parse_chat_message(item, session['user_id'])
+        if error:
+            return jsonify({'error': error, 'index': index}), 400
+        messages.append(message)
+    
+    try:
+        with transaction() as conn:
+            message_ids = store_chat_messages(conn, messages)
+    except PermissionError:
+        return jsonify({'error': 'Session belongs to another user'}), 403
+    
+    return jsonify({'success': True, 'message_ids': message_ids})
+
+@app.route('/api/chat/session/<session_id>', methods=['DELETE'])
+@auth.login_required
+def delete_chat_session(session_id):
+    """Delete a chat session and all its messages"""
+    flush_pending_writes(session['user_id'])
+    
+    # Hidden at once, deleted in batches by the purger
+    with transaction() as conn:
+        retention.delete_session(conn, session['user_id'], session_id)
     
     return jsonify({'success': True})
 
 @app.route('/api/chat/session/<session_id>/name', methods=['PUT'])
+@auth.login_required
 def update_session_name(session_id):
     """Update the name of a chat session"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    flush_pending_writes(session['user_id'])
     
     data = request.json
     session_name = data.get('session_name', '').strip()
@@ -407,103 +717,313 @@ def update_session_name(session_id):
     if not session_name:
         return jsonify({'error': 'Session name required'}), 400
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE chat_sessions SET session_name = ? WHERE session_id = ? AND user_id = ?",
-        (session_name, session_id, session['user_id'])
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            f"""UPDATE chat_sessions SET session_name = ?
+                WHERE session_id = ? AND user_id = ? AND {retention.SESSION_VISIBLE}""",
+            (session_name, session_id, session['user_id'])
+        )
     
     return jsonify({'success': True})
 
-@app.route('/api/chat/export/<session_id>', methods=['GET'])
-def export_chat_session(session_id):
-    """Export a chat session as JSON"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
-    
-    # Get session info
-    cursor.execute(
-        """SELECT session_name, created_at, last_activity FROM chat_sessions
-           WHERE session_id = ? AND user_id = ?""",
-        (session_id, session['user_id'])
+# Rows fetched from the cursor per streamed chunk during exports
+EXPORT_BATCH_SIZE = 500
+
+def _export_session_info(row):
+    session_id = row[0]
+    return {
+        'session_id': session_id,
+        'session_name': row[1] or f"Conversation {session_id[:8]}",
+        'created_at': row[2],
+        'last_activity': row[3],
+        'total_messages': row[4],
+        'total_questions': row[5]
+    }
+
+def _export_messages(conn, session_id, floor):
+    """Yield batches of message dicts for a session straight from the cursor"""
+    cursor = conn.execute(
+        """SELECT role, zunpack(content), model_type, timestamp FROM chat_history
+           WHERE session_id = ? AND id > ? ORDER BY timestamp ASC, id ASC""",
+        (session_id, floor)
     )
-    session_info = cursor.fetchone()
-    
-    if not session_info:
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        yield [
+            {'role': row[0], 'content': row[1], 'model_type': row[2], 'timestamp': row[3]}
+            for row in rows
+        ]
+
+def _export_sessions(conn, user_id, session_id=None):
+    """(info, floor) for each of the user's sessions, floor being its highest hidden message id"""
+    sql = f"""SELECT session_id, session_name, created_at, last_activity, message_count,
+              question_count, {retention.session_floor_sql()} FROM chat_sessions
+              WHERE user_id = ? AND {retention.SESSION_VISIBLE}"""
+    params = [user_id]
+    if session_id is not None:
+        sql += " AND session_id = ?"
+        params.append(session_id)
+    sql += " ORDER BY last_activity DESC, id DESC"
+    # Materialize only the session headers so the message cursor has the connection to itself
+    return [(_export_session_info(row), row[6]) for row in conn.execute(sql, params).fetchall()]
+
+def _stream_ndjson(pool, sessions):
+    with pool.connection() as conn:
+        for info, floor in sessions:
+            yield json.dumps({'type': 'session', **info}) + '\n'
+            for batch in _export_messages(conn, info['session_id'], floor):
+                yield ''.join(
+                    json.dumps({'type': 'message', 'session_id': info['session_id'], **message}) + '\n'
+                    for message in batch
+                )
+
+def _stream_session_json(conn, info, floor):
+    yield '{"session_info": ' + json.dumps(info) + ', "messages": ['
+    first = True
+    for batch in _export_messages(conn, info['session_id'], floor):
+        chunk = ', '.join(json.dumps(message) for message in batch)
+        yield chunk if first else ', ' + chunk
+        first = False
+    yield ']}'
+
+def _stream_json(pool, sessions, single):
+    with pool.connection() as conn:
+        if single:
+            yield from _stream_session_json(conn, *sessions[0])
+            return
+
+        yield '{"sessions": ['
+        for index, (info, floor) in enumerate(sessions):
+            if index:
+                yield ', '
+            yield from _stream_session_json(conn, info, floor)
+        yield ']}'
+
+def _export_response(session_id=None):
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
+    
+    # Session headers are read once, here: one deleted or purged while the
+    # body streams is exported with whatever messages remain, and the JSON
+    # stays well-formed
+    sessions = _export_sessions(get_db(), session['user_id'], session_id)
+    if session_id is not None and not sessions:
         return jsonify({'error': 'Session not found'}), 404
     
-    # Get messages
-    cursor.execute(
-        """SELECT role, content, model_type, timestamp FROM chat_history
-           WHERE session_id = ? ORDER BY timestamp ASC""",
-        (session_id,)
-    )
+    # The generator outlives the request context, so it takes its own pooled connection
+    pool = db.get_pool()
+    if fmt == 'ndjson':
+        body, mimetype = _stream_ndjson(pool, sessions), 'application/x-ndjson'
+    else:
+        body, mimetype = _stream_json(pool, sessions, session_id is not None), 'application/json'
     
-    messages = []
-    for row in cursor.fetchall():
-        messages.append({
-            'role': row[0],
-            'content': row[1],
-            'model_type': row[2],
-            'timestamp': row[3]
-        })
-    
-    conn.close()
-    
-    export_data = {
-        'session_info': {
-            'session_id': session_id,
-            'session_name': session_info[0] or f"Conversation {session_id[:8]}",
-            'created_at': session_info[1],
-            'last_activity': session_info[2],
-            'total_messages': len(messages),
-            'total_questions': len([m for m in messages if m['role'] == 'user'])
-        },
-        'messages': messages
-    }
+    return Response(body, mimetype=mimetype, headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/chat/export/<session_id>', methods=['GET'])
+@admission.limit('export')
+@auth.login_required
+def export_chat_session(session_id):
+    """Export a chat session, streamed as JSON or NDJSON (?format=ndjson)"""
+    flush_pending_writes(session['user_id'])
     
-    return jsonify(export_data)
+    return _export_response(session_id)
+
+@app.route('/api/chat/export', methods=['GET'])
+@admission.limit('export')
+@auth.login_required
+def export_all_chat_sessions():
+    """Export every chat session of the current user, streamed as JSON or NDJSON"""
+    flush_pending_writes(session['user_id'])
+    
+    return _export_response()
 
 @app.route('/api/chat/clear-all', methods=['DELETE'])
+@auth.login_required
 def clear_all_chat_history():
     """Clear all chat history for the current user"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+    flush_pending_writes(session['user_id'])
     
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+    # Hidden at once, deleted in batches by the purger
+    with transaction() as conn:
+        retention.clear_user_history(conn, session['user_id'], 'chat_history')
     
-    # Delete all messages
-    cursor.execute(
-        "DELETE FROM chat_history WHERE user_id = ?",
-        (session['user_id'],)
-    )
+    return jsonify({'success': True})
+
+# LLM Proxy API Endpoint
+
+def sse_event(data, event=None):
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data)}\n\n'
+
+def save_exchange(pool, messages):
+    """Persist a finished question/answer pair through the chat_history path"""
+    with pool.connection() as conn:
+        with transaction(conn):
+            return store_chat_messages(conn, messages)
+
+def _stream_completion(pool, source, chunks, session_id, messages):
+    answer = []
+    try:
+        for text in chunks:
+            answer.append(text)
+            yield sse_event({'token': text})
+    except llm.UpstreamError as e:
+        app.logger.warning('Chat completion failed: %s', e)
+        yield sse_event({'error': 'Upstream model unavailable'}, 'error')
+        return
+    
+    message_ids = []
+    if messages:
+        messages[1]['content'] = ''.join(answer) or ' '
+        message_ids = save_exchange(pool, messages)
+    yield sse_event({'session_id': session_id, 'message_ids': message_ids, 'source': source}, 'done')
+
+@app.route('/api/chat/complete', methods=['POST'])
+@admission.limit('llm')
+def complete_chat():
+    """Ask an upstream model and stream its answer back as server-sent events
+
+    Each chunk is a `data: {"token": ...}` event, followed by a `done` event
+    (or an `error` event). For a logged-in user the question and the finished
+    answer are saved to the chat session. Send "stream": false for a single
+    JSON response instead, and "cache": false (or Cache-Control: no-cache)
+    to skip the shared response cache.
+    """
+    data = request.json or {}
+    prompt = data.get('message')
+    model_type = data.get('model_type') or llm.DEFAULT_MODEL
+    session_id = data.get('session_id') or f'chat_{secrets.token_hex(8)}'
+    
+    if not isinstance(prompt, str) or not prompt.strip():
+        return jsonify({'error': 'Message is required'}), 400
+    
+    if model_type not in llm_client.pools:
+        return jsonify({'error': f'Unknown model: {model_type}'}), 400
     
-    # Delete all sessions
-    cursor.execute(
-        "DELETE FROM chat_sessions WHERE user_id = ?",
-        (session['user_id'],)
+    messages = []
+    user = auth.current_user()
+    if user is not None:
+        user_id = user['id']
+        # The question is stamped now; the answer gets the time it finished
+        for role, content, timestamp in (('user', prompt, datetime.now(timezone.utc).isoformat()),
+                                         ('assistant', ' ', None)):
+            message, error = parse_chat_message({
+                'session_id': session_id, 'role': role, 'content': content,
+                'model_type': model_type, 'timestamp': timestamp
+            }, user_id)
+            if error:
+                return jsonify({'error': error}), 400
+            messages.append(message)
+        if foreign_session(get_db(), messages):
+            return jsonify({'error': 'Session not found'}), 404
+    
+    cache_control = request.headers.get('Cache-Control', '')
+    use_cache = data.get('cache', True) is not False and not (
+        'no-cache' in cache_control or 'no-store' in cache_control
     )
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'success': True})
+    source, chunks = llm_client.complete(model_type, prompt, session_id, use_cache=use_cache)
+    
+    # The generator outlives the request context, so it takes its own pooled connection
+    pool = db.get_pool()
+    
+    if data.get('stream', True) is False:
+        try:
+            answer = ''.join(chunks)
+        except llm.UpstreamError as e:
+            app.logger.warning('Chat completion failed: %s', e)
+            return jsonify({'error': 'Upstream model unavailable'}), 502
+        message_ids = []
+        if messages:
+            messages[1]['content'] = answer or ' '
+            message_ids = save_exchange(pool, messages)
+        return jsonify({'response': answer, 'session_id': session_id, 'message_ids': message_ids,
+                        'source': source})
+    
+    response = Response(
+        _stream_completion(pool, source, chunks, session_id, messages),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Releases a shared upstream call even if the body is never iterated
+    if hasattr(chunks, 'close'):
+        response.call_on_close(chunks.close)
+    return response
 
 # Paper Summarization API Endpoint
 
+def generate_summary(paper_title):
+    """Generate a structured summary (placeholder implementation)
+
+    In a real implementation, this would call an external AI service or API.
+    Bump SUMMARY_CACHE_VERSION whenever the output of this function changes.
+    """
+    return {
+        'paper_title': paper_title,
+        'summary': f'This research paper examines the effects of microgravity conditions on biological systems. The study "{paper_title}" investigates how the absence of gravitational forces influences cellular processes, physiological adaptations, and molecular mechanisms. The research contributes to our understanding of space biology and has implications for long-duration spaceflight missions.',
+        'key_findings': [
+            'Microgravity significantly alters cellular behavior and gene expression patterns',
+            'Physiological adaptations occur rapidly in weightless environments',
+            'Countermeasures may be necessary to mitigate negative effects during spaceflight'
+        ],
+        'methodology': 'The study likely employed ground-based microgravity simulation facilities, flight experiments, or analysis of astronaut data to investigate the biological responses to weightless conditions.',
+        'significance': 'This research is crucial for understanding how living organisms adapt to space environments and for developing strategies to maintain crew health during long-duration missions to Mars and beyond.',
+        'generated_at': datetime.now().isoformat()
+    }
+
+@app.cli.command('purge-summaries')
+def purge_summaries_command():
+    """Delete expired and outdated cached paper summaries"""
+    print(f"Purged {summary_cache.purge()} cached summaries")
+
+@app.cli.command('purge-history')
+def purge_history_command():
+    """Delete cleared and expired chat and search history now, then vacuum"""
+    counts = purger.run_once()
+    if counts is None:
+        print("Another process is purging history")
+        return
+    for table, count in sorted(counts.items()):
+        print(f"Purged {count} rows from {table}")
+
+@app.cli.command('compress-history')
+@click.option('--train/--no-train', default=True, show_default=True,
+              help='Train a new dictionary on recent history first')
+def compress_history_command(train):
+    """Recompress stored history with the current dictionary, a batch per transaction"""
+    pool = db.get_pool(app)
+    if train:
+        with pool.connection() as conn:
+            with transaction(conn):
+                dictionary_id = compression.train(conn, text_codec)
+        print(f"Trained dictionary {dictionary_id}" if dictionary_id is not None
+              else "Too little history to train a dictionary")
+    for table in compression.COMPRESSED_COLUMNS:
+        after_id = 0
+        while after_id is not None:
+            with pool.connection() as conn:
+                with transaction(conn):
+                    after_id = compression.compress_rows(conn, text_codec, table, after_id)
+        print(f"Compressed {table}")
+
+@app.cli.command('vacuum')
+def vacuum_command():
+    """Rebuild the database with incremental auto-vacuum (blocks writers while it runs)"""
+    with db.get_pool(app).connection() as conn:
+        conn.execute(f"PRAGMA auto_vacuum = {app.config['DB_AUTO_VACUUM']}")
+        conn.execute("VACUUM")
+    print(f"Vacuumed {app.config['DATABASE']}")
+
 @app.route('/api/papers/summarize', methods=['POST'])
+@admission.limit('generate')
 def summarize_paper():
-    """Generate a summary for a research paper"""
+    """Generate a summary for a research paper, served from the summary cache when possible"""
     try:
         data = request.json
         paper_title = data.get('paper_title', '').strip()
+        doi = data.get('doi')
         
         if not paper_title:
             return jsonify({
@@ -511,23 +1031,12 @@ def summarize_paper():
                 'error': 'Paper title is required'
             }), 400
         
-        # Generate a structured summary (placeholder implementation)
-        # In a real implementation, this would call an external AI service or API
-        summary_data = {
-            'success': True,
-            'paper_title': paper_title,
-            'summary': f'This research paper examines the effects of microgravity conditions on biological systems. The study "{paper_title}" investigates how the absence of gravitational forces influences cellular processes, physiological adaptations, and molecular mechanisms. The research contributes to our understanding of space biology and has implications for long-duration spaceflight missions.',
-            'key_findings': [
-                'Microgravity significantly alters cellular behavior and gene expression patterns',
-                'Physiological adaptations occur rapidly in weightless environments',
-                'Countermeasures may be necessary to mitigate negative effects during spaceflight'
-            ],
-            'methodology': 'The study likely employed ground-based microgravity simulation facilities, flight experiments, or analysis of astronaut data to investigate the biological responses to weightless conditions.',
-            'significance': 'This research is crucial for understanding how living organisms adapt to space environments and for developing strategies to maintain crew health during long-duration missions to Mars and beyond.',
-            'generated_at': datetime.now().isoformat()
-        }
+        summary, cached = summary_cache.get(
+            summaries.summary_key(paper_title, doi),
+            lambda: generate_summary(paper_title)
+        )
         
-        return jsonify(summary_data)
+        return jsonify(dict(summary, success=True, cached=cached))
         
     except Exception as e:
         return jsonify({
@@ -535,434 +1044,188 @@ def summarize_paper():
             'error': f'Failed to generate summary: {str(e)}'
         }), 500
 
-# Paper Search Suggestions API Endpoint
+# Quiz Generation API Endpoints
 
-@app.route('/api/papers/suggestions', methods=['GET'])
-def get_paper_suggestions():
-    """Get paper title suggestions for autocomplete"""
-    try:
-        query = request.args.get('q', '').strip().lower()
-        
-        if len(query) < 2:
-            return jsonify({'suggestions': []})
-        
-        # Sample paper suggestions (in a real implementation, this would query a database or API)
-        sample_papers = [
-            {'title': 'Effects of Microgravity on Plant Cell Wall Synthesis', 'authors': 'Smith, J. et al.', 'year': 2023},
-            {'title': 'DNA Repair Mechanisms in Space Environment', 'authors': 'Johnson, A. et al.', 'year': 2022},
-            {'title': 'Protein Crystallization Under Microgravity Conditions', 'authors': 'Brown, M. et al.', 'year': 2023},
-            {'title': 'Bone Density Changes During Long-Duration Spaceflight', 'authors': 'Davis, K. et al.', 'year': 2021},
-            {'title': 'Cardiovascular Adaptations to Microgravity', 'authors': 'Wilson, R. et al.', 'year': 2022},
-            {'title': 'Neural Plasticity in Altered Gravitational Fields', 'authors': 'Garcia, L. et al.', 'year': 2023},
-            {'title': 'Immune System Response to Space Radiation', 'authors': 'Taylor, S. et al.', 'year': 2022},
-            {'title': 'Muscle Atrophy Prevention in Microgravity', 'authors': 'Anderson, P. et al.', 'year': 2021},
-            {'title': 'Sleep Patterns and Circadian Rhythms in Space', 'authors': 'Martinez, C. et al.', 'year': 2023},
-            {'title': 'Psychological Effects of Long-Duration Space Missions', 'authors': 'Thompson, D. et al.', 'year': 2022}
-        ]
-        
-        # Filter suggestions based on query
-        suggestions = []
-        for paper in sample_papers:
-            if query in paper['title'].lower() or query in paper['authors'].lower():
-                suggestions.append(paper)
-        
-        # Limit to 5 suggestions
-        suggestions = suggestions[:5]
-        
-        return jsonify({'suggestions': suggestions})
-        
-    except Exception as e:
-        return jsonify({
-            'suggestions': [],
-            'error': f'Failed to get suggestions: {str(e)}'
-        }), 500
+# Placeholder questions; the first is formatted with the paper title
+QUIZ_QUESTION_BANK = [
+    {
+        "question": "What is the primary focus of the research paper '{paper_title}'?",
+        "options": {
+            "A": "Investigating the effects of microgravity on biological processes",
+            "B": "Developing new space exploration technologies",
+            "C": "Analyzing atmospheric conditions on Mars",
+            "D": "Studying solar radiation patterns"
+        },
+        "correct": "A",
+        "explanation": "The paper primarily focuses on biological processes and their response to space conditions."
+    },
+    {
+        "question": "Which methodology was most likely used in this research?",
+        "options": {
+            "A": "Theoretical modeling only",
+            "B": "Ground-based experiments with simulated conditions",
+            "C": "Observational studies from Earth",
+            "D": "Computer simulations exclusively"
+        },
+        "correct": "B",
+        "explanation": "Most space biology research uses ground-based experiments that simulate space conditions."
+    },
+    {
+        "question": "What are the potential applications of this research?",
+        "options": {
+            "A": "Improving astronaut health during long missions",
+            "B": "Developing better spacecraft materials",
+            "C": "Enhancing communication systems",
+            "D": "Creating new propulsion technologies"
+        },
+        "correct": "A",
+        "explanation": "Space biology research primarily aims to understand and mitigate the effects of space on living organisms."
+    },
+    {
+        "question": "Which of the following is a common challenge in space biology research?",
+        "options": {
+            "A": "Limited access to space-based experimental facilities",
+            "B": "Lack of funding for research projects",
+            "C": "Difficulty in replicating space conditions on Earth",
+            "D": "All of the above"
+        },
+        "correct": "D",
+        "explanation": "Space biology research faces multiple challenges including limited access to space, funding constraints, and technical difficulties."
+    },
+    {
+        "question": "What type of controls would be essential in this type of study?",
+        "options": {
+            "A": "Earth gravity conditions as a baseline",
+            "B": "Different time intervals for observation",
+            "C": "Multiple biological specimens",
+            "D": "All of the above"
+        },
+        "correct": "D",
+        "explanation": "Proper scientific methodology requires multiple types of controls to ensure valid results."
+    }
+]
+
+# Quizzes can't be longer than the generator can make them, so every count
+# above this would store the same quiz under another key
+MAX_QUIZ_QUESTIONS = len(QUIZ_QUESTION_BANK)
 
-# Quiz Generation API Endpoint
+def generate_quiz_questions(paper_title, num_questions):
+    """Generate multiple choice questions for a paper (placeholder implementation)
 
+    In a real application, this would use an AI service to generate questions.
+    Bump QUIZ_GENERATOR_VERSION whenever the output of this function changes.
+    """
+    return [dict(question, question=question['question'].format(paper_title=paper_title))
+            for question in QUIZ_QUESTION_BANK[:num_questions]]
+
+@app.route('/api/quiz/generate', methods=['POST'])
 @app.route('/api/papers/quiz', methods=['POST'])
+@admission.limit('generate')
 def generate_quiz():
-    """Generate a quiz for a research paper"""
+    """Get the stored quiz for a paper, generating it on first request"""
+    data = request.json
+    paper_title = data.get('paper_title', '').strip()
+    
     try:
-        data = request.json
-        paper_title = data.get('paper_title', '').strip()
-        
-        if not paper_title:
-            return jsonify({
-                'success': False,
-                'error': 'Paper title is required'
-            }), 400
-        
-        # Generate a sample quiz (placeholder implementation)
-        quiz_data = {
-            'success': True,
-            'paper_title': paper_title,
-            'quiz': {
-                'title': f'Quiz: {paper_title}',
-                'questions': [
-                    {
-                        'id': 1,
-                        'question': 'What is the primary focus of this research paper?',
-                        'options': [
-                            'Effects of microgravity on biological systems',
-                            'Spacecraft propulsion mechanisms',
-                            'Planetary geology studies',
-                            'Solar radiation analysis'
-                        ],
-                        'correct_answer': 0,
-                        'explanation': 'The paper focuses on how microgravity affects various biological processes and systems.'
-                    },
-                    {
-                        'id': 2,
-                        'question': 'Which research method is commonly used in microgravity studies?',
-                        'options': [
-                            'Computer simulations only',
-                            'Ground-based microgravity simulation facilities',
-                            'Theoretical analysis only',
-                            'Historical data review'
-                        ],
-                        'correct_answer': 1,
-                        'explanation': 'Ground-based microgravity simulation facilities allow researchers to study biological responses to weightless conditions.'
-                    },
-                    {
-                        'id': 3,
-                        'question': 'What is a key finding regarding cellular behavior in microgravity?',
-                        'options': [
-                            'Cells behave identically to Earth conditions',
-                            'Cellular behavior and gene expression patterns are significantly altered',
-                            'Only plant cells are affected',
-                            'Changes are temporary and reversible'
-                        ],
-                        'correct_answer': 1,
-                        'explanation': 'Research shows that microgravity significantly alters cellular behavior and gene expression patterns across various cell types.'
-                    }
-                ],
-                'total_questions': 3
-            },
-            'generated_at': datetime.now().isoformat()
-        }
-        
-        return jsonify(quiz_data)
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'Failed to generate quiz: {str(e)}'
-        }), 500
-
-if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+        num_questions = max(1, min(int(data.get('num_questions', 5)), MAX_QUIZ_QUESTIONS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid num_questions'}), 400
+    
+    if not paper_title:
+        return jsonify({'error': 'Paper title is required'}), 400
+    
+    quiz = quiz_store.get_or_create(
+        paper_title, num_questions,
+        lambda: generate_quiz_questions(paper_title, num_questions)
+    )
+    
+    return jsonify(quiz.public())
 
 # Quiz and Search Suggestions API Endpoints
 
 @app.route('/api/papers/search', methods=['GET'])
+@admission.limit('search')
 def search_papers():
-    """Search for papers with suggestions"""
+    """Search the paper catalog, optionally filtered by year, author or keyword"""
     query = request.args.get('q', '').strip()
-    limit = min(int(request.args.get('limit', 10)), 50)
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    
+    filters = {
+        'year': request.args.get('year', type=int),
+        'year_from': request.args.get('year_from', type=int),
+        'year_to': request.args.get('year_to', type=int),
+        'author': request.args.get('author', '').strip() or None,
+        'keyword': request.args.get('keyword', '').strip() or None
+    }
     
-    if not query:
+    if not query and not any(value is not None for value in filters.values()):
         return jsonify({'papers': []})
     
-    # Sample papers database (in a real app, this would query a database)
-    sample_papers = [
-        {
-            "title": "Effects of Microgravity on Plant Cell Wall Synthesis",
-            "authors": ["Johnson, M.K.", "Smith, A.L.", "Brown, R.T."],
-            "year": 2023,
-            "doi": "10.1016/j.spaceres.2023.001",
-            "abstract": "This study investigates how microgravity conditions affect the synthesis of plant cell walls...",
-            "keywords": ["microgravity", "plant", "cell wall", "synthesis"]
-        },
-        {
-            "title": "DNA Repair Mechanisms in Space Radiation Environment",
-            "authors": ["Chen, L.", "Williams, P.D.", "Davis, K.M."],
-            "year": 2022,
-            "doi": "10.1038/s41526-022-0234-1",
-            "abstract": "Space radiation poses significant challenges to DNA integrity. This research examines...",
-            "keywords": ["DNA", "repair", "radiation", "space"]
-        },
-        {
-            "title": "Bone Density Changes in Long-Duration Spaceflight",
-            "authors": ["Anderson, J.R.", "Thompson, S.A.", "Miller, C.L."],
-            "year": 2023,
-            "doi": "10.1007/s00223-023-1089-4",
-            "abstract": "Long-duration spaceflight results in significant bone density loss...",
-            "keywords": ["bone", "density", "spaceflight", "astronaut"]
-        },
-        {
-            "title": "Protein Crystallization in Microgravity Conditions",
-            "authors": ["Garcia, M.E.", "Wilson, D.K.", "Taylor, B.J."],
-            "year": 2021,
-            "doi": "10.1107/S2059798321009834",
-            "abstract": "Microgravity provides unique conditions for protein crystallization...",
-            "keywords": ["protein", "crystallization", "microgravity"]
-        },
-        {
-            "title": "Cardiovascular Adaptations to Zero Gravity",
-            "authors": ["Lee, H.S.", "Martinez, R.C.", "Jackson, T.M."],
-            "year": 2022,
-            "doi": "10.1152/japplphysiol.00456.2022",
-            "abstract": "The cardiovascular system undergoes significant adaptations in zero gravity...",
-            "keywords": ["cardiovascular", "zero gravity", "adaptation"]
-        },
-        {
-            "title": "Yeast Gene Expression Under Simulated Mars Conditions",
-            "authors": ["Patel, N.K.", "Robinson, A.F.", "White, L.G."],
-            "year": 2023,
-            "doi": "10.1089/ast.2023.0045",
-            "abstract": "This study examines how yeast gene expression changes under Mars-like conditions...",
-            "keywords": ["yeast", "gene expression", "mars", "conditions"]
-        },
-        {
-            "title": "Immune System Response to Extended Space Travel",
-            "authors": ["Kumar, S.R.", "Adams, M.J.", "Clark, P.L."],
-            "year": 2022,
-            "doi": "10.3389/fimmu.2022.987654",
-            "abstract": "Extended space travel significantly impacts immune system function...",
-            "keywords": ["immune", "system", "space travel", "extended"]
-        },
-        {
-            "title": "Muscle Atrophy Prevention Strategies in Microgravity",
-            "authors": ["Brooks, K.A.", "Evans, D.R.", "Moore, J.S."],
-            "year": 2023,
-            "doi": "10.1113/JP284567",
-            "abstract": "Muscle atrophy is a major concern in microgravity environments...",
-            "keywords": ["muscle", "atrophy", "prevention", "microgravity"]
-        }
-    ]
-    
-    # Filter papers based on query
-    query_lower = query.lower()
-    matching_papers = []
-    
-    for paper in sample_papers:
-        # Check if query matches title, authors, or keywords
-        title_match = query_lower in paper['title'].lower()
-        author_match = any(query_lower in author.lower() for author in paper['authors'])
-        keyword_match = any(query_lower in keyword.lower() for keyword in paper['keywords'])
-        
-        if title_match or author_match or keyword_match:
-            # Calculate relevance score
-            score = 0
-            if title_match:
-                score += 3
-            if author_match:
-                score += 2
-            if keyword_match:
-                score += 1
-            
-            paper_copy = paper.copy()
-            paper_copy['relevance_score'] = score
-            matching_papers.append(paper_copy)
-    
-    # Sort by relevance score and limit results
-    matching_papers.sort(key=lambda x: x['relevance_score'], reverse=True)
-    matching_papers = matching_papers[:limit]
+    total_matches, matching_papers = paper_catalog.index().search(query, limit=limit, **filters)
     
     return jsonify({
         'papers': matching_papers,
         'total': len(matching_papers),
+        'total_matches': total_matches,
         'query': query
     })
 
+# Paper Search Suggestions API Endpoint
+
 @app.route('/api/papers/suggestions', methods=['GET'])
+@admission.limit('search')
 def get_paper_suggestions():
     """Get paper title suggestions for autocomplete"""
     query = request.args.get('q', '').strip()
-    limit = min(int(request.args.get('limit', 5)), 10)
+    limit = max(1, min(request.args.get('limit', 5, type=int), 10))
     
     if not query or len(query) < 2:
         return jsonify({'suggestions': []})
     
-    # Use the same sample papers for suggestions
-    sample_papers = [
-        {
-            "title": "Effects of Microgravity on Plant Cell Wall Synthesis",
-            "authors": "Johnson, M.K., Smith, A.L., Brown, R.T.",
-            "year": 2023
-        },
-        {
-            "title": "DNA Repair Mechanisms in Space Radiation Environment",
-            "authors": "Chen, L., Williams, P.D., Davis, K.M.",
-            "year": 2022
-        },
-        {
-            "title": "Bone Density Changes in Long-Duration Spaceflight",
-            "authors": "Anderson, J.R., Thompson, S.A., Miller, C.L.",
-            "year": 2023
-        },
-        {
-            "title": "Protein Crystallization in Microgravity Conditions",
-            "authors": "Garcia, M.E., Wilson, D.K., Taylor, B.J.",
-            "year": 2021
-        },
-        {
-            "title": "Cardiovascular Adaptations to Zero Gravity",
-            "authors": "Lee, H.S., Martinez, R.C., Jackson, T.M.",
-            "year": 2022
-        },
-        {
-            "title": "Yeast Gene Expression Under Simulated Mars Conditions",
-            "authors": "Patel, N.K., Robinson, A.F., White, L.G.",
-            "year": 2023
-        },
-        {
-            "title": "Immune System Response to Extended Space Travel",
-            "authors": "Kumar, S.R., Adams, M.J., Clark, P.L.",
-            "year": 2022
-        },
-        {
-            "title": "Muscle Atrophy Prevention Strategies in Microgravity",
-            "authors": "Brooks, K.A., Evans, D.R., Moore, J.S.",
-            "year": 2023
-        }
-    ]
-    
-    query_lower = query.lower()
+    index = paper_catalog.index()
     suggestions = []
-    
-    for paper in sample_papers:
-        if query_lower in paper['title'].lower():
-            suggestions.append(paper)
-    
-    # Sort by title length (shorter titles first for better UX)
-    suggestions.sort(key=lambda x: len(x['title']))
-    suggestions = suggestions[:limit]
+    for paper_id in index.completions.suggest(query, limit):
+        paper = index.papers[paper_id]
+        suggestions.append({
+            'title': paper['title'],
+            'authors': ', '.join(paper['authors']),
+            'year': paper['year']
+        })
     
     return jsonify({'suggestions': suggestions})
 
-@app.route('/api/quiz/generate', methods=['POST'])
-def generate_quiz():
-    """Generate a quiz for a specific paper"""
-    data = request.json
-    paper_title = data.get('paper_title', '').strip()
-    num_questions = min(int(data.get('num_questions', 5)), 10)
-    
-    if not paper_title:
-        return jsonify({'error': 'Paper title is required'}), 400
-    
-    # In a real application, this would use an AI service to generate questions
-    # For demo purposes, we'll return sample quiz questions
-    sample_quiz = {
-        "paper_title": paper_title,
-        "questions": [
-            {
-                "question": f"What is the primary focus of the research paper '{paper_title}'?",
-                "options": {
-                    "A": "Investigating the effects of microgravity on biological processes",
-                    "B": "Developing new space exploration technologies",
-                    "C": "Analyzing atmospheric conditions on Mars",
-                    "D": "Studying solar radiation patterns"
-                },
-                "correct": "A",
-                "explanation": "The paper primarily focuses on biological processes and their response to space conditions."
-            },
-            {
-                "question": "Which methodology was most likely used in this research?",
-                "options": {
-                    "A": "Theoretical modeling only",
-                    "B": "Ground-based experiments with simulated conditions",
-                    "C": "Observational studies from Earth",
-                    "D": "Computer simulations exclusively"
-                },
-                "correct": "B",
-                "explanation": "Most space biology research uses ground-based experiments that simulate space conditions."
-            },
-            {
-                "question": "What are the potential applications of this research?",
-                "options": {
-                    "A": "Improving astronaut health during long missions",
-                    "B": "Developing better spacecraft materials",
-                    "C": "Enhancing communication systems",
-                    "D": "Creating new propulsion technologies"
-                },
-                "correct": "A",
-                "explanation": "Space biology research primarily aims to understand and mitigate the effects of space on living organisms."
-            },
-            {
-                "question": "Which of the following is a common challenge in space biology research?",
-                "options": {
-                    "A": "Limited access to space-based experimental facilities",
-                    "B": "Lack of funding for research projects",
-                    "C": "Difficulty in replicating space conditions on Earth",
-                    "D": "All of the above"
-                },
-                "correct": "D",
-                "explanation": "Space biology research faces multiple challenges including limited access to space, funding constraints, and technical difficulties."
-            },
-            {
-                "question": "What type of controls would be essential in this type of study?",
-                "options": {
-                    "A": "Earth gravity conditions as a baseline",
-                    "B": "Different time intervals for observation",
-                    "C": "Multiple biological specimens",
-                    "D": "All of the above"
-                },
-                "correct": "D",
-                "explanation": "Proper scientific methodology requires multiple types of controls to ensure valid results."
-            }
-        ]
-    }
-    
-    # Limit to requested number of questions
-    sample_quiz["questions"] = sample_quiz["questions"][:num_questions]
-    
-    return jsonify(sample_quiz)
-
 @app.route('/api/quiz/submit', methods=['POST'])
+@auth.login_required
 def submit_quiz():
     """Submit quiz answers and get results"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.json
-    paper_title = data.get('paper_title', '')
+    quiz_id = data.get('quiz_id')
     answers = data.get('answers', {})  # {question_index: selected_option}
     
-    if not paper_title or not answers:
-        return jsonify({'error': 'Paper title and answers are required'}), 400
+    if not isinstance(quiz_id, int) or not isinstance(answers, dict) or not answers:
+        return jsonify({'error': 'Quiz id and answers are required'}), 400
     
-    # In a real app, this would validate against the actual quiz questions
-    # For demo, we'll calculate a simple score
-    total_questions = len(answers)
-    correct_answers = 0
+    quiz = quiz_store.get(quiz_id)
+    if quiz is None:
+        return jsonify({'error': 'Quiz not found'}), 404
     
-    # Sample correct answers (in real app, this would come from database)
-    correct_answer_key = {0: 'A', 1: 'B', 2: 'A', 3: 'D', 4: 'D'}
+    answers = {str(index): option for index, option in answers.items()}
+    correct_answers, results = quiz.grade(answers)
+    total_questions = len(quiz.questions)
     
-    for question_index, user_answer in answers.items():
-        question_idx = int(question_index)
-        if question_idx in correct_answer_key and correct_answer_key[question_idx] == user_answer:
-            correct_answers += 1
-    
-    score_percentage = (correct_answers / total_questions * 100) if total_questions > 0 else 0
+    score_percentage = quizzes.percentage(correct_answers, total_questions)
     
     # Save quiz result to database (optional)
     try:
-        conn = sqlite3.connect("users.db")
-        cursor = conn.cursor()
-        
-        # Create quiz_results table if it doesn't exist
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quiz_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            paper_title TEXT NOT NULL,
-            score INTEGER NOT NULL,
-            total_questions INTEGER NOT NULL,
-            answers TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-        )
-        """)
-        
-        cursor.execute(
-            """INSERT INTO quiz_results (user_id, paper_title, score, total_questions, answers)
-               VALUES (?, ?, ?, ?, ?)""",
-            (session['user_id'], paper_title, correct_answers, total_questions, json.dumps(answers))
-        )
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            conn.execute(
+                """INSERT INTO quiz_results (user_id, quiz_id, paper_title, score, total_questions, answers)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (session['user_id'], quiz.id, quiz.paper_title, correct_answers, total_questions,
+                 json.dumps(answers))
+            )
+            quizzes.record_result(conn, session['user_id'], quiz.paper_title,
+                                  correct_answers, total_questions)
     except Exception as e:
         print(f"Error saving quiz result: {e}")
     
@@ -970,20 +1233,18 @@ def submit_quiz():
         'score': correct_answers,
         'total': total_questions,
         'percentage': round(score_percentage, 1),
-        'passed': score_percentage >= 70
+        'passed': score_percentage >= quizzes.PASS_PERCENTAGE,
+        'quiz_id': quiz.id,
+        'results': results
     })
 
 @app.route('/api/quiz/history', methods=['GET'])
+@auth.login_required
 def get_quiz_history():
     """Get quiz history for the current user"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     try:
-        conn = sqlite3.connect("users.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT paper_title, score, total_questions, timestamp
+        cursor = get_db().execute(
+            """SELECT paper_title, score, total_questions, timestamp, quiz_id
                FROM quiz_results WHERE user_id = ?
                ORDER BY timestamp DESC LIMIT 50""",
             (session['user_id'],)
@@ -997,10 +1258,131 @@ def get_quiz_history():
                 'score': row[1],
                 'total_questions': row[2],
                 'percentage': round(percentage, 1),
-                'timestamp': row[3]
+                'timestamp': row[3],
+                'quiz_id': row[4]
             })
         
-        conn.close()
         return jsonify({'history': history})
     except Exception as e:
         return jsonify({'error': 'Failed to load quiz history'}), 500
+
+# Quiz Analytics API Endpoints
+
+MAX_LEADERBOARD_SIZE = 100
+
+def quiz_stats_row(row):
+    return {
+        'attempts': row[0],
+        'passes': row[1],
+        'pass_rate': round(row[1] / row[0] * 100, 1) if row[0] else 0,
+        'average_percentage': round(row[2], 1),
+        'best_percentage': round(row[3], 1),
+        'average_score': round(row[4] / row[0], 2) if row[0] else 0
+    }
+
+@app.route('/api/quiz/stats', methods=['GET'])
+@auth.login_required
+def get_quiz_stats():
+    """Get the current user's quiz totals from the running summary table"""
+    row = get_db().execute(
+        """SELECT attempts, passes, avg_percentage, best_percentage, score_sum, last_attempt_at
+           FROM quiz_user_stats WHERE user_id = ?""",
+        (session['user_id'],)
+    ).fetchone()
+    
+    if not row:
+        return jsonify({'stats': quiz_stats_row((0, 0, 0, 0, 0)), 'last_attempt_at': None})
+    
+    return jsonify({'stats': quiz_stats_row(row), 'last_attempt_at': row[5]})
+
+@app.route('/api/quiz/stats/papers', methods=['GET'])
+@auth.login_required
+def get_paper_quiz_stats():
+    """Get per-paper quiz stats, most attempted first or by pass rate with ?sort=pass_rate"""
+    limit = max(1, min(request.args.get('limit', 20, type=int), MAX_LEADERBOARD_SIZE))
+    paper_title = request.args.get('paper_title', '').strip()
+    sort = request.args.get('sort', 'attempts')
+    if sort not in ('attempts', 'pass_rate'):
+        return jsonify({'error': 'sort must be attempts or pass_rate'}), 400
+    
+    sql = """SELECT attempts, passes, avg_percentage, best_percentage, score_sum, paper_title
+             FROM quiz_paper_stats"""
+    if paper_title:
+        rows = get_db().execute(sql + " WHERE paper_key = ?",
+                                (catalog.normalize(paper_title),)).fetchall()
+    else:
+        # Both orders match an index, so this reads just `limit` rows
+        rows = get_db().execute(sql + f" ORDER BY {sort} DESC, attempts DESC LIMIT ?",
+                                (limit,)).fetchall()
+    
+    papers = []
+    for row in rows:
+        papers.append(dict(quiz_stats_row(row), paper_title=row[5]))
+    
+    return jsonify({'papers': papers})
+
+@app.route('/api/quiz/leaderboard', methods=['GET'])
+@auth.login_required
+def get_quiz_leaderboard():
+    """Top users by average score, or by best score on one paper with ?paper_title="""
+    limit = max(1, min(request.args.get('limit', 10, type=int), MAX_LEADERBOARD_SIZE))
+    min_attempts = max(1, request.args.get('min_attempts', 1, type=int))
+    paper_title = request.args.get('paper_title', '').strip()
+    
+    if paper_title:
+        rows = get_db().execute(
+            """SELECT u.username, l.best_percentage, l.attempts, l.best_at
+               FROM quiz_paper_leaderboard l JOIN users u ON u.id = l.user_id
+               WHERE l.paper_key = ? AND l.attempts >= ?
+               ORDER BY l.best_percentage DESC, l.best_at ASC LIMIT ?""",
+            (catalog.normalize(paper_title), min_attempts, limit)
+        ).fetchall()
+    else:
+        rows = get_db().execute(
+            """SELECT u.username, s.avg_percentage, s.attempts, s.last_attempt_at
+               FROM quiz_user_stats s JOIN users u ON u.id = s.user_id
+               WHERE s.attempts >= ?
+               ORDER BY s.avg_percentage DESC, s.attempts DESC LIMIT ?""",
+            (min_attempts, limit)
+        ).fetchall()
+    
+    leaderboard = []
+    for rank, row in enumerate(rows, 1):
+        leaderboard.append({
+            'rank': rank,
+            'username': row[0],
+            'percentage': round(row[1], 1),
+            'attempts': row[2],
+            'timestamp': row[3]
+        })
+    
+    return jsonify({'leaderboard': leaderboard, 'paper_title': paper_title or None})
+
+@app.route('/api/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """Admission counters per endpoint class, for tuning the limits"""
+    if not metrics.scrape_allowed(app):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    controller = app.extensions.get('admission')
+    if controller is None:
+        return jsonify({'enabled': False, 'classes': {}})
+    
+    return jsonify({'enabled': True, 'classes': controller.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, SQL, cache and admission metrics in the Prometheus text format"""
+    if not metrics.scrape_allowed(app):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    collector = app.extensions.get('metrics')
+    if collector is None:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    
+    return Response(collector.render(), mimetype='text/plain; version=0.0.4')
+
+# Development server; run serve.py in production
+if __name__ == '__main__':
+    init_db()
+    app.run(debug=True, port=5000)
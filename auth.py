@@ -0,0 +1,151 @@
+"""Session authentication backed by an in-process user profile cache
+
+@login_required replaces the per-view `'user_id' not in session` checks and
+also confirms the account still exists. Profiles are cached for
+USER_CACHE_TTL seconds, so the check costs no database round-trip on the
+hot path. Code that creates, changes or deletes an account updates this
+process's cache with put() or invalidate(). Other worker processes, and
+edits made straight in the database, are only seen once their entries
+expire: USER_CACHE_TTL bounds how long a changed or deleted account is
+served stale. Unknown user ids are cached for the shorter
+USER_CACHE_MISS_TTL.
+
+Session cookies are signed with SECRET_KEY. When it isn't configured, a key
+is generated once and kept in SECRET_KEY_FILE, so every worker process and
+every restart signs with the same key instead of logging everyone out.
+"""
+import functools
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, jsonify, session
+
+from db import get_pool, load_config
+
+DEFAULT_CONFIG = {
+    'SECRET_KEY_FILE': 'secret_key',
+    'USER_CACHE_TTL': 60.0,
+    'USER_CACHE_MISS_TTL': 5.0,
+    'USER_CACHE_SIZE': 10000,
+}
+
+
+class UserCache:
+    """LRU of user_id -> profile dict (None for missing accounts) with a TTL"""
+
+    def __init__(self, pool, ttl=60.0, max_size=10000, miss_ttl=5.0):
+        self.pool = pool
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT id, username, email FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+        profile = {'id': row[0], 'username': row[1], 'email': row[2]} if row else None
+        self.put(user_id, profile)
+        return profile
+
+    def put(self, user_id, profile):
+        """Cache a profile, replacing any entry for user_id (including a cached miss)"""
+        ttl = self.ttl if profile is not None else self.miss_ttl
+        with self._lock:
+            self._entries[user_id] = (profile, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def invalidate(self, user_id=None):
+        """Forget one user, or everyone"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+def load_secret_key(app):
+    """SECRET_KEY from app.config or the environment, else the key kept in SECRET_KEY_FILE"""
+    key = app.config.get('SECRET_KEY') or os.environ.get('SECRET_KEY')
+    if key:
+        return key
+
+    path = app.config['SECRET_KEY_FILE']
+    try:
+        with open(path, encoding='ascii') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+
+    # Written under a temporary name and linked into place, so processes
+    # starting together all end up with whichever key was linked first
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'w', encoding='ascii') as f:
+            f.write(secrets.token_hex(32))
+        os.link(temp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(temp_path)
+    with open(path, encoding='ascii') as f:
+        return f.read().strip()
+
+
+def get_cache(app=None):
+    return (app or current_app).extensions['user_cache']
+
+
+def current_user():
+    """The logged-in user's profile, or None (clearing the session if the account is gone)"""
+    if 'user' in g:
+        return g.user
+    user_id = session.get('user_id')
+    user = get_cache().get(user_id) if user_id is not None else None
+    if user is None and user_id is not None:
+        session.clear()
+    g.user = user
+    return user
+
+
+def login_required(view):
+    """Reject the request with 401 unless it comes from an existing, logged-in user"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_user() is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    load_config(app, DEFAULT_CONFIG)
+    app.secret_key = load_secret_key(app)
+    cache = UserCache(get_pool(app), ttl=app.config['USER_CACHE_TTL'],
+                      max_size=app.config['USER_CACHE_SIZE'],
+                      miss_ttl=app.config['USER_CACHE_MISS_TTL'])
+    app.extensions['user_cache'] = cache
+    return cache
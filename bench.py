@@ -0,0 +1,564 @@
+"""Scale-data generator and endpoint benchmarks
+
+    python bench.py seed --users 100000 --sessions 5 --messages 20
+    python bench.py run [--http http://127.0.0.1:5000] [--concurrency 1,8,32]
+                        [--baseline bench_baseline.json] [--save-baseline]
+
+seed fills the configured DATABASE (users.db unless overridden) with bench
+users, chat sessions and messages, search history, papers and quiz results.
+The same options and --seed always produce the same rows. Every bench user
+has the password BENCH_PASSWORD.
+
+run drives each scenario for --duration seconds at every concurrency level,
+one logged-in bench user per client. It uses the Flask test client in this
+process, or a running server when --http is given. Each result has the
+p50/p95/p99 latency, throughput, status counts and the peak RSS of the
+process serving the requests. Results are compared against the stored
+baseline, and the exit status is 1 when p95 or throughput regressed by more
+than --tolerance. Scenarios that write add rows to the database, so run
+against a scratch copy of a seeded database.
+
+Test client runs disable admission control unless --admission is given, so
+that the numbers measure the endpoints and not the limits. Start the server
+with ADMISSION_CONTROL=0 for the same effect over HTTP.
+"""
+import http.client
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from urllib.parse import quote, urlsplit
+
+import click
+
+BENCH_PASSWORD = 'bench-password'
+
+# Seeded rows are dated within the year before this instant, so a seed is
+# reproducible whatever day it runs
+EPOCH = datetime(2025, 1, 1)
+
+# Rows per INSERT batch and transaction while seeding
+SEED_BATCH = 5000
+
+# Seconds between RSS samples while a scenario runs
+RSS_SAMPLE_INTERVAL = 0.05
+
+MODELS = ('researcher', 'student', 'manager')
+
+WORDS = (
+    'microgravity radiation bone density muscle atrophy plant growth cell wall gene expression '
+    'spaceflight astronaut immune response oxidative stress dna repair circadian rhythm '
+    'arabidopsis rodent habitat cardiovascular vestibular microbiome biofilm protein '
+    'crystallization tissue culture stem cells telomere calcium metabolism hydroponics '
+    'photosynthesis lunar regolith mars analog isolation sleep cognition fluid shift '
+    'vision intracranial pressure countermeasure exercise nutrition shielding cosmic rays'
+).split()
+
+
+# Scale data
+
+def words(rng, count):
+    return ' '.join(rng.choices(WORDS, k=count))
+
+
+def timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def random_moment(rng):
+    return EPOCH - timedelta(seconds=rng.randrange(365 * 86400))
+
+
+def bench_papers(count, rng):
+    papers = []
+    for i in range(count):
+        papers.append({
+            'title': f'{words(rng, 3).title()}: {words(rng, 4)} (bench {i})',
+            'authors': [f'{rng.choice(WORDS).title()}, {chr(65 + rng.randrange(26))}.'
+                        for _ in range(rng.randint(1, 4))],
+            'year': rng.randint(1995, 2024),
+            'doi': f'10.5555/bench.{i}',
+            'abstract': words(rng, 40),
+            'keywords': rng.sample(WORDS, 4),
+            'popularity': round(rng.random() * 100, 2),
+        })
+    return papers
+
+
+def batched(rows, size=SEED_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def chat_rows(rng, user_id, user_index, sessions, messages, preview_length):
+    """One user's (session rows, message rows), with the aggregates save_chat_message keeps"""
+    session_rows = []
+    message_rows = []
+    for s in range(sessions):
+        session_id = f'bench_{user_index}_{s}'
+        moment = random_moment(rng)
+        started = moment
+        contents = []
+        for m in range(messages):
+            role = 'user' if m % 2 == 0 else 'assistant'
+            content = words(rng, rng.randint(5, 20) if role == 'user' else rng.randint(40, 200))
+            contents.append(content)
+            message_rows.append((user_id, session_id, role, content, 'researcher',
+                                 timestamp(moment)))
+            moment += timedelta(seconds=rng.randint(5, 120))
+        session_rows.append((user_id, session_id, f'Bench session {s}', timestamp(started),
+                             timestamp(moment), messages, (messages + 1) // 2,
+                             contents[0][:preview_length] if contents else None,
+                             contents[-1][:preview_length] if contents else None))
+    return session_rows, message_rows
+
+
+@click.group()
+def cli():
+    """Scale-data generator and endpoint benchmarks"""
+
+
+@cli.command()
+@click.option('--users', default=1000, show_default=True)
+@click.option('--sessions', default=5, show_default=True, help='Chat sessions per user')
+@click.option('--messages', default=20, show_default=True, help='Messages per chat session')
+@click.option('--history', default=50, show_default=True, help='Search history rows per user')
+@click.option('--quiz-results', default=10, show_default=True, help='Quiz attempts per user')
+@click.option('--papers', default=1000, show_default=True, help='Catalog papers to add')
+@click.option('--quizzes', 'quiz_papers', default=50, show_default=True,
+              help='Papers with a stored quiz, which the quiz attempts are spread over')
+@click.option('--seed', 'random_seed', default=1, show_default=True)
+def seed(users, sessions, messages, history, quiz_results, papers, quiz_papers, random_seed):
+    """Fill the configured database with deterministic bench data"""
+    import compression
+    import quizzes
+    from app import (PREVIEW_LENGTH, app, generate_quiz_questions, init_db, paper_catalog,
+                     password_hasher, quiz_store, text_codec)
+    from db import get_pool, transaction
+
+    init_db()
+    pool = get_pool(app)
+    with pool.connection() as conn:
+        if conn.execute("SELECT 1 FROM users WHERE username = 'bench_user_0'").fetchone():
+            raise click.ClickException('This database is already seeded; seed a fresh one')
+        first_user_id = conn.execute("SELECT coalesce(max(id), 0) + 1 FROM users").fetchone()[0]
+
+    rng = random.Random(random_seed)
+    started = time.monotonic()
+
+    catalog_papers = bench_papers(papers, rng)
+    paper_catalog.import_papers(catalog_papers)
+    stored_quizzes = [
+        quiz_store.get_or_create(p['title'], 5, lambda t=p['title']: generate_quiz_questions(t, 5))
+        for p in catalog_papers[:quiz_papers]
+    ]
+    click.echo(f"papers: {papers}, quizzes: {len(stored_quizzes)}", err=True)
+
+    # Everyone shares one hash, since hashing per user would dominate the seed
+    password_hash = password_hasher.hash(BENCH_PASSWORD)
+
+    counts = Counter()
+    with pool.connection() as conn:
+        for batch in batched(range(users), max(1, SEED_BATCH // max(1, sessions * messages))):
+            with transaction(conn):
+                for u in batch:
+                    user_id = first_user_id + u
+                    conn.execute(
+                        """INSERT INTO users (id, username, email, password_hash, created_at)
+                           VALUES (?, ?, ?, ?, ?)""",
+                        (user_id, f'bench_user_{u}', f'bench_user_{u}@example.org',
+                         password_hash, timestamp(random_moment(rng)))
+                    )
+                    session_rows, message_rows = chat_rows(rng, user_id, u, sessions, messages,
+                                                           PREVIEW_LENGTH)
+                    conn.executemany(
+                        """INSERT INTO chat_sessions (user_id, session_id, session_name, created_at,
+                                                      last_activity, message_count, question_count,
+                                                      first_message_preview, last_message_preview)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        session_rows
+                    )
+                    conn.executemany(
+                        """INSERT INTO chat_history (user_id, session_id, role, content, model_type,
+                                                     timestamp)
+                           VALUES (?, ?, ?, ?, ?, ?)""",
+                        message_rows
+                    )
+                    conn.execute(
+                        """UPDATE chat_sessions SET last_message_id =
+                               (SELECT max(id) FROM chat_history h
+                                WHERE h.session_id = chat_sessions.session_id)
+                           WHERE user_id = ?""",
+                        (user_id,)
+                    )
+                    conn.executemany(
+                        """INSERT INTO search_history (user_id, query, model_type, response, sources,
+                                                       timestamp)
+                           VALUES (?, ?, ?, ?, ?, ?)""",
+                        [(user_id, words(rng, rng.randint(2, 8)), rng.choice(MODELS),
+                          words(rng, rng.randint(50, 300)),
+                          str([rng.choice(catalog_papers)['doi']]),
+                          timestamp(random_moment(rng)))
+                         for _ in range(history)]
+                    )
+                    # Through record_result so the quiz summary tables agree with the results
+                    for _ in range(quiz_results if stored_quizzes else 0):
+                        quiz = rng.choice(stored_quizzes)
+                        score = rng.randint(0, len(quiz.questions))
+                        conn.execute(
+                            """INSERT INTO quiz_results (user_id, quiz_id, paper_title, score,
+                                                         total_questions, answers, timestamp)
+                               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                            (user_id, quiz.id, quiz.paper_title, score, len(quiz.questions),
+                             json.dumps({str(i): 'A' for i in range(len(quiz.questions))}),
+                             timestamp(random_moment(rng)))
+                        )
+                        quizzes.record_result(conn, user_id, quiz.paper_title, score,
+                                              len(quiz.questions))
+                    counts['messages'] += len(message_rows)
+            counts['users'] += len(batch)
+            click.echo(f"\rusers: {counts['users']}/{users}, messages: {counts['messages']}",
+                       nl=False, err=True)
+        click.echo(err=True)
+        # Stored as the app stores them, with a dictionary trained on the seeded text
+        with transaction(conn):
+            compression.train(conn, text_codec)
+        for table in compression.COMPRESSED_COLUMNS:
+            after_id = 0
+            while after_id is not None:
+                with transaction(conn):
+                    after_id = compression.compress_rows(conn, text_codec, table, after_id)
+        conn.execute("ANALYZE")
+
+    click.echo(f"Seeded {users} users, {users * sessions} sessions, {counts['messages']} messages, "
+               f"{users * history} history rows and {users * quiz_results} quiz results "
+               f"in {time.monotonic() - started:.1f}s", err=True)
+
+
+# Clients
+
+class TestClient:
+    """Requests through the Flask test client, in this process"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        try:
+            # Reads streamed bodies (exports) to the end, as a real client would
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+
+class HTTPClient:
+    """Requests over one keep-alive connection to a running server"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.prefix = parts.path.rstrip('/')
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, body=None):
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        for attempt in range(2):
+            try:
+                self.connection.request(method, self.prefix + path, payload, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The server closed an idle keep-alive connection; reconnect once
+                self.connection.close()
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or ():
+            cookie = SimpleCookie(header)
+            if 'session' in cookie:
+                self.cookie = f"session={cookie['session'].value}"
+        return response.status, data
+
+
+class BenchUser:
+    """A client logged in as one bench user, with ids to use in requests"""
+
+    def __init__(self, client, index):
+        self.client = client
+        self.username = f'bench_user_{index}'
+        self.rng = random.Random(index)
+        self.session_ids = []
+        self.quizzes = []
+        self.paper_titles = []
+
+    def call(self, method, path, body=None, expect=200):
+        status, data = self.client.request(method, path, body)
+        if status != expect:
+            raise click.ClickException(f"{method} {path} returned {status} during setup: {data[:200]!r}")
+        return json.loads(data)
+
+    def setup(self):
+        self.call('POST', '/api/auth/login', {'username': self.username, 'password': BENCH_PASSWORD})
+        self.session_ids = [s['session_id'] for s in
+                            self.call('GET', '/api/chat/sessions?limit=50')['sessions']]
+        papers = self.call('GET', '/api/papers/search?q=microgravity&limit=20')['papers']
+        self.paper_titles = [p['title'] for p in papers] or ['Microgravity bench paper']
+        for title in self.paper_titles[:3]:
+            quiz = self.call('POST', '/api/quiz/generate', {'paper_title': title, 'num_questions': 5})
+            self.quizzes.append(quiz)
+
+    def session_id(self):
+        return self.rng.choice(self.session_ids) if self.session_ids else 'bench_missing'
+
+    def word(self):
+        return self.rng.choice(WORDS)
+
+    def quiz_answers(self):
+        quiz = self.rng.choice(self.quizzes)
+        return {'quiz_id': quiz['quiz_id'],
+                'answers': {str(i): self.rng.choice('ABCD') for i in range(quiz['total_questions'])}}
+
+
+# Scenarios: name -> function(user) returning (method, path, body)
+SCENARIOS = {
+    'auth.login': lambda u: ('POST', '/api/auth/login',
+                             {'username': u.username, 'password': BENCH_PASSWORD}),
+    'auth.me': lambda u: ('GET', '/api/auth/me', None),
+    'history.list': lambda u: ('GET', '/api/history?limit=20', None),
+    'history.save': lambda u: ('POST', '/api/history',
+                               {'query': words(u.rng, 5), 'model_type': 'researcher',
+                                'response': words(u.rng, 150), 'sources': []}),
+    'history.search': lambda u: ('GET', f'/api/history/search?q={u.word()}', None),
+    'chat.sessions': lambda u: ('GET', '/api/chat/sessions?limit=20', None),
+    'chat.session': lambda u: ('GET', f'/api/chat/session/{quote(u.session_id())}', None),
+    'chat.save': lambda u: ('POST', '/api/chat/session',
+                            {'session_id': u.session_id(), 'role': 'user',
+                             'content': words(u.rng, 15)}),
+    'chat.search': lambda u: ('GET', f'/api/chat/search?q={u.word()}', None),
+    'chat.export': lambda u: ('GET', f'/api/chat/export/{quote(u.session_id())}', None),
+    'chat.export_all': lambda u: ('GET', '/api/chat/export?format=ndjson', None),
+    'papers.search': lambda u: ('GET', f'/api/papers/search?q={u.word()}+{u.word()}', None),
+    'papers.suggestions': lambda u: ('GET', f'/api/papers/suggestions?q={u.word()[:3]}', None),
+    'quiz.generate': lambda u: ('POST', '/api/quiz/generate',
+                                {'paper_title': u.rng.choice(u.paper_titles), 'num_questions': 5}),
+    'quiz.submit': lambda u: ('POST', '/api/quiz/submit', u.quiz_answers()),
+    'quiz.history': lambda u: ('GET', '/api/quiz/history', None),
+    'quiz.stats': lambda u: ('GET', '/api/quiz/stats', None),
+    'quiz.leaderboard': lambda u: ('GET', f'/api/quiz/leaderboard?paper_title='
+                                          f'{quote(u.rng.choice(u.paper_titles))}', None),
+}
+
+
+# Measurement
+
+def rss_bytes(pids):
+    """Total resident memory of the given processes, from /proc"""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+    return total
+
+
+def process_tree(pid):
+    """pid and its descendants (a prefork server's workers), from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, ()))
+    return tree
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, rss_bytes(process_tree(self.pid)))
+            self._done.wait(RSS_SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.peak
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_scenario(build, users, duration, server_pid):
+    """Run one scenario with every user as a concurrent client for duration seconds"""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def drive(user):
+        local_latencies = []
+        local_statuses = Counter()
+        while time.perf_counter() < deadline:
+            method, path, body = build(user)
+            started = time.perf_counter()
+            try:
+                status, _ = user.client.request(method, path, body)
+            except (OSError, http.client.HTTPException):
+                status = 'error'
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[status] += 1
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+
+    sampler = RSSSampler(server_pid) if server_pid and os.path.isdir('/proc') else None
+    if sampler:
+        sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=drive, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    peak_rss = sampler.stop() if sampler else 0
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Percent changes in p95 and throughput against the baseline, and whether either regressed"""
+    if not baseline:
+        return '', False
+    p95_change = (result['p95_ms'] - baseline['p95_ms']) / max(baseline['p95_ms'], 0.01)
+    rate_change = (result['throughput'] - baseline['throughput']) / max(baseline['throughput'], 0.01)
+    regressed = p95_change > tolerance or rate_change < -tolerance
+    note = f"p95 {p95_change:+.0%}, rps {rate_change:+.0%}"
+    return note + (' REGRESSED' if regressed else ''), regressed
+
+
+@cli.command()
+@click.option('--http', 'base_url', help='Benchmark a running server at this URL instead of the test client')
+@click.option('--server-pid', type=int,
+              help='Server master pid for RSS over HTTP (defaults to this process for the test client)')
+@click.option('--concurrency', default='1,8,32', show_default=True,
+              help='Comma separated numbers of concurrent clients')
+@click.option('--duration', default=5.0, show_default=True, help='Seconds per scenario and level')
+@click.option('--scenario', 'selected', multiple=True,
+              help='Scenario name or prefix (e.g. chat); repeatable, default all')
+@click.option('--baseline', 'baseline_path', default='bench_baseline.json', show_default=True)
+@click.option('--save-baseline', is_flag=True, help='Store these results as the new baseline')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Allowed fractional p95 increase or throughput drop')
+@click.option('--admission', is_flag=True, help='Keep admission control on for test client runs')
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the results as JSON')
+def run(base_url, server_pid, concurrency, duration, selected, baseline_path, save_baseline,
+        tolerance, admission, output):
+    """Measure latency, throughput and memory per scenario and concurrency level"""
+    levels = sorted({int(level) for level in concurrency.split(',')})
+    names = [name for name in SCENARIOS
+             if not selected or any(name == s or name.startswith(s + '.') for s in selected)]
+    if not names:
+        raise click.ClickException(f"No scenario matches {', '.join(selected)}")
+
+    if base_url:
+        mode = 'http'
+        make_client = lambda: HTTPClient(base_url)
+    else:
+        mode = 'client'
+        if not admission:
+            os.environ['ADMISSION_CONTROL'] = '0'
+        from app import app
+        make_client = lambda: TestClient(app)
+        server_pid = server_pid or os.getpid()
+
+    click.echo(f"Logging in {levels[-1]} bench users", err=True)
+    users = [BenchUser(make_client(), index) for index in range(levels[-1])]
+    for user in users:
+        user.setup()
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    previous = baseline.get(mode, {})
+
+    results = {}
+    regressions = 0
+    click.echo(f"{'scenario':<20}{'clients':>8}{'requests':>10}{'rps':>9}{'p50 ms':>9}"
+               f"{'p95 ms':>9}{'p99 ms':>9}{'RSS MB':>8}  statuses / vs baseline")
+    for name in names:
+        for level in levels:
+            key = f'{name}@{level}'
+            result = run_scenario(SCENARIOS[name], users[:level], duration, server_pid)
+            note, regressed = compare(result, previous.get(key), tolerance)
+            regressions += regressed
+            results[key] = result
+            statuses = ' '.join(f'{s}:{c}' for s, c in result['statuses'].items())
+            click.echo(f"{name:<20}{level:>8}{result['requests']:>10}{result['throughput']:>9}"
+                       f"{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}"
+                       f"{result['peak_rss_mb']:>8}  {statuses}  {note}")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({mode: results}, f, indent=2)
+    if save_baseline:
+        baseline[mode] = {**previous, **results}
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        click.echo(f"Saved baseline to {baseline_path}", err=True)
+    if regressions and not save_baseline:
+        click.echo(f"{regressions} result(s) regressed beyond {tolerance:.0%}", err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,372 @@
+"""Space-biology paper catalog and its in-memory search index
+
+Papers live in the `papers` table (migration 4). The PaperIndex built from
+it keeps BM25F postings (ranking.py) plus year/author/keyword filter maps,
+so a search only touches the papers that share its terms. Triggers bump
+catalog_state.version on every change and the index reloads itself when it
+sees a newer version.
+"""
+import bisect
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from operator import mul
+
+import ranking
+from db import transaction
+from ranking import tokenize
+
+logger = logging.getLogger(__name__)
+
+WORD_START_RE = re.compile(r'(?<![a-z0-9])[a-z0-9]')
+
+# Seconds between checks of catalog_state.version
+REFRESH_INTERVAL = 5.0
+
+# Autocomplete keys are truncated to this many characters to bound memory
+COMPLETION_KEY_LENGTH = 32
+
+# Hot autocomplete prefixes kept per index build
+COMPLETION_CACHE_SIZE = 2048
+
+# Relevance multiplier for recent papers: up to 1 + RECENCY_WEIGHT for this
+# year's papers, decaying with a half-life in years
+RECENCY_WEIGHT = 0.2
+RECENCY_HALF_LIFE = 5.0
+
+SAMPLE_PAPERS = [
+    {
+        "title": "Effects of Microgravity on Plant Cell Wall Synthesis",
+        "authors": ["Johnson, M.K.", "Smith, A.L.", "Brown, R.T."],
+        "year": 2023,
+        "doi": "10.1016/j.spaceres.2023.001",
+        "abstract": "This study investigates how microgravity conditions affect the synthesis of plant cell walls...",
+        "keywords": ["microgravity", "plant", "cell wall", "synthesis"]
+    },
+    {
+        "title": "DNA Repair Mechanisms in Space Radiation Environment",
+        "authors": ["Chen, L.", "Williams, P.D.", "Davis, K.M."],
+        "year": 2022,
+        "doi": "10.1038/s41526-022-0234-1",
+        "abstract": "Space radiation poses significant challenges to DNA integrity. This research examines...",
+        "keywords": ["DNA", "repair", "radiation", "space"]
+    },
+    {
+        "title": "Bone Density Changes in Long-Duration Spaceflight",
+        "authors": ["Anderson, J.R.", "Thompson, S.A.", "Miller, C.L."],
+        "year": 2023,
+        "doi": "10.1007/s00223-023-1089-4",
+        "abstract": "Long-duration spaceflight results in significant bone density loss...",
+        "keywords": ["bone", "density", "spaceflight", "astronaut"]
+    },
+    {
+        "title": "Protein Crystallization in Microgravity Conditions",
+        "authors": ["Garcia, M.E.", "Wilson, D.K.", "Taylor, B.J."],
+        "year": 2021,
+        "doi": "10.1107/S2059798321009834",
+        "abstract": "Microgravity provides unique conditions for protein crystallization...",
+        "keywords": ["protein", "crystallization", "microgravity"]
+    },
+    {
+        "title": "Cardiovascular Adaptations to Zero Gravity",
+        "authors": ["Lee, H.S.", "Martinez, R.C.", "Jackson, T.M."],
+        "year": 2022,
+        "doi": "10.1152/japplphysiol.00456.2022",
+        "abstract": "The cardiovascular system undergoes significant adaptations in zero gravity...",
+        "keywords": ["cardiovascular", "zero gravity", "adaptation"]
+    },
+    {
+        "title": "Yeast Gene Expression Under Simulated Mars Conditions",
+        "authors": ["Patel, N.K.", "Robinson, A.F.", "White, L.G."],
+        "year": 2023,
+        "doi": "10.1089/ast.2023.0045",
+        "abstract": "This study examines how yeast gene expression changes under Mars-like conditions...",
+        "keywords": ["yeast", "gene expression", "mars", "conditions"]
+    },
+    {
+        "title": "Immune System Response to Extended Space Travel",
+        "authors": ["Kumar, S.R.", "Adams, M.J.", "Clark, P.L."],
+        "year": 2022,
+        "doi": "10.3389/fimmu.2022.987654",
+        "abstract": "Extended space travel significantly impacts immune system function...",
+        "keywords": ["immune", "system", "space travel", "extended"]
+    },
+    {
+        "title": "Muscle Atrophy Prevention Strategies in Microgravity",
+        "authors": ["Brooks, K.A.", "Evans, D.R.", "Moore, J.S."],
+        "year": 2023,
+        "doi": "10.1113/JP284567",
+        "abstract": "Muscle atrophy is a major concern in microgravity environments...",
+        "keywords": ["muscle", "atrophy", "prevention", "microgravity"]
+    }
+]
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def upsert_papers(conn, papers):
+    """Insert or update papers keyed on DOI; must run inside a write transaction"""
+    conn.executemany(
+        """INSERT INTO papers (title, authors, year, doi, abstract, keywords, popularity)
+           VALUES (?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (doi) DO UPDATE SET
+               title = excluded.title, authors = excluded.authors, year = excluded.year,
+               abstract = excluded.abstract, keywords = excluded.keywords,
+               popularity = excluded.popularity""",
+        [(p['title'], json.dumps(p.get('authors', [])), p.get('year'), p['doi'],
+          p.get('abstract', ''), json.dumps(p.get('keywords', [])), p.get('popularity', 0))
+         for p in papers]
+    )
+
+
+class Autocomplete:
+    """Word-prefix completion over titles and author names
+
+    Every word start of every title and author name becomes a key in one
+    sorted array, so a prefix is a bisect range. Candidates are ranked by
+    popularity, then by shorter title, and hot prefixes are kept in an LRU.
+    """
+
+    def __init__(self, papers, cache_size=COMPLETION_CACHE_SIZE):
+        entries = []
+        self.texts = {}
+        self.rank = {}
+        for paper in papers:
+            texts = [normalize(paper['title'])] + [normalize(a) for a in paper['authors']]
+            self.texts[paper['id']] = texts
+            self.rank[paper['id']] = (-(paper.get('popularity') or 0), len(paper['title']),
+                                      paper['title'])
+            for text in texts:
+                for match in WORD_START_RE.finditer(text):
+                    start = match.start()
+                    entries.append((text[start:start + COMPLETION_KEY_LENGTH], paper['id']))
+
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.ids = [paper_id for _, paper_id in entries]
+
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, query, limit):
+        probe = query[:COMPLETION_KEY_LENGTH]
+        start = bisect.bisect_left(self.keys, probe)
+        end = bisect.bisect_left(self.keys, probe + '\uffff', start)
+        candidates = set(self.ids[start:end])
+
+        if len(query) > COMPLETION_KEY_LENGTH:
+            # Keys were truncated, so confirm the full query at a word start
+            candidates = {
+                paper_id for paper_id in candidates
+                if any(text.startswith(query) or f' {query}' in text
+                       for text in self.texts[paper_id])
+            }
+
+        return heapq.nsmallest(limit, candidates, key=self.rank.__getitem__)
+
+    def suggest(self, query, limit=5):
+        """Ids of the top `limit` papers with a title or author word starting with query"""
+        query = normalize(query)
+        key = (query, limit)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+
+        result = self._lookup(query, limit)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+
+class PaperIndex:
+    """Search index over the catalog, rebuilt as a whole from the papers table"""
+
+    def __init__(self, papers, version=0):
+        self.version = version
+        self.papers = {}
+        self.by_year = {}
+        self.by_author = {}
+        self.by_keyword = {}
+
+        for paper in papers:
+            self._add(paper)
+
+        self.ranker = ranking.BM25FIndex(
+            (paper_id, {
+                'title': paper['title'],
+                'abstract': paper['abstract'],
+                'keywords': ' '.join(paper['keywords']),
+                'authors': ' '.join(paper['authors']),
+            })
+            for paper_id, paper in self.papers.items()
+        )
+        self.completions = Autocomplete(self.papers.values())
+        self.recency = {paper_id: self.recency_boost(paper['year'])
+                        for paper_id, paper in self.papers.items()}
+
+    def _add(self, paper):
+        paper_id = paper['id']
+        self.papers[paper_id] = paper
+
+        self.by_year.setdefault(paper['year'], set()).add(paper_id)
+        for author in paper['authors']:
+            for token in tokenize(author):
+                self.by_author.setdefault(token, set()).add(paper_id)
+        for keyword in paper['keywords']:
+            self.by_keyword.setdefault(keyword.lower(), set()).add(paper_id)
+
+    def filter_ids(self, year=None, year_from=None, year_to=None, author=None, keyword=None):
+        """Papers allowed by the filters, or None when no filter is set"""
+        allowed = None
+
+        def narrow(ids):
+            return ids if allowed is None else allowed & ids
+
+        if year is not None:
+            allowed = narrow(self.by_year.get(year, set()))
+        if year_from is not None or year_to is not None:
+            low = year_from if year_from is not None else float('-inf')
+            high = year_to if year_to is not None else float('inf')
+            ids = set()
+            for paper_year, year_ids in self.by_year.items():
+                if paper_year is not None and low <= paper_year <= high:
+                    ids |= year_ids
+            allowed = narrow(ids)
+        if author:
+            for token in tokenize(author):
+                allowed = narrow(self.by_author.get(token, set()))
+        if keyword:
+            allowed = narrow(self.by_keyword.get(keyword.strip().lower(), set()))
+        return allowed
+
+    def recency_boost(self, year):
+        """Multiplier that favours recent papers, halving its bonus every RECENCY_HALF_LIFE years"""
+        if not year:
+            return 1.0
+        age = max(0, datetime.now().year - year)
+        return 1.0 + RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE)
+
+    def search(self, query, limit=10, **filters):
+        """Rank papers matching every query word, returning (total_matches, papers)"""
+        allowed = self.filter_ids(**filters)
+
+        if not tokenize(query):
+            if allowed is None:
+                return 0, []
+            top = heapq.nsmallest(limit, allowed, key=lambda i: (-(self.papers[i]['year'] or 0), i))
+            return len(allowed), [dict(self.papers[i], relevance_score=0) for i in top]
+
+        scores = self.ranker.score(query, allowed)
+
+        # map() keeps the per-candidate boost and the top-k selection in C
+        boosted = map(mul, scores.values(), map(self.recency.__getitem__, scores.keys()))
+        top = heapq.nlargest(limit, zip(boosted, scores.keys()))
+        results = [dict(self.papers[i], relevance_score=round(score, 4)) for score, i in top]
+        return len(scores), results
+
+
+def load_index(conn):
+    version = conn.execute("SELECT version FROM catalog_state WHERE id = 1").fetchone()[0]
+    papers = []
+    for row in conn.execute(
+        """SELECT id, title, authors, year, doi, abstract, keywords, popularity
+           FROM papers ORDER BY id"""
+    ):
+        papers.append({
+            'id': row[0],
+            'title': row[1],
+            'authors': json.loads(row[2] or '[]'),
+            'year': row[3],
+            'doi': row[4],
+            'abstract': row[5],
+            'keywords': json.loads(row[6] or '[]'),
+            'popularity': row[7],
+        })
+    return PaperIndex(papers, version)
+
+
+class Catalog:
+    """Holds the current PaperIndex and swaps in a fresh one when the catalog changes
+
+    Only the first index() call waits for a build. After that, a background
+    thread checks the version every refresh_interval and builds the new
+    index while searches keep using the current one.
+    """
+
+    def __init__(self, pool, refresh_interval=REFRESH_INTERVAL):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self._index = None
+        self._checked_at = 0.0
+        # Held while an index is checked or built
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def index(self):
+        if self._pid != os.getpid():
+            # A refresh thread in the parent doesn't exist in a forked worker
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+        index = self._index
+        if index is None:
+            self.refresh()
+            return self._index
+
+        if (time.monotonic() - self._checked_at >= self.refresh_interval
+                and self._lock.acquire(blocking=False)):
+            try:
+                threading.Thread(target=self._refresh_in_background, name='catalog-refresh',
+                                 daemon=True).start()
+            except BaseException:
+                self._lock.release()
+                raise
+        return index
+
+    def refresh(self):
+        """Reload the index now if the catalog changed, waiting for a running refresh"""
+        with self._lock:
+            self._refresh()
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh()
+        except Exception:
+            logger.exception('Refreshing the paper index failed')
+            self._checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        with self.pool.connection() as conn:
+            version = conn.execute(
+                "SELECT version FROM catalog_state WHERE id = 1"
+            ).fetchone()[0]
+            if self._index is None or version != self._index.version:
+                self._index = load_index(conn)
+        self._checked_at = time.monotonic()
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def import_papers(self, papers):
+        with self.pool.connection() as conn:
+            with transaction(conn):
+                upsert_papers(conn, papers)
+        self.refresh()
@@ -0,0 +1,276 @@
+"""Transparent compression of the long history text columns
+
+chat_history.content, search_history.response and search_history.sources
+are written through Codec.compress(). Values of at least
+COMPRESSION_MIN_BYTES are stored as a BLOB of raw deflate data when that is
+smaller; shorter values stay TEXT. Readers decompress only the columns they
+return, with the zunpack() SQL function, which passes TEXT through:
+
+    SELECT zunpack(content) FROM chat_history WHERE ...
+
+Deflate is given a preset dictionary trained on stored history (see
+train_dictionary()), which helps most with values of a few hundred bytes.
+Dictionaries are kept in compression_dictionaries and never change; each
+blob names the one it was made with, so training a new one doesn't touch
+existing rows. `flask --app app compress-history` trains one and recompresses
+stored history with it in batches, including rows from before migration 11.
+
+Every pooled connection gets zunpack() through install(). The full-text
+indexes (migration 11) and their triggers use it too, so writing to the
+history tables from a plain sqlite3 shell fails with "no such function".
+"""
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections import Counter
+
+from db import get_pool, load_config
+
+DEFAULT_CONFIG = {
+    'COMPRESSION_ENABLED': True,
+    'COMPRESSION_LEVEL': 6,
+    # Shorter values gain too little to be worth a decompression on every read
+    'COMPRESSION_MIN_BYTES': 128,
+}
+
+# Columns compressed at write time, by table
+COMPRESSED_COLUMNS = {
+    'chat_history': ('content',),
+    'search_history': ('response', 'sources'),
+}
+
+# Blob layout: a format byte, then for DICTIONARY the dictionary id as 4
+# big-endian bytes, then raw deflate data (no zlib header or checksum)
+RAW = 0
+DICTIONARY = 1
+
+# zlib only looks back 32 KiB, so a larger dictionary is never used
+DICTIONARY_SIZE = 32 * 1024
+MIN_TRAINING_SAMPLES = 200
+TRAINING_SAMPLES = 1000
+# Longest phrase, in words, considered for the dictionary
+MAX_PHRASE_WORDS = 4
+
+WORD_RE = re.compile(r'\S+\s*')
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """Build a preset dictionary from the phrases that recur most across samples
+
+    Phrases of up to MAX_PHRASE_WORDS words are scored by the bytes they
+    would save. The best ones go last, where deflate reaches them with the
+    shortest distances.
+    """
+    counts = Counter()
+    for text in samples:
+        words = WORD_RE.findall(text[:4000])
+        for n in range(1, MAX_PHRASE_WORDS + 1):
+            counts.update(''.join(words[i:i + n]) for i in range(len(words) - n + 1))
+
+    chosen = []
+    total = 0
+    joined = ''
+    for phrase, count in sorted(counts.items(), key=lambda item: (item[1] - 1) * len(item[0]),
+                                reverse=True):
+        if count < 2 or total + len(phrase) > size:
+            continue
+        if phrase in joined:
+            continue
+        chosen.append(phrase)
+        total += len(phrase)
+        joined = ''.join(chosen)
+        if total >= size - 8:
+            break
+    return ''.join(reversed(chosen)).encode()[-size:]
+
+
+class Codec:
+    """Compresses values for one database and decompresses with its dictionaries"""
+
+    def __init__(self, level=6, min_bytes=128, enabled=True):
+        self.level = level
+        self.min_bytes = min_bytes
+        self.enabled = enabled
+        self.dictionaries = {}  # id -> bytes
+        self.current = None     # id of the dictionary new values are compressed with
+        self._loaded = False
+        # (dictionary id, level) -> a compressor primed with the dictionary.
+        # Loading a dictionary costs far more than compressing a short value,
+        # so each value is compressed with a copy of one of these.
+        self._compressors = {}
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        """Read the stored dictionaries; the newest becomes the current one"""
+        try:
+            rows = conn.execute("SELECT id, data FROM compression_dictionaries ORDER BY seq").fetchall()
+        except sqlite3.OperationalError:
+            # Before migration 11
+            rows = []
+        with self._lock:
+            for dictionary_id, data in rows:
+                self.dictionaries[dictionary_id] = bytes(data)
+                self.current = dictionary_id
+            self._loaded = True
+
+    def add_dictionary(self, conn, data):
+        """Store a dictionary and compress new values with it; run inside a write transaction"""
+        dictionary_id = zlib.crc32(data)
+        conn.execute(
+            "INSERT OR IGNORE INTO compression_dictionaries (id, data) VALUES (?, ?)",
+            (dictionary_id, data)
+        )
+        with self._lock:
+            self.dictionaries[dictionary_id] = data
+            self.current = dictionary_id
+        return dictionary_id
+
+    def _dictionary(self, dictionary_id, conn):
+        data = self.dictionaries.get(dictionary_id)
+        if data is None:
+            # Trained since this process loaded its dictionaries; read through
+            # the connection asking, so it sees the same snapshot as the row
+            row = conn.execute("SELECT data FROM compression_dictionaries WHERE id = ?",
+                               (dictionary_id,)).fetchone() if conn is not None else None
+            if row is None:
+                raise ValueError(f'Unknown compression dictionary {dictionary_id}')
+            data = self.dictionaries[dictionary_id] = bytes(row[0])
+        return data
+
+    def compress(self, text):
+        """text as stored: a compressed BLOB, or the text itself when that is as small"""
+        if not self.enabled or not isinstance(text, str):
+            return text
+        data = text.encode()
+        if len(data) < self.min_bytes:
+            return text
+        dictionary_id = self.current
+        if dictionary_id is not None:
+            header = bytes([DICTIONARY]) + dictionary_id.to_bytes(4, 'big')
+        else:
+            header = bytes([RAW])
+        compressor = self._compressor(dictionary_id).copy()
+        blob = header + compressor.compress(data) + compressor.flush()
+        return blob if len(blob) < len(data) else text
+
+    def _compressor(self, dictionary_id):
+        key = (dictionary_id, self.level)
+        compressor = self._compressors.get(key)
+        if compressor is None:
+            if dictionary_id is not None:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15,
+                                              zdict=self.dictionaries[dictionary_id])
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            compressor = self._compressors.setdefault(key, compressor)
+        return compressor
+
+    def decompress(self, value, conn=None):
+        """The text of a stored value; anything but a BLOB is returned as it is
+
+        conn is where to look up a dictionary this process hasn't loaded yet.
+        """
+        if not isinstance(value, bytes):
+            return value
+        if value[0] == RAW:
+            return zlib.decompress(value[1:], -15).decode()
+        dictionary = self._dictionary(int.from_bytes(value[1:5], 'big'), conn)
+        decompressor = zlib.decompressobj(-15, zdict=dictionary)
+        return (decompressor.decompress(value[5:]) + decompressor.flush()).decode()
+
+    def setup_connection(self, conn):
+        if not self._loaded:
+            self.load(conn)
+        # The function holds the connection until the connection is closed
+        conn.create_function('zunpack', 1, lambda value: self.decompress(value, conn),
+                             deterministic=True)
+
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+
+
+def codec_for(path):
+    """The process-wide Codec for a database file"""
+    key = os.path.realpath(path) if path not in ('', ':memory:') else path
+    with _codecs_lock:
+        codec = _codecs.get(key)
+        if codec is None:
+            codec = _codecs[key] = Codec()
+        return codec
+
+
+def install(pool):
+    """Give every connection the pool opens the zunpack() function"""
+    codec = codec_for(pool.path)
+    if codec.setup_connection not in pool.setup:
+        pool.setup.append(codec.setup_connection)
+    return codec
+
+
+def train(conn, codec):
+    """Train a dictionary on recent history and make it current; run inside a write transaction
+
+    Returns the dictionary id, or None when there is too little history to train on.
+    """
+    samples = []
+    for table, column in (('chat_history', 'content'), ('search_history', 'response')):
+        samples += [row[0] for row in conn.execute(
+            f"SELECT zunpack({column}) FROM {table} WHERE {column} IS NOT NULL ORDER BY id DESC LIMIT ?",
+            (TRAINING_SAMPLES // 2,)
+        )]
+    if len(samples) < MIN_TRAINING_SAMPLES:
+        return None
+    return codec.add_dictionary(conn, train_dictionary(samples))
+
+
+def compress_rows(conn, codec, table, after_id=0, limit=1000):
+    """Compress, with the current dictionary, one batch of rows stored any other way
+
+    Returns the last id looked at, or None when the table is done. Values
+    that don't shrink are left as they are.
+    """
+    columns = COMPRESSED_COLUMNS[table]
+    rows = conn.execute(
+        f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+        (after_id, limit)
+    ).fetchall()
+    if not rows:
+        return None
+
+    if codec.current is None:
+        done = bytes([RAW])
+    else:
+        done = bytes([DICTIONARY]) + codec.current.to_bytes(4, 'big')
+    updates = []
+    for row in rows:
+        values = list(row[1:])
+        changed = False
+        for index, value in enumerate(values):
+            if isinstance(value, bytes) and value.startswith(done):
+                continue
+            packed = codec.compress(codec.decompress(value, conn))
+            if packed != value:
+                values[index] = packed
+                changed = True
+        if changed:
+            updates.append(values + [row[0]])
+    if updates:
+        conn.executemany(
+            f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in columns)} WHERE id = ?",
+            updates
+        )
+    return rows[-1][0]
+
+
+def init_app(app):
+    """Configure the codec for the app's database and install zunpack() on its pool"""
+    load_config(app, DEFAULT_CONFIG)
+    codec = install(get_pool(app))
+    codec.enabled = app.config['COMPRESSION_ENABLED']
+    codec.level = app.config['COMPRESSION_LEVEL']
+    codec.min_bytes = app.config['COMPRESSION_MIN_BYTES']
+    app.extensions['codec'] = codec
+    return codec
@@ -0,0 +1,207 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import g, current_app
+
+# Connection settings, overridable through app.config or environment variables
+DEFAULT_CONFIG = {
+    'DATABASE': 'users.db',
+    'DB_POOL_SIZE': 8,
+    'DB_POOL_TIMEOUT': 10.0,
+    'DB_BUSY_TIMEOUT_MS': 5000,
+    'DB_JOURNAL_MODE': 'WAL',
+    'DB_SYNCHRONOUS': 'NORMAL',
+    'DB_CACHE_SIZE_KB': 16384,
+    'DB_MMAP_SIZE': 268435456,
+    'DB_STATEMENT_CACHE': 256,
+    # Takes effect for new databases; existing ones switch with `flask --app app vacuum`
+    'DB_AUTO_VACUUM': 'INCREMENTAL',
+}
+
+
+class ConnectionPool:
+    """A bounded pool of SQLite connections configured once and reused across requests"""
+
+    def __init__(self, path, size=8, timeout=10.0, busy_timeout_ms=5000,
+                 journal_mode='WAL', synchronous='NORMAL', cache_size_kb=16384,
+                 mmap_size=268435456, statement_cache=256, auto_vacuum='INCREMENTAL'):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        self.auto_vacuum = auto_vacuum
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._pid = os.getpid()
+        self._inherited = []
+        # Connection class; metrics.py swaps in one that times statements
+        self.factory = sqlite3.Connection
+        # Functions called with each new connection, e.g. to register SQL functions
+        self.setup = []
+
+    def _check_fork(self):
+        # SQLite connections must not be used across fork(). A forked worker
+        # starts with an empty pool and keeps the parent's connections
+        # referenced but untouched, since even closing one in the child could
+        # checkpoint or remove the parent's WAL file.
+        if self._pid != os.getpid():
+            self._inherited.append(self._idle)
+            self._idle = queue.LifoQueue()
+            self._lock = threading.Lock()
+            self._created = 0
+            self._pid = os.getpid()
+
+    def _connect(self):
+        # Statements are compiled once per connection and kept in its statement
+        # cache, so a pooled connection reuses prepared statements across requests
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.statement_cache,
+            factory=self.factory,
+        )
+        conn.execute(f"PRAGMA auto_vacuum = {self.auto_vacuum}")
+        conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        for setup in self.setup:
+            setup(conn)
+        return conn
+
+    def acquire(self):
+        """Take an idle connection, opening a new one while under the pool size"""
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back anything left open"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._created -= 1
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self):
+        return {'open': self._created, 'idle': self._idle.qsize(), 'size': self.size}
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+def load_config(app, defaults):
+    """Fill app.config from defaults, letting app.config then the environment override them"""
+    for key, default in defaults.items():
+        value = app.config.get(key, os.environ.get(key, default))
+        if isinstance(default, bool) and isinstance(value, str):
+            value = value.strip().lower() in ('1', 'true', 'yes', 'on')
+        app.config[key] = type(default)(value)
+
+
+def init_app(app):
+    """Configure the connection pool for app and release connections after each request"""
+    load_config(app, DEFAULT_CONFIG)
+
+    app.extensions['db_pool'] = ConnectionPool(
+        app.config['DATABASE'],
+        size=app.config['DB_POOL_SIZE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+        journal_mode=app.config['DB_JOURNAL_MODE'],
+        synchronous=app.config['DB_SYNCHRONOUS'],
+        cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+        mmap_size=app.config['DB_MMAP_SIZE'],
+        statement_cache=app.config['DB_STATEMENT_CACHE'],
+        auto_vacuum=app.config['DB_AUTO_VACUUM'],
+    )
+    app.teardown_appcontext(close_db)
+
+
+def get_pool(app=None):
+    return (app or current_app).extensions['db_pool']
+
+
+def get_db():
+    """Get the pooled connection bound to the current request"""
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def close_db(exception=None):
+    """Return the request's connection to the pool, on every exit path"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+@contextmanager
+def transaction(conn=None):
+    """Run a write transaction that takes the writer lock up front
+
+    BEGIN IMMEDIATE waits on busy_timeout for the lock instead of failing with
+    "database is locked" when a deferred read transaction tries to upgrade.
+    """
+    conn = conn or get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
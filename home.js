@@ -255,6 +255,14 @@ function showLoadingMessage() {
   chatHistoryEl.scrollTop = chatHistoryEl.scrollHeight;
 }
 
+// Show the answer as it streams in, in place of the "thinking" indicator
+function updateLoadingMessage(partialAnswer) {
+  const label = document.querySelector('#chat-loading > span');
+  if (!label) return;
+  label.textContent = partialAnswer;
+  chatHistoryEl.scrollTop = chatHistoryEl.scrollHeight;
+}
+
 function hideLoadingMessage() {
   const loadingEl = el('chat-loading');
   if (loadingEl) {
@@ -320,22 +328,93 @@ function loadChatHistoryFromStorage() {
 }
 
 /* AI Communication */
-async function sendToAI(message, model = 'researcher') {
+// Completions go through the Flask proxy, which streams the answer back as
+// server-sent events and saves the exchange for logged-in users. The
+// webhooks in API_CONFIG are only called directly when there is no proxy.
+function proxyUnavailable(reason) {
+  const err = new Error(reason);
+  err.proxyUnavailable = true;
+  return err;
+}
+
+async function streamFromProxy(message, model, onToken) {
+  let res;
+  try {
+    res = await fetch('/api/chat/complete', {
+      method: 'POST',
+      credentials: 'include',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ message, model_type: model, session_id: getSessionId() })
+    });
+  } catch (err) {
+    throw proxyUnavailable(String(err));
+  }
+  if ([404, 405, 501].includes(res.status) || !res.body) {
+    throw proxyUnavailable(`Proxy returned ${res.status}`);
+  }
+  if (!res.ok) {
+    const data = await res.json().catch(() => ({}));
+    throw new Error(data.error || `Proxy returned ${res.status}`);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let answer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = 'message';
+      const data = [];
+      block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data.push(line.slice(5).trim());
+      });
+      if (!data.length) continue;
+
+      const payload = JSON.parse(data.join('\n'));
+      if (event === 'error') throw new Error(payload.error);
+      if (event === 'message' && payload.token) {
+        answer += payload.token;
+        if (onToken) onToken(payload.token, answer);
+      }
+    }
+  }
+  return answer;
+}
+
+async function sendToAI(message, model = 'researcher', onToken = null) {
+  // Add filter context if filters are active
+  let enhancedMessage = message;
+  if (Object.keys(currentFilters).length > 0) {
+    const filterContext = Object.entries(currentFilters)
+      .filter(([_, v]) => v)
+      .map(([k, v]) => `${k}: ${v}`)
+      .join(', ');
+    enhancedMessage = `${message}\n[Filter context: ${filterContext}]`;
+  }
+
+  try {
+    return await streamFromProxy(enhancedMessage, model, onToken);
+  } catch (err) {
+    if (!err.proxyUnavailable) {
+      console.error('AI Error:', err);
+      return "Connection error. Please check your network and try again. 🛰️";
+    }
+  }
+
   try {
     const cfg = API_CONFIG[model] || API_CONFIG.default;
     const headers = { 'Content-Type': 'application/json' };
     if (cfg.apiKey) headers['Authorization'] = `Bearer ${cfg.apiKey}`;
 
-    // Add filter context if filters are active
-    let enhancedMessage = message;
-    if (Object.keys(currentFilters).length > 0) {
-      const filterContext = Object.entries(currentFilters)
-        .filter(([_, v]) => v)
-        .map(([k, v]) => `${k}: ${v}`)
-        .join(', ');
-      enhancedMessage = `${message}\n[Filter context: ${filterContext}]`;
-    }
-
     const res = await fetch(cfg.url, {
       method: 'POST',
       headers,
@@ -469,7 +548,7 @@ async function handleSearch() {
 
   try {
     const prompt = buildPrompt(query, currentModel);
-    const aiResponse = await sendToAI(prompt, currentModel);
+    const aiResponse = await sendToAI(prompt, currentModel, (_, partial) => updateLoadingMessage(partial));
     
     hideLoadingMessage();
     
@@ -0,0 +1,461 @@
+"""Pooled keep-alive client for the upstream chat models
+
+Each model in UPSTREAMS (the webhooks home.js used to call directly) gets
+its own small pool of persistent http.client connections, so a completion
+reuses an open TCP/TLS connection instead of handshaking per request.
+Completions are read incrementally and yielded as text chunks whether the
+upstream streams SSE, NDJSON or plain text, or answers with one JSON body.
+
+Finished answers are cached per model, normalized prompt and filter context
+(ResponseCache), and identical requests that arrive while one is in flight
+follow that request's stream instead of calling the upstream again.
+"""
+import codecs
+import http.client
+import json
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from db import load_config
+
+# Same webhooks as API_CONFIG in home.js; override with LLM_UPSTREAMS
+UPSTREAMS = {
+    'researcher': 'https://n8n.navigo.dpdns.org/webhook/59e89dd8-395c-4763-8112-00797eb4bd7e/chat',
+    'student': 'https://n8n.navigo.dpdns.org/webhook/8e243197-5fab-4c6d-ab9e-5fbf39c81e3e/chat',
+    'manager': 'https://n8n.navigo.dpdns.org/webhook/d3590fee-4817-41d5-970c-2e3d31e8f567/chat',
+}
+DEFAULT_MODEL = 'researcher'
+
+DEFAULT_CONFIG = {
+    # JSON object of model -> URL or {"url": ..., "api_key": ...}; empty uses UPSTREAMS
+    'LLM_UPSTREAMS': '',
+    'LLM_POOL_SIZE': 8,
+    'LLM_CONNECT_TIMEOUT': 10.0,
+    'LLM_READ_TIMEOUT': 120.0,
+    'LLM_CACHE_TTL': 600,
+    'LLM_CACHE_MAX_BYTES': 16 * 1024 * 1024,
+}
+
+READ_SIZE = 8192
+
+# Fields the webhooks put the answer text in, checked in order (as in home.js)
+TEXT_FIELDS = ('output', 'message', 'text', 'content', 'delta', 'token')
+
+# The filter suffix sendToAI appends to the prompt
+FILTER_CONTEXT_RE = re.compile(r'\n\[Filter context: ([^\]]*)\]\s*$')
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class HTTPConnectionPool:
+    """Persistent connections to one upstream host, reused LIFO"""
+
+    def __init__(self, url, size=8, connect_timeout=10.0, read_timeout=120.0, api_key=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported upstream URL: {url}')
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.api_key = api_key
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def post(self, body):
+        """POST a JSON body, returning (connection, response); call finish() when done reading"""
+        if not self._slots.acquire(timeout=self.connect_timeout):
+            raise UpstreamError('Too many concurrent requests to upstream')
+
+        headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream, application/json'}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        payload = json.dumps(body).encode()
+
+        try:
+            while True:
+                conn, reused = self._checkout()
+                try:
+                    conn.request('POST', self.path, body=payload, headers=headers)
+                    return conn, conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    # An idle keep-alive connection the server already closed; retry on a fresh one
+                    if not reused:
+                        raise
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def finish(self, conn, response, reusable=True):
+        """Return the connection to the pool if the response was fully read and keep-alive"""
+        try:
+            # read1() leaves a response whose Content-Length is used up open;
+            # closing it releases only the response, not the socket
+            if reusable and response.length == 0:
+                response.close()
+            if reusable and response.isclosed() and not response.will_close:
+                self._idle.put(conn)
+            else:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def text_from_json(data):
+    if isinstance(data, str):
+        return data
+    if isinstance(data, dict):
+        for field in TEXT_FIELDS:
+            if isinstance(data.get(field), str):
+                return data[field]
+        return ''
+    if isinstance(data, list) and data:
+        return text_from_json(data[0])
+    return ''
+
+
+def parse_event_data(data):
+    """Text carried by one SSE data field or NDJSON line"""
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return data
+    # n8n streaming sends {"type": "begin" | "item" | "end", "content": ...}
+    if isinstance(event, dict) and event.get('type') in ('begin', 'end', 'error'):
+        if event['type'] == 'error':
+            raise UpstreamError(text_from_json(event) or 'Upstream error')
+        return ''
+    return text_from_json(event)
+
+
+def iter_lines(response):
+    buffer = b''
+    while True:
+        chunk = response.read1(READ_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line.rstrip(b'\r').decode('utf-8', 'replace')
+    if buffer:
+        yield buffer.decode('utf-8', 'replace')
+
+
+def iter_text(response):
+    """Yield text chunks from an upstream response as they arrive"""
+    content_type = response.getheader('Content-Type', '').split(';')[0].strip().lower()
+
+    if content_type == 'text/event-stream':
+        data = []
+        for line in iter_lines(response):
+            if line.startswith('data:'):
+                data.append(line[5:].lstrip(' '))
+            elif not line and data:
+                if data != ['[DONE]']:
+                    text = parse_event_data('\n'.join(data))
+                    if text:
+                        yield text
+                data = []
+        if data and data != ['[DONE]']:
+            text = parse_event_data('\n'.join(data))
+            if text:
+                yield text
+
+    elif content_type in ('application/x-ndjson', 'application/jsonl'):
+        for line in iter_lines(response):
+            if line.strip():
+                text = parse_event_data(line)
+                if text:
+                    yield text
+
+    elif content_type == 'application/json':
+        body = response.read().decode('utf-8', 'replace')
+        try:
+            text = text_from_json(json.loads(body))
+        except ValueError:
+            # n8n answers a streaming workflow with NDJSON under a JSON content type
+            text = ''.join(parse_event_data(line) for line in body.splitlines() if line.strip())
+        if text:
+            yield text
+
+    else:
+        # Incremental decoding holds back a multi-byte character split across reads
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            chunk = response.read1(READ_SIZE)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                yield text
+            if not chunk:
+                break
+
+
+def cache_key(model, message):
+    """(model, normalized prompt, filter context) with the filter pairs in a stable order"""
+    filters = ''
+    match = FILTER_CONTEXT_RE.search(message)
+    if match:
+        message = message[:match.start()]
+        filters = ', '.join(sorted(pair.strip() for pair in match.group(1).split(',') if pair.strip()))
+    return model, ' '.join(message.lower().split()), filters
+
+
+class Flight:
+    """An upstream call in progress whose chunks other identical requests can follow"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def publish(self, text):
+        with self._cond:
+            self.chunks.append(text)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def follow(self, timeout):
+        """Yield every chunk published so far and then the rest as it arrives"""
+        position = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: len(self.chunks) > position or self.done, timeout):
+                    raise UpstreamError('Timed out waiting for a shared upstream response')
+                chunks = self.chunks[position:]
+                done, error = self.done, self.error
+            position += len(chunks)
+            yield from chunks
+            if done and position == len(self.chunks):
+                if error is not None:
+                    raise UpstreamError(str(error))
+                return
+
+
+class ResponseCache:
+    """Byte-bounded LRU of finished answers with a TTL, plus the flights in progress"""
+
+    def __init__(self, ttl=600, max_bytes=16 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (answer, expires_at, size in bytes)
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Return ('hit', answer), ('shared', flight) or ('miss', flight) for key
+
+        On a miss the caller leads the new flight and must call complete()
+        or abandon() for it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return 'hit', entry[0]
+                del self._entries[key]
+                self._bytes -= entry[2]
+
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.shared += 1
+                return 'shared', flight
+
+            self.misses += 1
+            flight = self._inflight[key] = Flight()
+            return 'miss', flight
+
+    def complete(self, key, flight):
+        answer = ''.join(flight.chunks)
+        size = len(answer.encode())
+        with self._lock:
+            self._inflight.pop(key, None)
+            if answer and size <= self.max_bytes and self.ttl > 0:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._bytes -= old[2]
+                self._entries[key] = (answer, time.monotonic() + self.ttl, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                    self._bytes -= evicted_size
+        flight.finish()
+
+    def abandon(self, key, flight, error):
+        with self._lock:
+            self._inflight.pop(key, None)
+        flight.finish(error)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits,
+                    'shared': self.shared, 'misses': self.misses, 'in_flight': len(self._inflight)}
+
+
+class Lead:
+    """The chunks of an upstream call, published to its Flight as they are read
+
+    The flight is resolved however the lead ends: finished, failed, closed
+    by the response, or dropped without ever being iterated. Followers get
+    an error, not a truncated answer, when it didn't finish.
+    """
+
+    def __init__(self, cache, key, flight, chunks):
+        self.cache = cache
+        self.key = key
+        self.flight = flight
+        self.chunks = chunks
+        self._resolved = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            text = next(self.chunks)
+        except StopIteration:
+            self._resolve()
+            raise
+        except BaseException as e:
+            self._resolve(e if isinstance(e, UpstreamError)
+                          else UpstreamError('Upstream request was abandoned'))
+            raise
+        self.flight.publish(text)
+        return text
+
+    def close(self):
+        self._resolve(UpstreamError('Upstream request was abandoned'))
+        self.chunks.close()
+
+    def __del__(self):
+        self.close()
+
+    def _resolve(self, error=None):
+        if self._resolved:
+            return
+        self._resolved = True
+        if error is None:
+            self.cache.complete(self.key, self.flight)
+        else:
+            self.cache.abandon(self.key, self.flight, error)
+
+
+class LLMClient:
+    """One keep-alive connection pool per upstream model"""
+
+    def __init__(self, upstreams, pool_size=8, connect_timeout=10.0, read_timeout=120.0,
+                 cache=None):
+        self.read_timeout = read_timeout
+        self.cache = cache
+        self.pools = {}
+        for model, target in upstreams.items():
+            if isinstance(target, str):
+                target = {'url': target}
+            self.pools[model] = HTTPConnectionPool(
+                target['url'], size=pool_size, connect_timeout=connect_timeout,
+                read_timeout=read_timeout, api_key=target.get('api_key')
+            )
+
+    def models(self):
+        return sorted(self.pools)
+
+    def stream(self, model, message, session_id):
+        """Yield the model's answer to message as text chunks, raising UpstreamError on failure"""
+        pool = self.pools[model]
+        body = {'action': 'sendMessage', 'chatInput': message, 'sessionId': session_id,
+                'model': model}
+        try:
+            conn, response = pool.post(body)
+        except (OSError, http.client.HTTPException) as e:
+            raise UpstreamError(f'Upstream unavailable: {e}') from e
+
+        completed = False
+        try:
+            if response.status >= 400:
+                detail = response.read(512).decode('utf-8', 'replace')
+                raise UpstreamError(f'Upstream returned {response.status}: {detail}')
+            yield from iter_text(response)
+            completed = True
+        except (OSError, http.client.HTTPException) as e:
+            raise UpstreamError(f'Upstream connection failed: {e}') from e
+        finally:
+            pool.finish(conn, response, reusable=completed)
+
+    def complete(self, model, message, session_id, use_cache=True):
+        """Return (source, chunks) where source is 'cache', 'shared' or 'upstream'
+
+        Identical requests share one upstream call and, once it finishes, its
+        cached answer. use_cache=False always makes a fresh upstream call.
+        """
+        if self.cache is None or not use_cache:
+            return 'upstream', self.stream(model, message, session_id)
+
+        key = cache_key(model, message)
+        state, value = self.cache.lookup(key)
+        if state == 'hit':
+            return 'cache', iter([value])
+        if state == 'shared':
+            return 'shared', value.follow(self.read_timeout)
+        return 'upstream', Lead(self.cache, key, value, self.stream(model, message, session_id))
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close_all()
+
+
+def init_app(app):
+    load_config(app, DEFAULT_CONFIG)
+    upstreams = json.loads(app.config['LLM_UPSTREAMS']) if app.config['LLM_UPSTREAMS'] else UPSTREAMS
+    client = LLMClient(
+        upstreams,
+        pool_size=app.config['LLM_POOL_SIZE'],
+        connect_timeout=app.config['LLM_CONNECT_TIMEOUT'],
+        read_timeout=app.config['LLM_READ_TIMEOUT'],
+        cache=ResponseCache(ttl=app.config['LLM_CACHE_TTL'],
+                            max_bytes=app.config['LLM_CACHE_MAX_BYTES']),
+    )
+    app.extensions['llm'] = client
+    return client
@@ -0,0 +1,487 @@
+"""Prometheus metrics for requests, SQL statements and the in-process caches
+
+Request hooks record a latency histogram, status counts and an in-flight
+gauge per endpoint. Pooled connections are made with a cursor class that
+times every statement and the fetch calls that step it, and counts the rows
+it returns or changes. BEGIN IMMEDIATE time is the wait for the writer
+lock. Pool, cache, admission and write-behind figures are only read when
+/metrics is scraped. Recording is a few dict updates under a lock, so it
+costs next to nothing when nobody scrapes. Other modules can follow every
+statement with add_statement_listener().
+
+Each worker process has its own numbers. With METRICS_DIR set, workers also
+write a snapshot there every METRICS_SNAPSHOT_INTERVAL seconds, and
+/metrics adds up the snapshots of the other workers (gauges only from
+workers that are still running).
+"""
+import bisect
+import functools
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, request
+
+from db import get_pool, load_config
+
+DEFAULT_CONFIG = {
+    'METRICS_ENABLED': True,
+    'METRICS_SQL': True,
+    # Shared directory for per-worker snapshots; empty serves this process only
+    'METRICS_DIR': '',
+    'METRICS_SNAPSHOT_INTERVAL': 5.0,
+    # Bearer token for /metrics and /api/admission/stats; empty allows only
+    # direct requests from this machine
+    'METRICS_TOKEN': '',
+}
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Distinct statements tracked; any more are counted under 'other'
+MAX_STATEMENTS = 500
+STATEMENT_LABEL_LENGTH = 200
+
+# name -> (type, help)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Time until the response was sent, by endpoint'),
+    'http_requests_in_flight': ('gauge', 'Requests being handled, by endpoint'),
+    'db_statements_total': ('counter', 'SQL statements executed, by statement'),
+    'db_statement_seconds_total': ('counter', 'Time spent executing and fetching, by statement'),
+    'db_statement_rows_total': ('counter', 'Rows returned or changed, by statement'),
+    'db_statement_duration_seconds': ('histogram', 'Time to execute a statement up to its first row'),
+    'db_lock_wait_seconds': ('histogram', 'Time BEGIN IMMEDIATE waited for the writer lock'),
+    'db_busy_errors_total': ('counter', 'Statements that gave up waiting on a locked database'),
+    'db_pool_connections': ('gauge', 'Pooled SQLite connections by state'),
+    'cache_hits_total': ('counter', 'Cache hits by cache'),
+    'cache_misses_total': ('counter', 'Cache misses by cache'),
+    'cache_entries': ('gauge', 'Entries held by cache'),
+    'cache_bytes': ('gauge', 'Bytes held by cache'),
+    'admission_in_flight': ('gauge', 'Requests holding an admission slot, by class'),
+    'admission_waiting': ('gauge', 'Requests waiting for an admission slot, by class'),
+    'admission_admitted_total': ('counter', 'Requests admitted, by class'),
+    'admission_rate_limited_total': ('counter', 'Requests rejected with 429, by class'),
+    'admission_shed_total': ('counter', 'Requests rejected with 503, by class'),
+    'write_behind_pending': ('gauge', 'Rows queued for the write-behind writer'),
+    'write_behind_failed_total': ('counter', 'Queued writes that failed and were dead-lettered'),
+    'retention_rows_purged_total': ('counter', 'History rows deleted by the purger, by table'),
+    'retention_sessions_archived_total': ('counter', 'Expired chat sessions written to ARCHIVE_DIR'),
+}
+
+
+class Registry:
+    """Counters, gauges and histograms keyed on (name, label pairs)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+        self.buckets = {}
+        # Statement label -> [executions, seconds, rows], kept apart from the
+        # counters since every statement updates them
+        self.statements = {}
+        self.statement_durations = [0] * (len(SQL_BUCKETS) + 2)
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, labels=(), value=1):
+        with self._lock:
+            key = (name, labels)
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            key = (name, labels)
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(buckets) + 2)
+                self.buckets[name] = buckets
+            counts[index] += 1
+            counts[-1] += value
+
+    def record_statement(self, statement, seconds, rows, executions=1, timed=False):
+        """Add to a statement's totals; timed also puts seconds in the duration histogram"""
+        index = bisect.bisect_left(SQL_BUCKETS, seconds) if timed else None
+        with self._lock:
+            totals = self.statements.get(statement)
+            if totals is None:
+                totals = self.statements[statement] = [0, 0.0, 0]
+            totals[0] += executions
+            totals[1] += seconds
+            totals[2] += rows
+            if index is not None:
+                self.statement_durations[index] += 1
+                self.statement_durations[-1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[n, list(l), v] for (n, l), v in self.counters.items()]
+            for statement, (executions, seconds, rows) in self.statements.items():
+                labels = [['statement', statement]]
+                counters += [['db_statements_total', labels, executions],
+                             ['db_statement_seconds_total', labels, seconds],
+                             ['db_statement_rows_total', labels, rows]]
+            histograms = [[n, list(l), list(c)] for (n, l), c in self.histograms.items()]
+            if any(self.statement_durations):
+                histograms.append(['db_statement_duration_seconds', [],
+                                   list(self.statement_durations)])
+            buckets = {n: list(b) for n, b in self.buckets.items()}
+            buckets['db_statement_duration_seconds'] = list(SQL_BUCKETS)
+            return {'counters': counters,
+                    'gauges': [[n, list(l), v] for (n, l), v in self.gauges.items()],
+                    'histograms': histograms, 'buckets': buckets}
+
+
+class MeteredCursor(sqlite3.Cursor):
+    """Cursor that reports each statement's time and rows to the connection's registry"""
+
+    statement = None
+    _iterated = 0
+
+    def _timed(self, method, sql, parameters, executions):
+        registry = self.connection.registry
+        self.statement = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if registry is not None and ('locked' in str(e) or 'busy' in str(e)):
+                registry.inc('db_busy_errors_total')
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if registry is not None:
+                registry.record_statement(self.statement, elapsed, max(self.rowcount, 0),
+                                          executions or 1, timed=executions is None)
+                if self.statement.startswith('BEGIN'):
+                    registry.observe('db_lock_wait_seconds', (), elapsed, SQL_BUCKETS)
+            for listener in self.connection.listeners:
+                listener(self.connection, sql, parameters, elapsed)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters, None)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        return self._timed(super().executemany, sql, seq_of_parameters, len(seq_of_parameters))
+
+    def _fetched(self, started, rows):
+        if self.statement is not None and self.connection.registry is not None:
+            self.connection.registry.record_statement(
+                self.statement, time.perf_counter() - started, rows, executions=0)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        # Iterating only counts rows (reported when the cursor is exhausted);
+        # timing each row would cost more than fetching it
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._iterated:
+                self._fetched(time.perf_counter(), self._iterated)
+                self._iterated = 0
+            raise
+        self._iterated += 1
+        return row
+
+
+class MeteredConnection(sqlite3.Connection):
+    # None when only listeners are wanted (METRICS_SQL off)
+    registry = None
+    # Functions called as listener(conn, sql, parameters, seconds) after each execute
+    listeners = ()
+
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    # The C implementations don't go through cursor(), so these are redirected
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+_statement_labels = {}
+
+
+def statement_label(sql):
+    """The statement with whitespace collapsed, as a bounded set of label values"""
+    label = _statement_labels.get(sql)
+    if label is None:
+        if len(_statement_labels) >= MAX_STATEMENTS:
+            return 'other'
+        label = _statement_labels[sql] = ' '.join(sql.split())[:STATEMENT_LABEL_LENGTH]
+    return label
+
+
+def collect(app):
+    """Point-in-time figures from the pool, caches, admission control and write-behind"""
+    samples = []  # (name, labels, value)
+
+    pool_stats = get_pool(app).stats()
+    samples += [('db_pool_connections', (('state', 'open'),), pool_stats['open']),
+                ('db_pool_connections', (('state', 'idle'),), pool_stats['idle'])]
+
+    caches = {'user': app.extensions.get('user_cache'),
+              'summary': app.extensions.get('summary_cache')}
+    llm_client = app.extensions.get('llm')
+    if llm_client is not None:
+        caches['llm'] = llm_client.cache
+    for name, cache in caches.items():
+        if cache is None:
+            continue
+        stats = cache.stats()
+        labels = (('cache', name),)
+        samples += [('cache_hits_total', labels, stats['hits'] + stats.get('db_hits', 0)),
+                    ('cache_misses_total', labels, stats['misses']),
+                    ('cache_entries', labels, stats['entries'])]
+        if 'bytes' in stats:
+            samples.append(('cache_bytes', labels, stats['bytes']))
+
+    controller = app.extensions.get('admission')
+    if controller is not None:
+        for name, stats in controller.stats().items():
+            labels = (('class', name),)
+            samples += [('admission_in_flight', labels, stats['in_flight']),
+                        ('admission_waiting', labels, stats['waiting']),
+                        ('admission_admitted_total', labels, stats['admitted']),
+                        ('admission_rate_limited_total', labels, stats['rate_limited']),
+                        ('admission_shed_total', labels, stats['shed'])]
+
+    write_queue = app.extensions.get('write_behind')
+    if write_queue is not None:
+        stats = write_queue.stats()
+        samples += [('write_behind_pending', (), stats['pending']),
+                    ('write_behind_failed_total', (), stats['failed'])]
+
+    purger = app.extensions.get('purger')
+    if purger is not None:
+        stats = purger.stats()
+        samples += [('retention_rows_purged_total', (('table', table),), count)
+                    for table, count in stats['purged'].items()]
+        samples.append(('retention_sessions_archived_total', (), stats['archived']))
+    return samples
+
+
+class Metrics:
+    def __init__(self, app, registry, directory='', snapshot_interval=5.0):
+        self.app = app
+        self.registry = registry
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self._writer_pid = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """The registry plus the collected figures, in the form written to METRICS_DIR"""
+        data = self.registry.snapshot()
+        for name, labels, value in collect(self.app):
+            kind = 'counters' if METRICS[name][0] == 'counter' else 'gauges'
+            data[kind].append([name, list(labels), value])
+        return data
+
+    def ensure_writer(self):
+        # Started lazily, and again after a fork, like the write-behind writer
+        if not self.directory or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            threading.Thread(target=self._write_snapshots, name='metrics-snapshot',
+                             daemon=True).start()
+
+    def _write_snapshots(self):
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        while True:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+            time.sleep(self.snapshot_interval)
+
+    def snapshots(self):
+        """This process's snapshot, then (snapshot, alive) for every other worker's file"""
+        yield self.snapshot(), True
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            pid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            yield data, pid_alive(int(pid))
+
+    def render(self):
+        """All snapshots added up, in the Prometheus text exposition format"""
+        values = {}
+        histograms = {}
+        buckets = {}
+        for data, alive in self.snapshots():
+            kinds = ('counters', 'gauges') if alive else ('counters',)
+            for kind in kinds:
+                for name, labels, value in data[kind]:
+                    key = (name, tuple(map(tuple, labels)))
+                    values[key] = values.get(key, 0) + value
+            for name, labels, counts in data['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+            buckets.update(data['buckets'])
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            series = sorted((k, v) for k, v in values.items() if k[0] == name)
+            hists = sorted((k, v) for k, v in histograms.items() if k[0] == name)
+            if not series and not hists:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (_, labels), value in series:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+            for (_, labels), counts in hists:
+                cumulative = 0
+                for bound, count in zip(list(buckets[name]) + ['+Inf'], counts[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(counts[-1])}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def scrape_allowed(app):
+    """Whether the current request may read the operational endpoints"""
+    token = app.config.get('METRICS_TOKEN')
+    if token:
+        given = request.headers.get('Authorization', '')
+        return hmac.compare_digest(given.encode(), f'Bearer {token}'.encode())
+    # A local reverse proxy relays outside clients from 127.0.0.1 too
+    return (request.remote_addr in ('127.0.0.1', '::1')
+            and 'X-Forwarded-For' not in request.headers)
+
+
+def add_statement_listener(app, listener):
+    """Call listener(conn, sql, parameters, seconds) after every statement on app's pool"""
+    pool = get_pool(app)
+    if not issubclass(pool.factory, MeteredConnection):
+        pool.factory = type('MeteredConnection', (MeteredConnection,), {})
+    pool.factory.listeners += (listener,)
+
+
+def clear_snapshots(app):
+    """Remove snapshots left in METRICS_DIR by a previous server run"""
+    directory = app.config['METRICS_DIR']
+    if directory and os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith(('.json', '.json.tmp')):
+                os.remove(os.path.join(directory, filename))
+
+
+def init_app(app):
+    """Install the request hooks and metered connections, returning the Metrics (None when disabled)
+
+    Call before admission.init_app so requests it rejects are counted too.
+    """
+    load_config(app, DEFAULT_CONFIG)
+    if not app.config['METRICS_ENABLED']:
+        return None
+
+    registry = Registry()
+    # A forked worker counts from zero rather than repeating what the
+    # preloading parent recorded
+    os.register_at_fork(after_in_child=registry.__init__)
+    metrics = Metrics(app, registry, directory=app.config['METRICS_DIR'],
+                      snapshot_interval=app.config['METRICS_SNAPSHOT_INTERVAL'])
+    if app.config['METRICS_SQL']:
+        get_pool(app).factory = type('MeteredConnection', (MeteredConnection,),
+                                     {'registry': registry})
+
+    def finish(labels, method, status, started):
+        registry.add_gauge('http_requests_in_flight', labels, -1)
+        registry.observe('http_request_duration_seconds', labels,
+                         time.perf_counter() - started, REQUEST_BUCKETS)
+        registry.inc('http_requests_total', labels + (('method', method), ('status', status)))
+
+    @app.before_request
+    def start_request_timer():
+        metrics.ensure_writer()
+        labels = (('endpoint', request.endpoint or 'unmatched'),)
+        registry.add_gauge('http_requests_in_flight', labels)
+        g.metrics_request = (labels, time.perf_counter())
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_request', None)
+        if started is not None:
+            # Counted once the body is fully sent, so streamed responses include streaming
+            response.call_on_close(functools.partial(
+                finish, started[0], request.method, str(response.status_code), started[1]))
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exception=None):
+        # Only still set when after_request didn't run
+        started = g.pop('metrics_request', None)
+        if started is not None:
+            finish(started[0], request.method, '500', started[1])
+
+    app.extensions['metrics'] = metrics
+    return metrics
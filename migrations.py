@@ -0,0 +1,548 @@
+"""Versioned schema migrations for users.db
+
+Migrations are applied once per deploy, not on import or per request:
+
+    flask --app app migrate
+    python migrations.py --database users.db
+"""
+import argparse
+import json
+
+import catalog
+import compression
+from db import ConnectionPool, transaction
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a forward migration; versions must be applied in increasing order"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+@migration(1, 'Initial schema')
+def initial_schema(conn):
+    cursor = conn.cursor()
+
+    # Users table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # Search history table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS search_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        query TEXT NOT NULL,
+        model_type TEXT NOT NULL,
+        response TEXT,
+        sources TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+    """)
+
+    # Chat history table for persistent conversation storage
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        model_type TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+    """)
+
+    # Chat sessions table to track conversation sessions
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS chat_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        session_id TEXT UNIQUE NOT NULL,
+        session_name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+    """)
+
+    # Quiz results table (previously created lazily by submit_quiz)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS quiz_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        paper_title TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        total_questions INTEGER NOT NULL,
+        answers TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+    )
+    """)
+
+
+@migration(2, 'Indexes for history, chat and quiz access paths')
+def history_indexes(conn):
+    # get_history: WHERE user_id = ? ORDER BY timestamp DESC
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_search_history_user_ts
+                    ON search_history (user_id, timestamp)""")
+    # get_chat_session / export_chat_session: WHERE session_id = ? ORDER BY timestamp
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_chat_history_session_ts
+                    ON chat_history (session_id, timestamp)""")
+    # The history reads above return response, sources and content; copying
+    # those into the index would store the largest columns twice, so these
+    # two visit the table for the rows of the page and aren't covering
+    # clear_all_chat_history: WHERE user_id = ?
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_chat_history_user
+                    ON chat_history (user_id)""")
+    # get_chat_sessions: WHERE user_id = ? ORDER BY last_activity DESC, id DESC.
+    # Covering: it carries every column the list returns, and id follows
+    # last_activity to keep the page order (see pagination.fetch_page).
+    # Migrations that add listed columns rebuild it.
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_activity
+                    ON chat_sessions (user_id, last_activity, id, session_id, session_name,
+                                      created_at)""")
+    # get_quiz_history: WHERE user_id = ? ORDER BY timestamp DESC, covering
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_quiz_results_user_ts
+                    ON quiz_results (user_id, timestamp, paper_title, score, total_questions)""")
+
+
+@migration(3, 'Denormalized message counters and previews on chat_sessions')
+def chat_session_counters(conn):
+    for column in ("message_count INTEGER NOT NULL DEFAULT 0",
+                   "question_count INTEGER NOT NULL DEFAULT 0",
+                   "first_message_preview TEXT",
+                   "last_message_preview TEXT"):
+        conn.execute(f"ALTER TABLE chat_sessions ADD COLUMN {column}")
+
+    # get_chat_sessions lists these too; keep its index covering (migration 2)
+    conn.execute("DROP INDEX IF EXISTS idx_chat_sessions_user_activity")
+    conn.execute("""CREATE INDEX idx_chat_sessions_user_activity
+                    ON chat_sessions (user_id, last_activity, id, session_id, session_name,
+                                      created_at, message_count, question_count,
+                                      first_message_preview, last_message_preview)""")
+
+    # Backfill from existing messages; save_chat_message maintains them from here on
+    conn.execute("""
+    UPDATE chat_sessions SET
+        message_count = (SELECT COUNT(*) FROM chat_history h
+                         WHERE h.session_id = chat_sessions.session_id),
+        question_count = (SELECT COUNT(*) FROM chat_history h
+                          WHERE h.session_id = chat_sessions.session_id AND h.role = 'user'),
+        first_message_preview = (SELECT substr(content, 1, 120) FROM chat_history h
+                                 WHERE h.session_id = chat_sessions.session_id
+                                 ORDER BY timestamp ASC, id ASC LIMIT 1),
+        last_message_preview = (SELECT substr(content, 1, 120) FROM chat_history h
+                                WHERE h.session_id = chat_sessions.session_id
+                                ORDER BY timestamp DESC, id DESC LIMIT 1)
+    """)
+
+
+@migration(4, 'Paper catalog')
+def paper_catalog(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS papers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        authors TEXT NOT NULL DEFAULT '[]',
+        year INTEGER,
+        doi TEXT UNIQUE NOT NULL,
+        abstract TEXT,
+        keywords TEXT NOT NULL DEFAULT '[]',
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_papers_year ON papers (year)")
+
+    # Single-row change counter the in-memory index polls to know when to reload
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_state (id, version) VALUES (1, 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS papers_{event.lower()}_version AFTER {event} ON papers
+        BEGIN
+            UPDATE catalog_state SET version = version + 1 WHERE id = 1;
+        END
+        """)
+
+    # Seed with the sample papers the search endpoint used to hard-code
+    conn.executemany(
+        """INSERT OR IGNORE INTO papers (title, authors, year, doi, abstract, keywords)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        [(p['title'], json.dumps(p['authors']), p['year'], p['doi'], p['abstract'],
+          json.dumps(p['keywords'])) for p in catalog.SAMPLE_PAPERS]
+    )
+
+
+@migration(5, 'Paper popularity for autocomplete ranking')
+def paper_popularity(conn):
+    conn.execute("ALTER TABLE papers ADD COLUMN popularity REAL NOT NULL DEFAULT 0")
+
+
+@migration(6, 'Full-text indexes over chat and search history')
+def history_fts(conn):
+    # External-content FTS5 tables: the text stays in the base tables and
+    # triggers keep the indexes in sync. user_id is indexed too so searches
+    # are scoped with a MATCH on it instead of filtering joined rows.
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+        content, user_id,
+        content='chat_history', content_rowid='id', tokenize='porter unicode61'
+    )
+    """)
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_history_fts USING fts5(
+        query, response, user_id,
+        content='search_history', content_rowid='id', tokenize='porter unicode61'
+    )
+    """)
+
+    for table, columns in (('chat_history', ('content', 'user_id')),
+                           ('search_history', ('query', 'response', 'user_id'))):
+        names = ', '.join(columns)
+        new_values = ', '.join(f'new.{c}' for c in columns)
+        old_values = ', '.join(f'old.{c}' for c in columns)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {new_values});
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {names})
+            VALUES ('delete', old.id, {old_values});
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {names})
+            VALUES ('delete', old.id, {old_values});
+            INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {new_values});
+        END
+        """)
+        conn.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+@migration(7, 'Persistent paper summary cache')
+def summary_cache(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS summary_cache (
+        cache_key TEXT PRIMARY KEY,
+        version TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summary_cache_expires ON summary_cache(expires_at)")
+
+
+
+@migration(8, 'Stored quizzes')
+def stored_quizzes(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS quizzes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        paper_key TEXT NOT NULL,
+        num_questions INTEGER NOT NULL,
+        generator_version TEXT NOT NULL,
+        paper_title TEXT NOT NULL,
+        questions TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (paper_key, num_questions, generator_version)
+    )
+    """)
+    conn.execute("ALTER TABLE quiz_results ADD COLUMN quiz_id INTEGER REFERENCES quizzes(id)")
+    # get_quiz_history returns quiz_id too; keep its index covering (migration 2)
+    conn.execute("DROP INDEX IF EXISTS idx_quiz_results_user_ts")
+    conn.execute("""CREATE INDEX idx_quiz_results_user_ts
+                    ON quiz_results (user_id, timestamp, paper_title, score, total_questions,
+                                     quiz_id)""")
+
+
+@migration(9, 'Quiz analytics summary tables')
+def quiz_analytics(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS quiz_user_stats (
+        user_id INTEGER PRIMARY KEY,
+        attempts INTEGER NOT NULL,
+        passes INTEGER NOT NULL,
+        score_sum INTEGER NOT NULL,
+        question_sum INTEGER NOT NULL,
+        percentage_sum REAL NOT NULL,
+        avg_percentage REAL NOT NULL,
+        best_percentage REAL NOT NULL,
+        last_attempt_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS quiz_paper_stats (
+        paper_key TEXT PRIMARY KEY,
+        paper_title TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        passes INTEGER NOT NULL,
+        score_sum INTEGER NOT NULL,
+        question_sum INTEGER NOT NULL,
+        percentage_sum REAL NOT NULL,
+        avg_percentage REAL NOT NULL,
+        pass_rate REAL NOT NULL,
+        best_percentage REAL NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS quiz_paper_leaderboard (
+        paper_key TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        attempts INTEGER NOT NULL,
+        best_percentage REAL NOT NULL,
+        best_at TIMESTAMP,
+        PRIMARY KEY (paper_key, user_id),
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_user_stats_avg ON quiz_user_stats(avg_percentage DESC, attempts DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_paper_stats_attempts ON quiz_paper_stats(attempts DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_paper_stats_pass_rate ON quiz_paper_stats(pass_rate DESC, attempts DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quiz_paper_leaderboard_rank ON quiz_paper_leaderboard(paper_key, best_percentage DESC, best_at)")
+
+    # Backfill from existing results, keyed on the same normalized title as
+    # the live updates (70% pass mark, as in submit_quiz at the time)
+    conn.create_function('normalize_title', 1, catalog.normalize, deterministic=True)
+    conn.execute("""
+    CREATE TEMP VIEW graded AS
+    SELECT user_id, paper_title, normalize_title(paper_title) AS paper_key, score,
+           total_questions, timestamp,
+           CASE WHEN total_questions > 0 THEN score * 100.0 / total_questions ELSE 0.0 END AS pct
+    FROM quiz_results
+    """)
+    conn.execute("""
+    INSERT INTO quiz_user_stats
+    SELECT user_id, count(*), sum(pct >= 70), sum(score), sum(total_questions), sum(pct),
+           avg(pct), max(pct), max(timestamp)
+    FROM graded GROUP BY user_id
+    """)
+    conn.execute("""
+    INSERT INTO quiz_paper_stats
+    SELECT paper_key, max(paper_title), count(*), sum(pct >= 70), sum(score), sum(total_questions),
+           sum(pct), avg(pct), avg(pct >= 70), max(pct)
+    FROM graded GROUP BY paper_key
+    """)
+    conn.execute("""
+    INSERT INTO quiz_paper_leaderboard
+    SELECT paper_key, user_id, count(*), max(pct),
+           (SELECT min(g2.timestamp) FROM graded g2
+            WHERE g2.paper_key = graded.paper_key AND g2.user_id = graded.user_id
+              AND g2.pct = max(graded.pct))
+    FROM graded GROUP BY paper_key, user_id
+    """)
+    conn.execute("DROP VIEW graded")
+
+
+@migration(10, 'History tombstones and chat session visibility')
+def history_tombstones(conn):
+    # Work queue for retention.Purger, and the per-user clear markers that
+    # hide history until it is purged
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS history_tombstones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        table_name TEXT NOT NULL,
+        session_id TEXT,
+        up_to_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_history_tombstones_user
+                    ON history_tombstones (user_id, table_name, session_id, up_to_id)""")
+
+    # Messages of a session with ids up to hidden_through belong to a deleted
+    # incarnation of it; last_message_id tells whether anything came after
+    conn.execute("ALTER TABLE chat_sessions ADD COLUMN hidden_through INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE chat_sessions ADD COLUMN last_message_id INTEGER")
+    conn.execute("""
+    UPDATE chat_sessions SET last_message_id = (SELECT max(id) FROM chat_history h
+                                                WHERE h.session_id = chat_sessions.session_id)
+    """)
+
+    # The session list filters on visibility; keep its index covering (migration 3)
+    conn.execute("DROP INDEX IF EXISTS idx_chat_sessions_user_activity")
+    conn.execute("""CREATE INDEX idx_chat_sessions_user_activity
+                    ON chat_sessions (user_id, last_activity, id, session_id, session_name,
+                                      created_at, message_count, question_count,
+                                      first_message_preview, last_message_preview,
+                                      last_message_id, hidden_through)""")
+    # retention.Purger expires chat sessions and search history by age across all users
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_activity
+                    ON chat_sessions (last_activity)""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_search_history_ts
+                    ON search_history (timestamp)""")
+
+
+@migration(11, 'Compressed history text')
+def compressed_history(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS compression_dictionaries (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id INTEGER UNIQUE NOT NULL,
+        data BLOB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Existing rows stay TEXT, which zunpack() passes through; they are
+    # compressed in batches by `flask --app app compress-history`, not in
+    # this one transaction.
+
+    # The external-content indexes from migration 6 would read compressed
+    # blobs. They are rebuilt over views that decompress, and their triggers
+    # index the decompressed text.
+    for table in compression.COMPRESSED_COLUMNS:
+        for event in ('insert', 'delete', 'update'):
+            conn.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{event}")
+        conn.execute(f"DROP TABLE IF EXISTS {table}_fts")
+
+    conn.execute("""
+    CREATE VIEW IF NOT EXISTS chat_history_text AS
+    SELECT id, zunpack(content) AS content, user_id FROM chat_history
+    """)
+    conn.execute("""
+    CREATE VIEW IF NOT EXISTS search_history_text AS
+    SELECT id, query, zunpack(response) AS response, user_id FROM search_history
+    """)
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+        content, user_id,
+        content='chat_history_text', content_rowid='id', tokenize='porter unicode61'
+    )
+    """)
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_history_fts USING fts5(
+        query, response, user_id,
+        content='search_history_text', content_rowid='id', tokenize='porter unicode61'
+    )
+    """)
+
+    for table, columns in (('chat_history', ('content', 'user_id')),
+                           ('search_history', ('query', 'response', 'user_id'))):
+        def values(row):
+            return ', '.join(f'zunpack({row}.{c})' if c in compression.COMPRESSED_COLUMNS[table]
+                             else f'{row}.{c}' for c in columns)
+        names = ', '.join(columns)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {values('new')});
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {names})
+            VALUES ('delete', old.id, {values('old')});
+        END
+        """)
+        # Recompressing a row leaves its text as it was, so it isn't reindexed
+        changed = ' OR '.join(f"{a} IS NOT {b}" for a, b in zip(values('old').split(', '),
+                                                              values('new').split(', ')))
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table}
+        WHEN {changed} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, {names})
+            VALUES ('delete', old.id, {values('old')});
+            INSERT INTO {table}_fts (rowid, {names}) VALUES (new.id, {values('new')});
+        END
+        """)
+        conn.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+@migration(12, 'Write-behind dead letters')
+def write_behind_failures(conn):
+    # Queued writes that failed after their 202, kept for inspection or replay
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS write_behind_failures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        user_id INTEGER,
+        payload TEXT NOT NULL,
+        error TEXT NOT NULL,
+        failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def ensure_version_table(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def current_version(conn):
+    """Get the highest applied migration version, 0 for a fresh database"""
+    ensure_version_table(conn)
+    row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+
+def pending_migrations(conn):
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def migrate(conn, target=None):
+    """Apply pending migrations up to target, each in its own transaction"""
+    applied = []
+    for version, description, func in pending_migrations(conn):
+        if target is not None and version > target:
+            break
+        with transaction(conn):
+            # Re-check under the writer lock so concurrent deploys apply it once
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?",
+                            (version,)).fetchone():
+                continue
+            func(conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+        applied.append((version, description))
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply schema migrations to users.db')
+    parser.add_argument('--database', default='users.db')
+    parser.add_argument('--target', type=int, default=None)
+    args = parser.parse_args()
+
+    pool = ConnectionPool(args.database, size=1)
+    compression.install(pool)
+    with pool.connection() as conn:
+        for version, description in migrate(conn, args.target):
+            print(f"Applied migration {version}: {description}")
+        print(f"Schema version: {current_version(conn)}")
+    pool.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Keyset (cursor) pagination over queries ordered by (timestamp, id)
+
+Pages are read with a range seek on the (..., timestamp, rowid) indexes from
+migrations.py, so the cost of a page does not grow with how far back it is.
+"""
+import base64
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(sort_value, row_id):
+    raw = f"{sort_value}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, row_id = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        return sort_value, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise CursorError('Invalid cursor')
+
+
+def page_params(args, default_limit=DEFAULT_PAGE_SIZE):
+    """Read before/after/limit from request args, raising CursorError on bad input"""
+    before = args.get('before')
+    after = args.get('after')
+    if before and after:
+        raise CursorError('Use either before or after, not both')
+
+    try:
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        raise CursorError('Invalid limit')
+
+    return {
+        'before': decode_cursor(before) if before else None,
+        'after': decode_cursor(after) if after else None,
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+    }
+
+
+def fetch_page(conn, columns, table, where, params, sort_column, page, newest_first=True):
+    """Fetch one page of rows in the endpoint's natural order
+
+    Without a cursor the newest page is returned. `before` walks towards older
+    rows and `after` towards newer ones. Each row gets sort_column and id
+    appended so the page cursors can be built from it.
+    """
+    sql = f"SELECT {columns}, {sort_column}, id FROM {table} WHERE {where}"
+    params = list(params)
+
+    if page['after']:
+        sql += f" AND ({sort_column}, id) > (?, ?) ORDER BY {sort_column} ASC, id ASC"
+        params.extend(page['after'])
+    else:
+        if page['before']:
+            sql += f" AND ({sort_column}, id) < (?, ?)"
+            params.extend(page['before'])
+        sql += f" ORDER BY {sort_column} DESC, id DESC"
+
+    sql += " LIMIT ?"
+    params.append(page['limit'] + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    has_more = len(rows) > page['limit']
+    rows = rows[:page['limit']]
+
+    # rows are newest-first unless we walked forward with `after`
+    if bool(page['after']) == newest_first:
+        rows.reverse()
+
+    if rows:
+        oldest, newest = (rows[-1], rows[0]) if newest_first else (rows[0], rows[-1])
+        before = encode_cursor(oldest[-2], oldest[-1])
+        after = encode_cursor(newest[-2], newest[-1])
+    else:
+        before = after = None
+
+    return rows, {
+        'limit': page['limit'],
+        'has_more': has_more,
+        'before': before,
+        'after': after,
+    }
@@ -0,0 +1,175 @@
+"""Password hashing off the request threads
+
+Hashes are computed by werkzeug in a small process pool, so a login storm
+uses spare cores instead of holding up every other request in the worker.
+At most PASSWORD_HASH_QUEUE hashes are queued or running at once; past
+that, callers get HasherBusy rather than waiting behind a growing backlog.
+
+The cost is configurable (PBKDF2 iterations or scrypt N/r/p). Stored hashes
+are werkzeug strings that carry their own parameters, so old hashes keep
+verifying and are replaced on the next successful login when the configured
+method differs. Logins for unknown usernames wait about as long as a real
+verification takes instead of hashing a dummy password. Until the first one
+is measured, they verify against a dummy hash that each process's pool
+computes once as it starts.
+"""
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from db import load_config
+
+DEFAULT_CONFIG = {
+    'PASSWORD_SCHEME': 'pbkdf2',
+    'PASSWORD_PBKDF2_ITERATIONS': 1000000,
+    # scrypt memory use is 128 * N * r bytes (32 MiB for N=2**15, r=8)
+    'PASSWORD_SCRYPT_N': 2 ** 15,
+    'PASSWORD_SCRYPT_R': 8,
+    'PASSWORD_SCRYPT_P': 1,
+    # 0 hashes in the request thread (single core deployments, tests)
+    'PASSWORD_HASH_WORKERS': min(4, os.cpu_count() or 1),
+    'PASSWORD_HASH_QUEUE': 64,
+    'PASSWORD_HASH_TIMEOUT': 10.0,
+}
+
+# Weight of the newest verification in the running average used to pace
+# logins for unknown usernames
+LATENCY_SMOOTHING = 0.1
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def hash_method(scheme, iterations=1000000, n=2 ** 15, r=8, p=1):
+    """The werkzeug method string for the configured scheme and cost"""
+    if scheme == 'pbkdf2':
+        return f'pbkdf2:sha256:{iterations}'
+    if scheme == 'scrypt':
+        return f'scrypt:{n}:{r}:{p}'
+    raise ValueError(f'Unknown password scheme: {scheme}')
+
+
+class PasswordHasher:
+    def __init__(self, method, workers=2, max_pending=64, timeout=10.0):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._verify_seconds = None
+        self._dummy_hash = None
+        self._dummy_future = None
+
+    def _pool(self):
+        # Created lazily, and again after a fork, since worker processes can't be inherited
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pid = os.getpid()
+                    self._dummy_future = self._executor.submit(generate_password_hash, '',
+                                                               self.method)
+        return self._executor
+
+    def start(self):
+        """Start the process pool now instead of on the first hash"""
+        if self.workers:
+            self._pool()
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy('Too many password hashes pending')
+        try:
+            return self._pool().submit(func, *args).result(self.timeout)
+        except FutureTimeout:
+            raise HasherBusy('Password hashing timed out')
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        started = time.monotonic()
+        result = self._run(check_password_hash, password_hash, password)
+        elapsed = time.monotonic() - started
+        with self._lock:
+            if self._verify_seconds is None:
+                self._verify_seconds = elapsed
+            else:
+                self._verify_seconds += LATENCY_SMOOTHING * (elapsed - self._verify_seconds)
+        return result
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+    def unknown_user_delay(self):
+        """Seconds to wait so an unknown user takes about as long as a wrong password
+
+        The caller sleeps for it, after giving back anything it doesn't need
+        to hold while doing no work.
+        """
+        with self._lock:
+            delay = self._verify_seconds
+        if delay is None:
+            # No login measured yet in this process; pay for one real verification
+            self.verify(self._dummy(), 'x')
+            return 0.0
+        return delay
+
+    def _dummy(self):
+        if not self.workers:
+            if self._dummy_hash is None:
+                self._dummy_hash = generate_password_hash('', self.method)
+            return self._dummy_hash
+        self._pool()
+        try:
+            return self._dummy_future.result(self.timeout)
+        except FutureTimeout:
+            raise HasherBusy('Password hashing timed out')
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def benchmark(methods, rounds=3):
+    """Seconds per hash and memory for each method string, for choosing the cost"""
+    results = []
+    for method in methods:
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            generate_password_hash('benchmark-password', method)
+            timings.append(time.perf_counter() - started)
+        name, *args = method.split(':')
+        memory = 128 * int(args[0]) * int(args[1]) if name == 'scrypt' else 0
+        results.append((method, min(timings), memory))
+    return results
+
+
+def init_app(app):
+    load_config(app, DEFAULT_CONFIG)
+    hasher = PasswordHasher(
+        hash_method(app.config['PASSWORD_SCHEME'],
+                    iterations=app.config['PASSWORD_PBKDF2_ITERATIONS'],
+                    n=app.config['PASSWORD_SCRYPT_N'],
+                    r=app.config['PASSWORD_SCRYPT_R'],
+                    p=app.config['PASSWORD_SCRYPT_P']),
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_pending=app.config['PASSWORD_HASH_QUEUE'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+    )
+    app.extensions['password_hasher'] = hasher
+    atexit.register(hasher.shutdown)
+    return hasher
@@ -0,0 +1,262 @@
+"""Opt-in request profiling and the slow-query log
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>` or is
+picked at random at PROFILE_SAMPLE_RATE. Its trace holds a cProfile summary
+of the request thread, and each SQL statement it ran with its time, the
+shape of its parameters and its EXPLAIN QUERY PLAN. Streamed responses
+are covered until their body has been sent. Traces are JSON files in
+PROFILE_DIR. Only the newest PROFILE_MAX_TRACES are kept, and the response
+names its trace in X-Profile-Id.
+
+Independently of profiling, every statement whose execution takes at least
+SLOW_QUERY_MS is logged to SLOW_QUERY_LOG with its route and the shape of
+its parameters (types and lengths, never values).
+
+Statements are seen through the metered connections from metrics.py.
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import secrets
+import threading
+import time
+
+from flask import request, session
+
+import metrics
+from db import get_pool, load_config
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slow_queries')
+
+DEFAULT_CONFIG = {
+    # Fraction of requests profiled at random
+    'PROFILE_SAMPLE_RATE': 0.0,
+    # Requests with X-Profile set to this token are profiled; empty disables the header
+    'PROFILE_TOKEN': '',
+    'PROFILE_DIR': 'profiles',
+    'PROFILE_MAX_TRACES': 200,
+    # 0 disables the slow-query log
+    'SLOW_QUERY_MS': 250.0,
+    # Empty sends slow queries to the 'slow_queries' logger only
+    'SLOW_QUERY_LOG': 'slow_queries.log',
+}
+
+PROFILE_HEADER = 'X-Profile'
+
+# Functions listed in a trace's profile, by cumulative time
+PROFILE_TOP_FUNCTIONS = 40
+
+# Statements kept per trace; a runaway loop shouldn't produce a huge file
+MAX_TRACE_STATEMENTS = 500
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def value_shape(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}[{len(value)}]'
+    return type(value).__name__
+
+
+def parameter_shape(parameters, many=False):
+    """Types and lengths of bound parameters, e.g. ['int', 'str[12]']"""
+    if many:
+        rows = list(parameters)
+        return {'rows': len(rows), 'first': parameter_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {key: value_shape(value) for key, value in parameters.items()}
+    return [value_shape(value) for value in parameters]
+
+
+class Trace:
+    """Everything recorded for one profiled request"""
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.started = time.perf_counter()
+        self.statements = []
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # Another profiler is active (one per interpreter from Python 3.12)
+            self.profiler = None
+
+    def add_statement(self, sql, parameters, seconds):
+        if len(self.statements) < MAX_TRACE_STATEMENTS:
+            self.statements.append((sql, parameters, seconds))
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        return time.perf_counter() - self.started
+
+    def profile_text(self):
+        if self.profiler is None:
+            return None
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        return out.getvalue()
+
+
+class Profiler:
+    def __init__(self, pool, directory='profiles', max_traces=200, sample_rate=0.0,
+                 token='', slow_query_ms=250.0):
+        self.pool = pool
+        self.directory = directory
+        self.max_traces = max_traces
+        self.sample_rate = sample_rate
+        self.token = token
+        self.slow_query_seconds = slow_query_ms / 1000 if slow_query_ms > 0 else None
+        # The request (endpoint, trace or None) running on each thread
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def trigger(self):
+        """Why this request should be profiled, or None"""
+        header = request.headers.get(PROFILE_HEADER)
+        if header and self.token and secrets.compare_digest(header, self.token):
+            return 'header'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def begin(self, endpoint, trigger):
+        stale = getattr(self._local, 'trace', None)
+        if stale is not None:
+            # Left behind by a request whose response was never closed
+            stale.stop()
+        self._local.endpoint = endpoint
+        self._local.trace = Trace(trigger) if trigger else None
+        return self._local.trace
+
+    def end(self):
+        self._local.endpoint = None
+        self._local.trace = None
+
+    def on_statement(self, conn, sql, parameters, seconds):
+        if sql.startswith('EXPLAIN'):
+            return
+        many = isinstance(parameters, list) and parameters and isinstance(parameters[0], (tuple, list, dict))
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            slow_query_logger.warning(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'ms': round(seconds * 1000, 2),
+                'route': getattr(self._local, 'endpoint', None),
+                'sql': ' '.join(sql.split()),
+                'parameters': parameter_shape(parameters, many),
+            }))
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.add_statement(sql, parameters[0] if many else parameters, seconds)
+
+    def explain(self, sql, parameters):
+        if not sql.lstrip().upper().startswith(EXPLAINABLE):
+            return None
+        try:
+            with self.pool.connection() as conn:
+                rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+        except Exception as e:
+            return [f'EXPLAIN failed: {e}']
+        return [f'{"  " * depth(rows, row)}{row[3]}' for row in rows]
+
+    def save(self, trace_id, trace, info):
+        """Write the trace to PROFILE_DIR, dropping the oldest beyond max_traces"""
+        elapsed = trace.stop()
+        statements = [{
+            'sql': ' '.join(sql.split()),
+            'ms': round(seconds * 1000, 3),
+            'parameters': parameter_shape(parameters),
+            'plan': self.explain(sql, parameters),
+        } for sql, parameters, seconds in trace.statements]
+        data = dict(info, id=trace_id, trigger=trace.trigger, ms=round(elapsed * 1000, 2),
+                    sql_ms=round(sum(s['ms'] for s in statements), 2),
+                    statements=statements, profile=trace.profile_text())
+
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, f'{trace_id}.json'), 'w') as f:
+                json.dump(data, f, indent=1)
+            traces = sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+            for name in traces[:-self.max_traces]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+def depth(rows, row):
+    """Nesting level of an EXPLAIN QUERY PLAN row, from its parent id"""
+    parents = {r[0]: r[1] for r in rows}
+    level = 0
+    parent = row[1]
+    while parent in parents:
+        level += 1
+        parent = parents[parent]
+    return level
+
+
+def init_app(app):
+    """Install the profiling hooks and the slow-query log, returning the Profiler"""
+    load_config(app, DEFAULT_CONFIG)
+    profiler = Profiler(
+        get_pool(app),
+        directory=app.config['PROFILE_DIR'],
+        max_traces=app.config['PROFILE_MAX_TRACES'],
+        sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+        token=app.config['PROFILE_TOKEN'],
+        slow_query_ms=app.config['SLOW_QUERY_MS'],
+    )
+    profiling_possible = app.config['PROFILE_SAMPLE_RATE'] > 0 or app.config['PROFILE_TOKEN']
+    if profiler.slow_query_seconds is None and not profiling_possible:
+        return profiler
+
+    if app.config['SLOW_QUERY_LOG'] and profiler.slow_query_seconds is not None:
+        handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'], delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        slow_query_logger.addHandler(handler)
+        slow_query_logger.setLevel(logging.WARNING)
+        slow_query_logger.propagate = False
+    metrics.add_statement_listener(app, profiler.on_statement)
+
+    @app.before_request
+    def start_profile():
+        trigger = profiler.trigger() if profiling_possible else None
+        profiler.begin(request.endpoint, trigger)
+
+    @app.after_request
+    def finish_profile(response):
+        trace = getattr(profiler._local, 'trace', None)
+        if trace is None:
+            response.call_on_close(profiler.end)
+            return response
+
+        info = {'method': request.method, 'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint, 'status': response.status_code,
+                'user_id': session.get('user_id')}
+        # Sorts by age, which is how the ring buffer picks what to drop
+        trace_id = f'{time.time_ns()}-{os.getpid()}'
+
+        def save():
+            try:
+                profiler.save(trace_id, trace, info)
+            except Exception:
+                logger.exception('Saving profile trace failed')
+            finally:
+                profiler.end()
+
+        response.headers['X-Profile-Id'] = trace_id
+        # Saved once the body is sent, so streamed responses are profiled to the end
+        response.call_on_close(save)
+        return response
+
+    app.extensions['profiler'] = profiler
+    return profiler
@@ -0,0 +1,213 @@
+"""Stored quizzes and their answer keys
+
+A generated quiz is saved in the quizzes table (migration 8) under a
+quiz_id, unique per normalized paper title, question count and generator
+version, so repeat requests for a popular paper reuse the stored quiz. The
+most recently used quizzes are kept in memory with their answer keys, so
+grading a submission is a dict lookup per answer.
+
+Results also feed per-user, per-paper and per-paper-per-user summary tables
+(migration 9) that record_result() updates in the submission's transaction,
+so leaderboards and stats are indexed top-k reads rather than scans of
+quiz_results.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from catalog import normalize
+from db import get_pool, load_config, transaction
+
+DEFAULT_CONFIG = {
+    'QUIZ_CACHE_SIZE': 1024,
+    # Bump when the quiz generator changes so new requests get fresh quizzes;
+    # quizzes already handed out keep their id and can still be graded
+    'QUIZ_GENERATOR_VERSION': '1',
+}
+
+# Percentage at or above which an attempt counts as a pass
+PASS_PERCENTAGE = 70
+
+
+def percentage(score, total_questions):
+    return score * 100.0 / total_questions if total_questions > 0 else 0.0
+
+
+class Quiz:
+    def __init__(self, quiz_id, paper_title, questions):
+        self.id = quiz_id
+        self.paper_title = paper_title
+        self.questions = questions
+        self.answer_key = {str(i): q['correct'] for i, q in enumerate(questions)}
+
+    def public(self):
+        """The quiz as shown to the user, without answers or explanations"""
+        return {
+            'quiz_id': self.id,
+            'paper_title': self.paper_title,
+            'questions': [{'question': q['question'], 'options': q['options']}
+                          for q in self.questions],
+            'total_questions': len(self.questions),
+        }
+
+    def grade(self, answers):
+        """Score {question_index: option} answers against the key, returning (score, results)"""
+        score = 0
+        results = []
+        for index, question in enumerate(self.questions):
+            given = answers.get(str(index))
+            correct = given is not None and self.answer_key[str(index)] == given
+            score += correct
+            results.append({
+                'question_index': index,
+                'answer': given,
+                'correct': correct,
+                'correct_answer': question['correct'],
+                'explanation': question.get('explanation'),
+            })
+        return score, results
+
+
+class QuizStore:
+    """Quizzes by id and by (paper, question count), cached in an LRU over SQLite"""
+
+    def __init__(self, pool, version='1', cache_size=1024):
+        self.pool = pool
+        self.version = version
+        self.cache_size = cache_size
+        self._by_id = OrderedDict()
+        self._by_paper = {}
+        self._lock = threading.Lock()
+
+    def _remember(self, quiz, paper_key=None):
+        with self._lock:
+            self._by_id[quiz.id] = quiz
+            self._by_id.move_to_end(quiz.id)
+            if paper_key is not None:
+                self._by_paper[paper_key] = quiz.id
+            while len(self._by_id) > self.cache_size:
+                evicted_id, _ = self._by_id.popitem(last=False)
+                self._by_paper = {k: v for k, v in self._by_paper.items() if v != evicted_id}
+
+    def _cached(self, quiz_id):
+        with self._lock:
+            quiz = self._by_id.get(quiz_id)
+            if quiz is not None:
+                self._by_id.move_to_end(quiz_id)
+            return quiz
+
+    def get(self, quiz_id):
+        """The stored quiz with this id, or None"""
+        quiz = self._cached(quiz_id)
+        if quiz is not None:
+            return quiz
+
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT id, paper_title, questions FROM quizzes WHERE id = ?", (quiz_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        quiz = Quiz(row[0], row[1], json.loads(row[2]))
+        self._remember(quiz)
+        return quiz
+
+    def get_or_create(self, paper_title, num_questions, generate):
+        """The stored quiz for this paper and question count, generating it on first use"""
+        paper_key = (normalize(paper_title), num_questions)
+        with self._lock:
+            quiz_id = self._by_paper.get(paper_key)
+        if quiz_id is not None:
+            quiz = self._cached(quiz_id)
+            if quiz is not None:
+                return quiz
+
+        with self.pool.connection() as conn:
+            row = self._find(conn, paper_key)
+            if row is None:
+                questions = generate()
+                # Concurrent first requests may both generate; the unique index
+                # keeps one quiz and everyone gets its id
+                with transaction(conn):
+                    conn.execute(
+                        """INSERT INTO quizzes (paper_key, num_questions, generator_version,
+                                                paper_title, questions)
+                           VALUES (?, ?, ?, ?, ?)
+                           ON CONFLICT (paper_key, num_questions, generator_version) DO NOTHING""",
+                        (paper_key[0], num_questions, self.version, paper_title,
+                         json.dumps(questions))
+                    )
+                row = self._find(conn, paper_key)
+
+        quiz = Quiz(row[0], row[1], json.loads(row[2]))
+        self._remember(quiz, paper_key)
+        return quiz
+
+    def _find(self, conn, paper_key):
+        return conn.execute(
+            """SELECT id, paper_title, questions FROM quizzes
+               WHERE paper_key = ? AND num_questions = ? AND generator_version = ?""",
+            (paper_key[0], paper_key[1], self.version)
+        ).fetchone()
+
+
+def record_result(conn, user_id, paper_title, score, total_questions):
+    """Fold one graded attempt into the quiz summary tables; must run inside a write transaction"""
+    paper_key = normalize(paper_title)
+    pct = percentage(score, total_questions)
+    passed = int(pct >= PASS_PERCENTAGE)
+
+    # In an upsert's SET clause bare column names are the row's values before the update
+    conn.execute(
+        """INSERT INTO quiz_user_stats (user_id, attempts, passes, score_sum, question_sum,
+                                        percentage_sum, avg_percentage, best_percentage,
+                                        last_attempt_at)
+           VALUES (?, 1, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+           ON CONFLICT (user_id) DO UPDATE SET
+               attempts = attempts + 1,
+               passes = passes + excluded.passes,
+               score_sum = score_sum + excluded.score_sum,
+               question_sum = question_sum + excluded.question_sum,
+               percentage_sum = percentage_sum + excluded.percentage_sum,
+               avg_percentage = (percentage_sum + excluded.percentage_sum) / (attempts + 1),
+               best_percentage = max(best_percentage, excluded.best_percentage),
+               last_attempt_at = excluded.last_attempt_at""",
+        (user_id, passed, score, total_questions, pct, pct, pct)
+    )
+    conn.execute(
+        """INSERT INTO quiz_paper_stats (paper_key, paper_title, attempts, passes, score_sum,
+                                         question_sum, percentage_sum, avg_percentage,
+                                         pass_rate, best_percentage)
+           VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (paper_key) DO UPDATE SET
+               attempts = attempts + 1,
+               passes = passes + excluded.passes,
+               score_sum = score_sum + excluded.score_sum,
+               question_sum = question_sum + excluded.question_sum,
+               percentage_sum = percentage_sum + excluded.percentage_sum,
+               avg_percentage = (percentage_sum + excluded.percentage_sum) / (attempts + 1),
+               pass_rate = (passes + excluded.passes) * 1.0 / (attempts + 1),
+               best_percentage = max(best_percentage, excluded.best_percentage)""",
+        (paper_key, paper_title, passed, score, total_questions, pct, pct, float(passed), pct)
+    )
+    conn.execute(
+        """INSERT INTO quiz_paper_leaderboard (paper_key, user_id, attempts, best_percentage, best_at)
+           VALUES (?, ?, 1, ?, CURRENT_TIMESTAMP)
+           ON CONFLICT (paper_key, user_id) DO UPDATE SET
+               attempts = attempts + 1,
+               best_at = CASE WHEN excluded.best_percentage > best_percentage
+                              THEN excluded.best_at ELSE best_at END,
+               best_percentage = max(best_percentage, excluded.best_percentage)""",
+        (paper_key, user_id, pct)
+    )
+
+
+def init_app(app):
+    load_config(app, DEFAULT_CONFIG)
+    store = QuizStore(
+        get_pool(app),
+        version=app.config['QUIZ_GENERATOR_VERSION'],
+        cache_size=app.config['QUIZ_CACHE_SIZE'],
+    )
+    app.extensions['quiz_store'] = store
+    return store
@@ -0,0 +1,187 @@
+"""Text analysis and BM25F relevance scoring for the paper catalog
+
+Term statistics are folded into per-posting impacts when the index is
+built, so scoring a query is a sum of idf * impact over its postings.
+"""
+import bisect
+import heapq
+import math
+import re
+from array import array
+from functools import lru_cache
+from operator import add
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# BM25 saturation and per-field boost / length normalization
+K1 = 1.2
+FIELD_BOOSTS = {'title': 3.0, 'keywords': 2.0, 'authors': 1.5, 'abstract': 1.0}
+FIELD_B = {'title': 0.75, 'keywords': 0.5, 'authors': 0.5, 'abstract': 0.75}
+
+# The last query word (the one still being typed) also matches indexed terms
+# it is a prefix of, at reduced weight
+PREFIX_WEIGHT = 0.5
+MAX_PREFIX_EXPANSIONS = 16
+
+# Irregular plurals common in biology papers that suffix rules get wrong
+IRREGULAR_STEMS = {
+    'bacteria': 'bacterium', 'mitochondria': 'mitochondrion', 'fungi': 'fungus',
+    'nuclei': 'nucleus', 'stimuli': 'stimulus', 'vertebrae': 'vertebra',
+    'larvae': 'larva', 'algae': 'alga', 'genera': 'genus', 'phenomena': 'phenomenon',
+    'criteria': 'criterion', 'analyses': 'analysis', 'hypotheses': 'hypothesis',
+    'cilia': 'cilium', 'flagella': 'flagellum', 'media': 'medium', 'mice': 'mouse',
+    'teeth': 'tooth', 'feet': 'foot', 'women': 'woman', 'men': 'man',
+}
+
+# Endings that look plural or inflected but are part of the word
+PROTECTED_ENDINGS = ('ss', 'us', 'is', 'ous', 'sis')
+
+VOWELS = set('aeiouy')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+@lru_cache(maxsize=200000)
+def stem(token):
+    """Light inflectional stemmer: plurals, -ed/-ing and a trailing e"""
+    if token in IRREGULAR_STEMS:
+        return IRREGULAR_STEMS[token]
+    if len(token) <= 3 or token.isdigit():
+        return token
+
+    if token.endswith('ies') and len(token) > 4:
+        token = token[:-3] + 'y'
+    elif token.endswith('sses'):
+        token = token[:-2]
+    elif token.endswith(('ches', 'shes', 'xes', 'zes')):
+        token = token[:-2]
+    elif token.endswith('s') and not token.endswith(PROTECTED_ENDINGS):
+        token = token[:-1]
+
+    for suffix in ('ing', 'ed'):
+        base = token[:-len(suffix)]
+        if token.endswith(suffix) and len(base) >= 4 and VOWELS & set(base):
+            token = base
+            # stopped -> stop, but keep -ll/-ss/-zz
+            if len(token) > 4 and token[-1] == token[-2] and token[-1] not in 'lsz':
+                token = token[:-1]
+            break
+
+    if token.endswith('e') and len(token) > 4:
+        token = token[:-1]
+    return token
+
+
+def analyze(text):
+    return [stem(token) for token in tokenize(text)]
+
+
+class BM25FIndex:
+    """BM25F over several weighted fields with precomputed per-posting impacts"""
+
+    def __init__(self, documents):
+        """documents: iterable of (doc_id, {field: text})"""
+        analyzed = []
+        totals = dict.fromkeys(FIELD_BOOSTS, 0)
+        for doc_id, fields in documents:
+            counts = {}
+            for field in FIELD_BOOSTS:
+                tokens = analyze(fields.get(field) or '')
+                totals[field] += len(tokens)
+                field_counts = {}
+                for token in tokens:
+                    field_counts[token] = field_counts.get(token, 0) + 1
+                counts[field] = (len(tokens), field_counts)
+            analyzed.append((doc_id, counts))
+
+        self.doc_count = len(analyzed)
+        avg_length = {f: (totals[f] / self.doc_count if self.doc_count else 0) or 1
+                      for f in FIELD_BOOSTS}
+
+        # term -> [doc ids], [impacts]; impact = saturated, length-normalized, boosted tf
+        building = {}
+        for doc_id, counts in analyzed:
+            weighted = {}
+            for field, (length, field_counts) in counts.items():
+                norm = 1 - FIELD_B[field] + FIELD_B[field] * length / avg_length[field]
+                boost = FIELD_BOOSTS[field]
+                for term, tf in field_counts.items():
+                    weighted[term] = weighted.get(term, 0.0) + boost * tf / norm
+            for term, tf in weighted.items():
+                ids, impacts = building.setdefault(term, ([], []))
+                ids.append(doc_id)
+                impacts.append(tf / (K1 + tf))
+
+        self.postings = {}
+        self.idf = {}
+        for term, (ids, impacts) in building.items():
+            self.postings[term] = (array('q', ids), array('f', impacts))
+            df = len(ids)
+            self.idf[term] = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+        self.terms = sorted(self.postings)
+
+    def expand(self, term):
+        """Up to MAX_PREFIX_EXPANSIONS indexed terms starting with term, most common first"""
+        start = bisect.bisect_left(self.terms, term)
+        expansions = []
+        for candidate in self.terms[start:]:
+            if not candidate.startswith(term):
+                break
+            expansions.append(candidate)
+        if len(expansions) > MAX_PREFIX_EXPANSIONS:
+            expansions = heapq.nlargest(MAX_PREFIX_EXPANSIONS, expansions,
+                                        key=lambda t: len(self.postings[t][0]))
+        return expansions
+
+    def _word_scores(self, word, prefix=False):
+        """doc -> score of the best-weighted indexed term a query word matches"""
+        stemmed = stem(word)
+        terms = {stemmed} if stemmed in self.postings else set()
+        if prefix:
+            terms.update(self.expand(stemmed))
+            if word != stemmed:
+                terms.update(self.expand(word))
+
+        weighted = sorted(
+            (self.idf[term] * (1.0 if term == stemmed else PREFIX_WEIGHT), term)
+            for term in terms
+        )
+        # Apply the heaviest term last so it wins for documents holding several
+        scores = {}
+        for weight, term in weighted:
+            ids, impacts = self.postings[term]
+            scores.update(zip(ids, [weight * impact for impact in impacts]))
+        return scores
+
+    def score(self, query, allowed=None):
+        """Score documents matching every query word, optionally within `allowed`"""
+        words = tokenize(query)
+        if not words:
+            return {}
+
+        per_word = []
+        for position, word in enumerate(words):
+            scores = self._word_scores(word, prefix=position == len(words) - 1)
+            if not scores:
+                return {}
+            per_word.append(scores)
+
+        if len(per_word) == 1 and allowed is None:
+            return per_word[0]
+
+        # Intersect starting from the most selective word
+        per_word.sort(key=len)
+        candidates = per_word[0].keys() & (allowed if allowed is not None else per_word[0].keys())
+        for scores in per_word[1:]:
+            candidates &= scores.keys()
+            if not candidates:
+                return {}
+
+        # Sum with map() so the per-candidate work stays in C
+        candidates = list(candidates)
+        totals = list(map(per_word[0].__getitem__, candidates))
+        for scores in per_word[1:]:
+            totals = list(map(add, totals, map(scores.__getitem__, candidates)))
+        return dict(zip(candidates, totals))
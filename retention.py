@@ -0,0 +1,308 @@
+"""History retention: tombstones, batched purging, archival and incremental vacuum
+
+User-facing deletes of chat and search history write a tombstone instead of
+deleting rows, so they cost the same for one message as for a million.
+History is hidden by row id, and ids only grow:
+
+- clearing a history records the table's highest id, and the user's rows
+  up to it are no longer shown (see SEARCH_VISIBLE and
+  session_floor_sql());
+- deleting a chat session sets its hidden_through to its last message id,
+  and the session shows only messages after that. A session whose last
+  message is hidden is deleted. Writing to it again starts it afresh.
+
+A background purger in each process (at most one runs a pass at a time,
+across processes) deletes what the tombstones cover. It works in
+RETENTION_BATCH_SIZE transactions, so other writers wait at most one
+batch for the lock. Each pass also applies the age limits:
+
+- search history older than RETENTION_SEARCH_DAYS is deleted;
+- chat sessions inactive for RETENTION_CHAT_DAYS are deleted whole, after
+  being appended to a gzip NDJSON file in ARCHIVE_DIR when that is set.
+
+The purger then returns up to RETENTION_VACUUM_PAGES free pages to the file
+system with an incremental vacuum. Databases created before auto_vacuum was
+enabled need one `flask --app app vacuum` first.
+"""
+import fcntl
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from db import get_pool, load_config, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # Age limits in days; 0 keeps rows forever
+    'RETENTION_CHAT_DAYS': 0,
+    'RETENTION_SEARCH_DAYS': 0,
+    # Seconds between purge passes; 0 leaves purging to `flask --app app purge-history`
+    'RETENTION_INTERVAL': 60.0,
+    'RETENTION_BATCH_SIZE': 500,
+    # Pause between batches, so writers queued on the lock get a turn
+    'RETENTION_BATCH_PAUSE': 0.02,
+    'RETENTION_VACUUM_PAGES': 2000,
+    # Directory for archived chat sessions; empty deletes expired sessions outright
+    'ARCHIVE_DIR': '',
+}
+
+# Highest search_history id hidden by the user's clears. Used as
+# "id > SEARCH_HIDDEN_THROUGH" with the user id as its parameter.
+SEARCH_HIDDEN_THROUGH = """(SELECT ifnull(max(up_to_id), 0) FROM history_tombstones
+    WHERE user_id = ? AND table_name = 'search_history' AND session_id IS NULL)"""
+
+SEARCH_VISIBLE = f"id > {SEARCH_HIDDEN_THROUGH}"
+
+
+def session_floor_sql(alias='chat_sessions'):
+    """SQL for the highest hidden message id of a chat session
+
+    Messages of the session above it are shown, and the session is shown while
+    its last_message_id is above it.
+    """
+    return f"""max({alias}.hidden_through,
+        (SELECT ifnull(max(up_to_id), 0) FROM history_tombstones
+         WHERE user_id = {alias}.user_id AND table_name = 'chat_history' AND session_id IS NULL))"""
+
+
+# A session's last message id for visibility checks. Sessions left without
+# messages from before migration 10 have none; they count as written just
+# after id 0, so they are shown until deleted or cleared like any other.
+SESSION_LAST_MESSAGE = "ifnull(last_message_id, 0.5)"
+
+SESSION_VISIBLE = f"{SESSION_LAST_MESSAGE} > {session_floor_sql()}"
+
+
+def clear_user_history(conn, user_id, table_name):
+    """Hide all of a user's chat_history or search_history; run inside a write transaction"""
+    conn.execute(
+        f"""INSERT INTO history_tombstones (user_id, table_name, up_to_id)
+            SELECT ?, ?, ifnull(max(id), 0) FROM {table_name}""",
+        (user_id, table_name)
+    )
+
+
+def delete_session(conn, user_id, session_id, last_message_id=None):
+    """Hide a chat session and its messages; run inside a write transaction
+
+    With last_message_id, the session is only deleted if nothing was written to
+    it since then. Returns whether it was deleted.
+    """
+    row = conn.execute(
+        f"""SELECT last_message_id FROM chat_sessions
+            WHERE session_id = ? AND user_id = ? AND {SESSION_VISIBLE}""",
+        (session_id, user_id)
+    ).fetchone()
+    if row is None or (last_message_id is not None and row[0] != last_message_id):
+        return False
+    # A session without messages is hidden by giving it last message id 0
+    up_to_id = row[0] or 0
+    conn.execute(
+        "UPDATE chat_sessions SET hidden_through = ?, last_message_id = ? WHERE session_id = ?",
+        (up_to_id, up_to_id, session_id)
+    )
+    conn.execute(
+        """INSERT INTO history_tombstones (user_id, table_name, session_id, up_to_id)
+           VALUES (?, 'chat_history', ?, ?)""",
+        (user_id, session_id, up_to_id)
+    )
+    return True
+
+
+class Purger:
+    """Deletes tombstoned and expired history in small batches"""
+
+    def __init__(self, pool, chat_days=0, search_days=0, interval=60.0, batch_size=500,
+                 batch_pause=0.02, vacuum_pages=2000, archive_dir=''):
+        self.pool = pool
+        self.chat_days = chat_days
+        self.search_days = search_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        self.archive_dir = archive_dir
+        self.purged = {}    # table -> rows deleted by this process
+        self.archived = 0
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        # Started lazily, and again after a fork, like the write-behind writer
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('History purge pass failed')
+
+    def run_once(self):
+        """Run one pass unless another process is running one; returns rows deleted per table"""
+        before = dict(self.purged)
+        # An advisory lock next to the database keeps worker processes from
+        # purging, and appending to the same archive, at the same time
+        with open(f'{self.pool.path}.retention-lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            if self.chat_days:
+                self.expire_sessions()
+            if self.search_days:
+                self.expire_search_history()
+            self.purge_tombstones()
+            self.vacuum()
+        return {table: count - before.get(table, 0) for table, count in self.purged.items()}
+
+    def _delete_batches(self, table, sql, params):
+        """Repeat a DELETE ... LIMIT ? statement, one transaction per batch, until it runs dry"""
+        while True:
+            with self.pool.connection() as conn:
+                with transaction(conn):
+                    deleted = conn.execute(sql, params + (self.batch_size,)).rowcount
+            with self._lock:
+                self.purged[table] = self.purged.get(table, 0) + deleted
+            if deleted < self.batch_size:
+                return
+            time.sleep(self.batch_pause)
+
+    def purge_tombstones(self):
+        with self.pool.connection() as conn:
+            tombstones = conn.execute(
+                "SELECT id, user_id, table_name, session_id, up_to_id FROM history_tombstones ORDER BY id"
+            ).fetchall()
+
+        for tombstone_id, user_id, table_name, session_id, up_to_id in tombstones:
+            if table_name == 'search_history':
+                self._delete_batches('search_history', """DELETE FROM search_history WHERE id IN
+                    (SELECT id FROM search_history WHERE user_id = ? AND id <= ? LIMIT ?)""",
+                                     (user_id, up_to_id))
+            elif session_id is None:
+                self._delete_batches('chat_history', """DELETE FROM chat_history WHERE id IN
+                    (SELECT id FROM chat_history WHERE user_id = ? AND id <= ? LIMIT ?)""",
+                                     (user_id, up_to_id))
+                # Sessions written to since the clear are kept, with their new messages
+                self._delete_batches('chat_sessions', f"""DELETE FROM chat_sessions WHERE id IN
+                    (SELECT id FROM chat_sessions WHERE user_id = ? AND {SESSION_LAST_MESSAGE} <= ? LIMIT ?)""",
+                                     (user_id, up_to_id))
+            else:
+                self._delete_batches('chat_history', """DELETE FROM chat_history WHERE id IN
+                    (SELECT id FROM chat_history WHERE session_id = ? AND id <= ? LIMIT ?)""",
+                                     (session_id, up_to_id))
+                # Unless it was written to again since, and perhaps deleted again by a later tombstone
+                self._delete_batches('chat_sessions', f"""DELETE FROM chat_sessions WHERE id IN
+                    (SELECT id FROM chat_sessions WHERE session_id = ? AND {SESSION_LAST_MESSAGE} <= ? LIMIT ?)""",
+                                     (session_id, up_to_id))
+
+            with self.pool.connection() as conn:
+                with transaction(conn):
+                    conn.execute("DELETE FROM history_tombstones WHERE id = ?", (tombstone_id,))
+
+    def expire_search_history(self):
+        # Filtered on the timestamp itself: imported and backfilled rows don't
+        # get ids in timestamp order (idx_search_history_ts, migration 10)
+        self._delete_batches('search_history', """DELETE FROM search_history WHERE id IN
+            (SELECT id FROM search_history WHERE timestamp < datetime('now', ?)
+             ORDER BY timestamp LIMIT ?)""", (f'-{self.search_days} days',))
+
+    def expire_sessions(self):
+        """Tombstone sessions inactive for chat_days, archiving them first when configured"""
+        while True:
+            with self.pool.connection() as conn:
+                sessions = conn.execute(
+                    f"""SELECT session_id, user_id, session_name, created_at, last_activity,
+                              message_count, question_count, last_message_id,
+                              {session_floor_sql()}
+                       FROM chat_sessions
+                       WHERE last_activity < datetime('now', ?) AND {SESSION_VISIBLE}
+                       LIMIT ?""",
+                    (f'-{self.chat_days} days', self.batch_size)
+                ).fetchall()
+                if not sessions:
+                    return
+                if self.archive_dir:
+                    self._archive(conn, sessions)
+
+            with self.pool.connection() as conn:
+                with transaction(conn):
+                    for session in sessions:
+                        delete_session(conn, session[1], session[0], last_message_id=session[7])
+            time.sleep(self.batch_pause)
+
+    def _archive(self, conn, sessions):
+        # One gzip member per batch appended to the day's file; a batch whose
+        # sessions change before they are tombstoned is archived again later
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"chat-{time.strftime('%Y-%m-%d')}.ndjson.gz")
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                for session_id, user_id, name, created_at, last_activity, messages, questions, _, floor in sessions:
+                    f.write(json.dumps({
+                        'type': 'session', 'session_id': session_id, 'user_id': user_id,
+                        'session_name': name, 'created_at': created_at, 'last_activity': last_activity,
+                        'total_messages': messages, 'total_questions': questions,
+                    }).encode() + b'\n')
+                    cursor = conn.execute(
+                        """SELECT role, zunpack(content), model_type, timestamp FROM chat_history
+                           WHERE session_id = ? AND id > ? ORDER BY timestamp ASC, id ASC""",
+                        (session_id, floor)
+                    )
+                    for role, content, model_type, timestamp in cursor:
+                        f.write(json.dumps({
+                            'type': 'message', 'session_id': session_id, 'role': role,
+                            'content': content, 'model_type': model_type, 'timestamp': timestamp,
+                        }).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+        self.archived += len(sessions)
+
+    def vacuum(self):
+        """Release free pages to the file system when the database uses incremental auto-vacuum"""
+        if not self.vacuum_pages:
+            return
+        with self.pool.connection() as conn:
+            # 2 is INCREMENTAL
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return
+            if conn.execute("PRAGMA freelist_count").fetchone()[0]:
+                # Each step of the pragma frees one page; execute() would stop
+                # after the first, executescript() runs it to the end
+                conn.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)});")
+
+    def stats(self):
+        with self._lock:
+            return {'purged': dict(self.purged), 'archived': self.archived}
+
+
+def init_app(app):
+    """Create the purger; its thread starts with the first request of each process"""
+    load_config(app, DEFAULT_CONFIG)
+    purger = Purger(
+        get_pool(app),
+        chat_days=app.config['RETENTION_CHAT_DAYS'],
+        search_days=app.config['RETENTION_SEARCH_DAYS'],
+        interval=app.config['RETENTION_INTERVAL'],
+        batch_size=app.config['RETENTION_BATCH_SIZE'],
+        batch_pause=app.config['RETENTION_BATCH_PAUSE'],
+        vacuum_pages=app.config['RETENTION_VACUUM_PAGES'],
+        archive_dir=app.config['ARCHIVE_DIR'],
+    )
+    app.before_request(purger.ensure_started)
+    app.extensions['purger'] = purger
+    return purger
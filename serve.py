@@ -0,0 +1,271 @@
+"""Prefork production server
+
+    python serve.py [--bind 0.0.0.0:8000] [--workers 4]
+
+The master imports app.py once, applies pending migrations, binds the
+listening socket and forks the workers, which accept connections on that
+shared socket with werkzeug's threaded server. Workers that die are
+replaced. Caches and admission limits are per worker; set METRICS_DIR
+for /metrics to cover every worker. Write-behind (WRITE_BEHIND) is turned
+off: its read-your-writes flush only covers the worker that queued a write.
+
+Signals to the master:
+    TERM, INT   stop accepting, let in-flight requests finish, then exit
+    HUP         graceful reload: re-exec the master on the same socket, start
+                workers on the new code, then drain the old ones
+    TTIN, TTOU  add or remove a worker
+"""
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import click
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import metrics
+from db import get_pool, load_config
+
+DEFAULT_CONFIG = {
+    'SERVER_BIND': '127.0.0.1:5000',
+    # 0 runs one worker per available CPU core
+    'SERVER_WORKERS': 0,
+    # Seconds a draining worker gets to finish its requests before it is killed
+    'SERVER_GRACEFUL_TIMEOUT': 30.0,
+}
+
+# Environment handed to a re-executed master: the listening socket's fd and
+# the pids of the workers it takes over and drains
+LISTEN_FD_ENV = 'SERVER_LISTEN_FD'
+OLD_WORKERS_ENV = 'SERVER_OLD_WORKERS'
+
+# Connections the kernel queues while every worker is busy accepting
+LISTEN_BACKLOG = 1024
+
+# A worker exiting sooner than this after starting is treated as a crash, and
+# the next one is started only after the same delay
+MIN_WORKER_LIFETIME = 1.0
+
+
+class RequestHandler(WSGIRequestHandler):
+    # Idle keep-alive connections are closed after this many seconds, so a
+    # draining worker doesn't wait on clients that have gone quiet
+    timeout = 5
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+def run_worker(app, fd, host, port):
+    """Serve on the inherited socket until SIGTERM, then finish in-flight requests"""
+    for signum in (signal.SIGHUP, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
+    for signum in (signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+    # Hashing workers and the dummy hash for unknown usernames are ready before the first login
+    app.extensions['password_hasher'].start()
+
+    server = make_server(host, port, app, threaded=True, request_handler=RequestHandler, fd=fd)
+    # Non-daemon request threads are joined by server_close()
+    server.daemon_threads = False
+
+    def drain(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, drain)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class Master:
+    def __init__(self, app, listener_fd, host, port, size, graceful_timeout):
+        self.app = app
+        self.listener_fd = listener_fd
+        self.host = host
+        self.port = port
+        self.size = size
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}    # pid -> start time
+        self.draining = {}   # pid -> deadline for exiting
+        self.respawn_at = 0.0
+
+    def log(self, message):
+        print(f"[master {os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.listener_fd, self.host, self.port)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            # A normal interpreter exit, not os._exit(), so atexit hooks such as
+            # the write-behind flush run and the hashing pool is shut down
+            sys.exit(status)
+        self.workers[pid] = time.monotonic()
+        self.log(f"started worker {pid}")
+
+    def drain(self, pid):
+        self.workers.pop(pid, None)
+        self.draining[pid] = time.monotonic() + self.graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            self.draining.pop(pid, None)
+            if started is not None:
+                self.log(f"worker {pid} exited unexpectedly ({os.waitstatus_to_exitcode(status)})")
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    self.respawn_at = time.monotonic() + MIN_WORKER_LIFETIME
+
+    def manage_workers(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.draining.items()):
+            if now > deadline:
+                self.log(f"killing worker {pid} after the graceful timeout")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.draining[pid] = float('inf')
+
+        while len(self.workers) > self.size:
+            self.drain(min(self.workers, key=self.workers.get))
+        if now >= self.respawn_at:
+            while len(self.workers) < self.size:
+                self.spawn()
+
+    def reload(self):
+        """Re-exec the master on new code; the new master drains the current workers"""
+        # app.py sits next to this file, which needn't be the working directory
+        path = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                             os.environ.get('PYTHONPATH')]))
+        check = subprocess.run([sys.executable, '-c', 'import app'], capture_output=True,
+                               text=True, env=dict(os.environ, PYTHONPATH=path))
+        if check.returncode != 0:
+            self.log(f"reload aborted, app failed to import:\n{check.stderr}")
+            return
+        self.log("reloading")
+        os.set_inheritable(self.listener_fd, True)
+        old_workers = list(self.workers) + list(self.draining)
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.listener_fd)
+        env[OLD_WORKERS_ENV] = ','.join(map(str, old_workers))
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    def stop(self):
+        self.log("shutting down")
+        self.size = 0
+        self.manage_workers()
+        while self.draining:
+            self.reap()
+            self.manage_workers()
+            time.sleep(0.1)
+
+    def run(self, old_workers=()):
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        # The wakeup fd carries the signal numbers; the handlers only need to exist
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGTTIN,
+                       signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, lambda signum, frame: None)
+
+        self.manage_workers()
+        for pid in old_workers:
+            self.drain(pid)
+        self.log(f"serving on {self.host}:{self.port} with {self.size} workers")
+
+        while True:
+            ready, _, _ = select.select([wakeup_read], [], [], 1.0)
+            signums = os.read(wakeup_read, 64) if ready else b''
+            for signum in signums:
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGTTIN:
+                    self.size += 1
+                elif signum == signal.SIGTTOU:
+                    self.size = max(1, self.size - 1)
+            self.reap()
+            self.manage_workers()
+
+
+@click.command()
+@click.option('--bind', help='host:port to listen on [SERVER_BIND]')
+@click.option('--workers', type=int, help='Worker processes, 0 for one per core [SERVER_WORKERS]')
+def main(bind, workers):
+    """Run the app with a preforked pool of worker processes"""
+    from app import app, init_db
+
+    load_config(app, DEFAULT_CONFIG)
+    host, port = parse_bind(bind or app.config['SERVER_BIND'])
+    size = workers if workers is not None else app.config['SERVER_WORKERS']
+    size = size or cpu_count()
+    hasher = app.extensions['password_hasher']
+    if hasher.workers and 'PASSWORD_HASH_WORKERS' not in os.environ:
+        # Every worker has its own hashing pool; together they shouldn't outnumber the cores
+        hasher.workers = max(1, cpu_count() // size)
+
+    if app.extensions.pop('write_behind', None) is not None:
+        # A read served by another worker, or by a new worker during a
+        # reload, wouldn't wait for writes queued in this one
+        app.config['WRITE_BEHIND'] = False
+        print("WRITE_BEHIND is ignored by the prefork server; writes commit inline",
+              file=sys.stderr)
+
+    for version, description in init_db():
+        print(f"Applied migration {version}: {description}", file=sys.stderr)
+    # Connections opened while preloading must not be shared with the workers
+    get_pool(app).close_all()
+
+    old_workers = []
+    if LISTEN_FD_ENV in os.environ:
+        listener_fd = int(os.environ.pop(LISTEN_FD_ENV))
+        old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid]
+    else:
+        metrics.clear_snapshots(app)
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        listener = socket.create_server((host, port), family=family, backlog=LISTEN_BACKLOG)
+        listener_fd = listener.detach()
+    os.set_inheritable(listener_fd, False)
+
+    Master(app, listener_fd, host, port, size, app.config['SERVER_GRACEFUL_TIMEOUT']).run(old_workers)
+
+
+if __name__ == '__main__':
+    main()
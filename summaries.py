@@ -0,0 +1,192 @@
+"""Two-tier cache for generated paper summaries
+
+Summaries are keyed on the paper's DOI, or its normalized title when there
+is no DOI. Lookups go to an in-process LRU bounded by the approximate size
+of the cached summaries, then to the summary_cache table (migration 7),
+and only then to the generator. Rows carry the generator version they were
+made with and an expiry time; rows from another version or past their
+expiry count as misses and are overwritten. Concurrent misses for the same
+key wait on the one generation already running instead of starting their own.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from catalog import normalize
+from db import get_pool, load_config, transaction
+
+DEFAULT_CONFIG = {
+    'SUMMARY_CACHE_MAX_BYTES': 8 * 1024 * 1024,
+    'SUMMARY_CACHE_TTL': 30 * 24 * 3600,
+    # Bump when the summary generator changes to invalidate every cached summary
+    'SUMMARY_CACHE_VERSION': '1',
+}
+
+
+def summary_key(title, doi=None):
+    doi = str(doi or '').strip()
+    if doi:
+        return 'doi:' + doi.lower()
+    return 'title:' + normalize(title)
+
+
+class SummaryCache:
+    """LRU in front of the summary_cache table, with single-flight generation"""
+
+    def __init__(self, pool, version='1', ttl=30 * 24 * 3600, max_bytes=8 * 1024 * 1024):
+        self.pool = pool
+        self.version = version
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # key -> (summary, expires_at, size)
+        self._bytes = 0
+        self._inflight = {}  # key -> Future of the running generation
+        self._lock = threading.Lock()
+
+    def get(self, key, generate):
+        """Return (summary, cached) for key, calling generate() at most once per miss"""
+        summary = self._memory_get(key)
+        if summary is not None:
+            return summary, True
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result(), True
+
+        try:
+            summary, cached = self._load_or_generate(key, generate)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(summary)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return summary, cached
+
+    def _load_or_generate(self, key, generate):
+        summary, expires_at, size = self._db_get(key)
+        if summary is not None:
+            with self._lock:
+                self.db_hits += 1
+            self._memory_put(key, summary, expires_at, size)
+            return summary, True
+
+        with self._lock:
+            self.misses += 1
+        summary = generate()
+        payload = json.dumps(summary)
+        expires_at = time.time() + self.ttl
+        self._db_put(key, payload, expires_at)
+        self._memory_put(key, summary, expires_at, len(payload))
+        return summary, False
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            summary, expires_at, size = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return summary
+
+    def _memory_put(self, key, summary, expires_at, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (summary, expires_at, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def _db_get(self, key):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                """SELECT payload, expires_at FROM summary_cache
+                   WHERE cache_key = ? AND version = ? AND expires_at > ?""",
+                (key, self.version, time.time())
+            ).fetchone()
+        if row is None:
+            return None, None, None
+        return json.loads(row[0]), row[1], len(row[0])
+
+    def _db_put(self, key, payload, expires_at):
+        with self.pool.connection() as conn:
+            with transaction(conn):
+                conn.execute(
+                    """INSERT INTO summary_cache (cache_key, version, payload, created_at, expires_at)
+                       VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT (cache_key) DO UPDATE SET
+                           version = excluded.version, payload = excluded.payload,
+                           created_at = excluded.created_at, expires_at = excluded.expires_at""",
+                    (key, self.version, payload, time.time(), expires_at)
+                )
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything, from both tiers"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry[2]
+        with self.pool.connection() as conn:
+            with transaction(conn):
+                if key is None:
+                    conn.execute("DELETE FROM summary_cache")
+                else:
+                    conn.execute("DELETE FROM summary_cache WHERE cache_key = ?", (key,))
+
+    def purge(self):
+        """Delete expired rows and rows from other generator versions; returns the count"""
+        with self.pool.connection() as conn:
+            with transaction(conn):
+                cursor = conn.execute(
+                    "DELETE FROM summary_cache WHERE expires_at <= ? OR version != ?",
+                    (time.time(), self.version)
+                )
+        return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+            }
+
+
+def init_app(app):
+    load_config(app, DEFAULT_CONFIG)
+    cache = SummaryCache(
+        get_pool(app),
+        version=app.config['SUMMARY_CACHE_VERSION'],
+        ttl=app.config['SUMMARY_CACHE_TTL'],
+        max_bytes=app.config['SUMMARY_CACHE_MAX_BYTES'],
+    )
+    app.extensions['summary_cache'] = cache
+    return cache
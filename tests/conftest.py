@@ -0,0 +1,90 @@
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py configures itself from the environment when it is imported
+TEST_DIR = tempfile.mkdtemp(prefix='app-tests-')
+os.environ.update({
+    'DATABASE': os.path.join(TEST_DIR, 'test.db'),
+    'SECRET_KEY': 'test-secret-key',
+    'PASSWORD_HASH_WORKERS': '0',
+    'PASSWORD_PBKDF2_ITERATIONS': '1000',
+    'ADMISSION_CONTROL': '0',
+    'WRITE_BEHIND': '0',
+    # Purges run only when a test asks for one, in small batches
+    'RETENTION_INTERVAL': '0',
+    'RETENTION_BATCH_SIZE': '2',
+    'RETENTION_BATCH_PAUSE': '0',
+})
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app as app_module
+    app_module.init_db()
+    yield app_module
+    app_module.db.get_pool(app_module.app).close_all()
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def app(app_module):
+    return app_module.app
+
+
+@pytest.fixture
+def migrated_pool(tmp_path):
+    """A pool over a fresh, fully migrated database of its own"""
+    import compression
+    import migrations
+    from db import ConnectionPool
+
+    pool = ConnectionPool(str(tmp_path / 'migrated.db'), size=2)
+    compression.install(pool)
+    with pool.connection() as conn:
+        migrations.migrate(conn)
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture
+def purger(app):
+    return app.extensions['purger']
+
+
+class Client:
+    """A logged-in test client for a new user; calls return (status, json)"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.username = f'user_{uuid.uuid4().hex[:12]}'
+        status, body = self.call('POST', '/api/auth/register', {
+            'username': self.username, 'email': f'{self.username}@example.org',
+            'password': 'correct horse battery',
+        })
+        assert status == 200, body
+        self.user_id = body['user']['id']
+
+    def call(self, method, url, json=None):
+        response = self.client.open(url, method=method, json=json)
+        try:
+            return response.status_code, response.get_json()
+        finally:
+            response.close()
+
+
+@pytest.fixture
+def make_client(app):
+    return lambda: Client(app)
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
@@ -0,0 +1,130 @@
+import json
+import threading
+
+import pytest
+from flask import Flask, Response, jsonify
+
+import admission
+
+
+def test_buckets_are_charged_only_when_all_admit():
+    limits = admission.AdmissionClass('t', rate=0.001, burst=2, concurrency=1, max_queue=0,
+                                      max_wait=0)
+    user_only = [('user:1', 1)]
+    both = [('ip:a', admission.IP_SHARE_FACTOR), ('user:1', 1)]
+    assert limits.check_rate(both) == 0
+    assert limits.check_rate(user_only) == 0
+
+    # The user's bucket is empty; rejected retries leave the IP's alone
+    for _ in range(5):
+        assert limits.check_rate(both) > 0
+    ip_bucket = limits._buckets['ip:a']
+    assert ip_bucket.tokens == pytest.approx(2 * admission.IP_SHARE_FACTOR - 1, abs=0.01)
+    assert limits.stats()['rate_limited'] == 5
+
+
+def test_concurrency_is_bounded_within_the_latency_budget():
+    limits = admission.AdmissionClass('t', rate=1, burst=1, concurrency=1, max_queue=1,
+                                      max_wait=0.05)
+    assert limits.acquire()
+    # Waits out the budget, then is shed
+    assert not limits.acquire()
+
+    got_slot = []
+    waiter = threading.Thread(target=lambda: got_slot.append(limits.acquire()))
+    limits.max_wait = 5
+    waiter.start()
+    while limits.stats()['waiting'] == 0:
+        pass
+    # The queue is full
+    assert not limits.acquire()
+    limits.release()
+    waiter.join(5)
+    assert got_slot == [True]
+    assert (limits.stats()['admitted'], limits.stats()['shed']) == (2, 2)
+
+
+@pytest.fixture
+def limited_app():
+    app = Flask(__name__)
+    app.config.update(ADMISSION_CONTROL=True, ADMISSION_LIMITS=json.dumps({
+        'test': {'rate': 0.001, 'burst': 2, 'concurrency': 1, 'max_queue': 0, 'max_wait': 0},
+    }))
+
+    @app.route('/limited')
+    @admission.limit('test')
+    def limited():
+        return jsonify({'ok': True})
+
+    @app.route('/stream')
+    @admission.limit('test')
+    def stream():
+        return Response(iter(['a', 'b']))
+
+    @app.route('/padded')
+    @admission.limit('test')
+    def padded():
+        # Like a login for an unknown user: the slot is given back before the idle wait
+        admission.release_slot()
+        app.idle_in_flight = controller.classes['test'].stats()['in_flight']
+        return jsonify({'ok': False}), 401
+
+    controller = admission.init_app(app)
+    return app, controller.classes['test']
+
+
+def test_rate_limit_returns_429_with_retry_after(limited_app):
+    app, limits = limited_app
+    client = app.test_client()
+    statuses = []
+    # Anonymous clients only have the IP bucket: IP_SHARE_FACTOR times the burst
+    for _ in range(2 * admission.IP_SHARE_FACTOR + 1):
+        response = client.get('/limited')
+        statuses.append(response.status_code)
+        response.close()
+    assert statuses == [200] * 2 * admission.IP_SHARE_FACTOR + [429]
+    assert int(response.headers['Retry-After']) >= 1
+    assert limits.stats()['in_flight'] == 0
+
+
+def test_slot_is_held_until_a_streamed_body_is_closed(limited_app):
+    app, limits = limited_app
+    client = app.test_client()
+    response = client.get('/stream', buffered=False)
+    assert limits.stats()['in_flight'] == 1
+    # Another client is shed while the body is still streaming
+    other = client.get('/limited', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other.status_code == 503
+    other.close()
+    response.close()
+    assert limits.stats()['in_flight'] == 0
+
+
+def test_slot_released_early_is_not_released_twice(limited_app):
+    app, limits = limited_app
+    response = app.test_client().get('/padded')
+    assert response.status_code == 401
+    response.close()
+    assert app.idle_in_flight == 0
+    assert limits.stats()['in_flight'] == 0
+    assert limits.acquire()
+
+
+@pytest.mark.parametrize('url', ['/metrics', '/api/admission/stats'])
+def test_operational_endpoints_are_local_only_by_default(app, url):
+    client = app.test_client()
+    assert client.get(url).status_code == 200
+    assert client.get(url, environ_base={'REMOTE_ADDR': '203.0.113.9'}).status_code == 403
+    assert client.get(url, headers={'X-Forwarded-For': '203.0.113.9'}).status_code == 403
+
+
+@pytest.mark.parametrize('url', ['/metrics', '/api/admission/stats'])
+def test_operational_endpoints_accept_the_configured_token(app, url, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape-secret')
+    client = app.test_client()
+    remote = {'REMOTE_ADDR': '203.0.113.9'}
+    assert client.get(url).status_code == 403
+    assert client.get(url, environ_base=remote,
+                      headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get(url, environ_base=remote,
+                      headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
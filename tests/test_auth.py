@@ -0,0 +1,68 @@
+import time
+
+import auth
+from db import get_pool, transaction
+
+
+def add_user(pool, username):
+    with pool.connection() as conn, transaction(conn):
+        return conn.execute(
+            "INSERT INTO users (username, email, password_hash) VALUES (?, ?, 'x')",
+            (username, f'{username}@example.org')).lastrowid
+
+
+def test_profiles_are_served_from_the_cache_until_they_expire(migrated_pool):
+    user_id = add_user(migrated_pool, 'cached')
+    cache = auth.UserCache(migrated_pool, ttl=60)
+    assert cache.get(user_id) == {'id': user_id, 'username': 'cached', 'email': 'cached@example.org'}
+    with migrated_pool.connection() as conn, transaction(conn):
+        conn.execute("UPDATE users SET username = 'renamed' WHERE id = ?", (user_id,))
+    # Stale until invalidated or expired
+    assert cache.get(user_id)['username'] == 'cached'
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1}
+    cache.invalidate(user_id)
+    assert cache.get(user_id)['username'] == 'renamed'
+
+    expiring = auth.UserCache(migrated_pool, ttl=0)
+    expiring.get(user_id)
+    expiring.get(user_id)
+    assert expiring.stats()['misses'] == 2
+
+
+def test_missing_accounts_are_cached_for_the_miss_ttl(migrated_pool):
+    cache = auth.UserCache(migrated_pool, ttl=60, miss_ttl=0.05)
+    assert cache.get(12345) is None
+    assert cache.get(12345) is None
+    assert cache.stats()['hits'] == 1
+    time.sleep(0.06)
+    assert cache.get(12345) is None
+    assert cache.stats()['misses'] == 2
+
+    # put() replaces a cached miss, as registration does
+    cache.put(12345, {'id': 12345, 'username': 'new', 'email': 'new@example.org'})
+    assert cache.get(12345)['username'] == 'new'
+
+
+def test_cache_drops_least_recently_used(migrated_pool):
+    cache = auth.UserCache(migrated_pool, max_size=2)
+    for user_id in (1, 2):
+        cache.put(user_id, {'id': user_id})
+    cache.get(1)
+    cache.put(3, {'id': 3})
+    assert cache.stats()['entries'] == 2
+    assert cache._entries.keys() == {1, 3}
+    cache.invalidate()
+    assert cache.stats()['entries'] == 0
+
+
+def test_deleted_account_loses_its_session(app, client):
+    assert client.call('GET', '/api/auth/me')[0] == 200
+    with get_pool(app).connection() as conn, transaction(conn):
+        conn.execute("DELETE FROM users WHERE id = ?", (client.user_id,))
+    # Other processes only notice once the entry expires
+    assert client.call('GET', '/api/auth/me')[0] == 200
+    auth.get_cache(app).invalidate(client.user_id)
+    assert client.call('GET', '/api/auth/me')[0] == 401
+    # The session was cleared, not just rejected
+    with client.client.session_transaction() as session:
+        assert 'user_id' not in session
@@ -0,0 +1,149 @@
+import threading
+
+import pytest
+
+import catalog
+from db import transaction
+
+
+def paper(doi, title, year=2020, authors=(), keywords=(), abstract='', popularity=0):
+    return {'doi': doi, 'title': title, 'year': year, 'authors': list(authors),
+            'keywords': list(keywords), 'abstract': abstract, 'popularity': popularity}
+
+
+@pytest.fixture
+def paper_catalog(migrated_pool):
+    return catalog.Catalog(migrated_pool, refresh_interval=0)
+
+
+def titles(papers):
+    return [p['title'] for p in papers]
+
+
+def test_search_matches_every_word(paper_catalog):
+    total, papers = paper_catalog.index().search('microgravity protein')
+    assert total == 1
+    assert titles(papers) == ['Protein Crystallization in Microgravity Conditions']
+
+    total, papers = paper_catalog.index().search('microgravity', limit=2)
+    assert total == 3
+    assert len(papers) == 2
+
+
+def test_filters_narrow_the_search(paper_catalog):
+    index = paper_catalog.index()
+    assert titles(index.search('microgravity', year=2021)[1]) == [
+        'Protein Crystallization in Microgravity Conditions']
+    assert titles(index.search('microgravity', author='Brooks')[1]) == [
+        'Muscle Atrophy Prevention Strategies in Microgravity']
+    assert titles(index.search('space', keyword='Radiation')[1]) == [
+        'DNA Repair Mechanisms in Space Radiation Environment']
+    assert index.search('microgravity', year_from=2024)[0] == 0
+
+
+def test_filters_without_a_query_list_newest_first(paper_catalog):
+    total, papers = paper_catalog.index().search('', limit=10, year_from=2022, year_to=2022)
+    assert total == 3
+    assert {p['year'] for p in papers} == {2022}
+    assert paper_catalog.index().search('') == (0, [])
+
+
+def test_catalog_changes_are_picked_up_in_the_background(migrated_pool, paper_catalog,
+                                                        monkeypatch):
+    old = paper_catalog.index()
+    with migrated_pool.connection() as conn:
+        with transaction(conn):
+            catalog.upsert_papers(conn, [paper('10.1/new', 'Tardigrade Survival in Vacuum')])
+
+    building, release = threading.Event(), threading.Event()
+    load_index = catalog.load_index
+
+    def slow_load_index(conn):
+        building.set()
+        release.wait(5)
+        return load_index(conn)
+
+    monkeypatch.setattr(catalog, 'load_index', slow_load_index)
+    # Searches keep the current index while the new one is built
+    assert paper_catalog.index() is old
+    assert building.wait(5)
+    assert paper_catalog.index() is old
+
+    release.set()
+    paper_catalog.refresh()
+    index = paper_catalog.index()
+    assert index is not old
+    assert titles(index.search('tardigrade')[1]) == ['Tardigrade Survival in Vacuum']
+
+
+def test_import_updates_papers_by_doi(paper_catalog):
+    paper_catalog.import_papers([paper('10.1/x', 'Original Title')])
+    paper_catalog.import_papers([paper('10.1/x', 'Revised Title', authors=['Ng, A.'])])
+    index = paper_catalog.index()
+    assert index.search('original')[0] == 0
+    assert titles(index.search('revised', author='Ng')[1]) == ['Revised Title']
+
+
+def test_search_endpoint(app, client):
+    status, body = client.call('GET', '/api/papers/search?q=microgravity&year=2023')
+    assert status == 200
+    assert body['total_matches'] == 2
+    assert all(p['year'] == 2023 for p in body['papers'])
+
+    assert client.call('GET', '/api/papers/search')[1] == {'papers': []}
+    status, body = client.call('GET', '/api/papers/search?q=microgravity&limit=0')
+    assert (status, len(body['papers'])) == (200, 1)
+    status, body = client.call('GET', '/api/papers/search?q=microgravity&limit=100000')
+    assert (status, body['total']) == (200, 3)
+
+
+def completions(papers, query, limit=5):
+    index = catalog.PaperIndex([dict(p, id=i) for i, p in enumerate(papers, 1)])
+    return [index.papers[i]['title'] for i in index.completions.suggest(query, limit)]
+
+
+def test_autocomplete_matches_word_prefixes_of_titles_and_authors():
+    papers = [paper('a', 'Plant Growth on Orbit', authors=['Okafor, C.']),
+              paper('b', 'Transplanted Tissue', authors=['Plantinga, J.']),
+              paper('c', 'Root Gravitropism')]
+    assert completions(papers, 'plant') == ['Transplanted Tissue', 'Plant Growth on Orbit']
+    assert completions(papers, 'ORB') == ['Plant Growth on Orbit']
+    assert completions(papers, 'oka') == ['Plant Growth on Orbit']
+    assert completions(papers, 'lant') == []
+
+
+def test_autocomplete_ranks_by_popularity_then_title_length():
+    papers = [paper('a', 'Radiation Shielding Materials Survey'),
+              paper('b', 'Radiation Dosimetry'),
+              paper('c', 'Radiation Biology Review', popularity=5)]
+    assert completions(papers, 'rad') == ['Radiation Biology Review', 'Radiation Dosimetry',
+                                          'Radiation Shielding Materials Survey']
+    assert completions(papers, 'rad', limit=1) == ['Radiation Biology Review']
+
+
+def test_autocomplete_checks_queries_longer_than_the_keys():
+    long_word = 'a' * catalog.COMPLETION_KEY_LENGTH
+    papers = [paper('a', f'{long_word}x study'), paper('b', f'{long_word}y study')]
+    assert completions(papers, f'{long_word}y') == [f'{long_word}y study']
+
+
+def test_autocomplete_caches_hot_prefixes():
+    completer = catalog.Autocomplete([{'id': 1, 'title': 'Bone Loss', 'authors': []}],
+                                     cache_size=1)
+    assert completer.suggest('bo') == [1]
+    assert completer.suggest('Bo ') == [1]
+    assert (completer.hits, completer.misses) == (1, 1)
+    completer.suggest('lo')
+    completer.suggest('bo')
+    assert (completer.hits, completer.misses) == (1, 3)
+
+
+def test_suggestions_endpoint(client):
+    status, body = client.call('GET', '/api/papers/suggestions?q=micro')
+    assert status == 200
+    assert len(body['suggestions']) == 3
+    assert all('Microgravity' in s['title'] for s in body['suggestions'])
+
+    assert client.call('GET', '/api/papers/suggestions?q=m')[1] == {'suggestions': []}
+    assert len(client.call('GET', '/api/papers/suggestions?q=micro&limit=0')[1]['suggestions']) == 1
+    assert len(client.call('GET', '/api/papers/suggestions?q=micro&limit=x')[1]['suggestions']) == 3
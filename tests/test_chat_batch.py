@@ -0,0 +1,87 @@
+import threading
+
+import app as app_module
+from db import get_pool
+
+
+def stored_messages(app, ids):
+    with get_pool(app).connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, session_id, zunpack(content) FROM chat_history "
+            f"WHERE id IN ({', '.join('?' * len(ids))})", ids
+        ).fetchall()
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def batch(client, messages):
+    return client.call('POST', '/api/chat/session/batch', {'messages': messages})
+
+
+def test_batch_ids_match_the_stored_rows(app, client):
+    first, second = f'first-{client.user_id}', f'second-{client.user_id}'
+    messages = [
+        {'session_id': first, 'role': 'user', 'content': 'q1'},
+        {'session_id': second, 'role': 'user', 'content': 'q2'},
+        {'session_id': first, 'role': 'assistant', 'content': 'a1'},
+        {'session_id': second, 'role': 'assistant', 'content': 'a2'},
+    ]
+    status, body = batch(client, messages)
+    assert status == 200
+    ids = body['message_ids']
+    assert ids == list(range(ids[0], ids[0] + len(messages)))
+    assert stored_messages(app, ids) == {
+        message_id: (m['session_id'], m['content']) for message_id, m in zip(ids, messages)
+    }
+
+
+def test_concurrent_batches_get_contiguous_ids(app, make_client):
+    clients = [make_client() for _ in range(4)]
+    results = []
+
+    def write(client):
+        for round_ in range(5):
+            messages = [{'session_id': f'concurrent-{client.user_id}', 'role': 'user',
+                         'content': f'{client.user_id}/{round_}/{index}'} for index in range(10)]
+            status, body = batch(client, messages)
+            assert status == 200
+            results.append((body['message_ids'], messages))
+
+    threads = [threading.Thread(target=write, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 20
+    for ids, messages in results:
+        assert ids == list(range(ids[0], ids[0] + len(messages)))
+        stored = stored_messages(app, ids)
+        assert [stored[message_id][1] for message_id in ids] == [m['content'] for m in messages]
+
+
+def test_batch_naming_a_foreign_session_writes_nothing(app, make_client):
+    client, other = make_client(), make_client()
+    theirs = f'theirs-{other.user_id}'
+    assert batch(other, [{'session_id': theirs, 'role': 'user', 'content': 'private'}])[0] == 200
+
+    mine = f'mine-{client.user_id}'
+    status, _ = batch(client, [
+        {'session_id': mine, 'role': 'user', 'content': 'fine'},
+        {'session_id': theirs, 'role': 'user', 'content': 'intrusion'},
+    ])
+    assert status == 403
+    with get_pool(app).connection() as conn:
+        assert conn.execute("SELECT count(*) FROM chat_sessions WHERE session_id = ?",
+                            (mine,)).fetchone()[0] == 0
+        assert conn.execute("SELECT count(*) FROM chat_history WHERE session_id = ?",
+                            (theirs,)).fetchone()[0] == 1
+
+
+def test_batch_validation(client, monkeypatch):
+    assert batch(client, [])[0] == 400
+    status, body = batch(client, [{'session_id': 's', 'role': 'user', 'content': 'ok'},
+                                  {'session_id': 's', 'role': 'user'}])
+    assert (status, body['index']) == (400, 1)
+
+    monkeypatch.setattr(app_module, 'MAX_BATCH_MESSAGES', 2)
+    assert batch(client, [{'session_id': 's', 'role': 'user', 'content': 'x'}] * 3)[0] == 413
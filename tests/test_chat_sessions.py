@@ -0,0 +1,49 @@
+from app import PREVIEW_LENGTH
+from db import get_pool
+
+
+def save_message(client, session_id, content, role='user'):
+    status, body = client.call('POST', '/api/chat/session',
+                               {'session_id': session_id, 'role': role, 'content': content})
+    assert status == 200, body
+    return body['message_id']
+
+
+def list_sessions(client):
+    status, body = client.call('GET', '/api/chat/sessions')
+    assert status == 200
+    return {s['session_id']: s for s in body['sessions']}
+
+
+def test_session_list_reports_counts_and_previews(client):
+    session_id = f'counted-{client.user_id}'
+    save_message(client, session_id, 'first question')
+    save_message(client, session_id, 'an answer', role='assistant')
+    save_message(client, session_id, 'x' * (PREVIEW_LENGTH + 50))
+
+    listed = list_sessions(client)[session_id]
+    assert listed['message_count'] == 3
+    assert listed['question_count'] == 2
+    assert listed['first_message_preview'] == 'first question'
+    assert listed['last_message_preview'] == 'x' * PREVIEW_LENGTH
+
+
+def test_sessions_are_counted_separately(client):
+    first, second = f'first-{client.user_id}', f'second-{client.user_id}'
+    save_message(client, first, 'one')
+    save_message(client, second, 'two')
+    save_message(client, second, 'three', role='assistant')
+
+    listed = list_sessions(client)
+    assert (listed[first]['message_count'], listed[first]['question_count']) == (1, 1)
+    assert (listed[second]['message_count'], listed[second]['question_count']) == (2, 1)
+    assert listed[second]['first_message_preview'] == 'two'
+    assert listed[second]['last_message_preview'] == 'three'
+
+
+def test_session_list_is_answered_from_the_covering_index(app):
+    with get_pool(app).connection() as conn:
+        columns = {row[2] for row in conn.execute(
+            "PRAGMA index_info(idx_chat_sessions_user_activity)")}
+    assert {'message_count', 'question_count',
+            'first_message_preview', 'last_message_preview'} <= columns
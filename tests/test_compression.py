@@ -0,0 +1,111 @@
+import compression
+from db import transaction
+
+LONG_TEXT = ('Microgravity slows bone formation in mice, and the effect on osteoblast '
+             'activity was measured over thirty days aboard the station. ') * 4
+
+
+def add_message(conn, codec, content, session_id='s1'):
+    return conn.execute(
+        """INSERT INTO chat_history (user_id, session_id, role, content, model_type)
+           VALUES (1, ?, 'user', ?, 'researcher')""",
+        (session_id, codec.compress(content))).lastrowid
+
+
+def stored(conn, message_id):
+    return conn.execute("SELECT typeof(content), zunpack(content) FROM chat_history WHERE id = ?",
+                        (message_id,)).fetchone()
+
+
+def test_long_values_round_trip_and_short_ones_stay_text(migrated_pool):
+    codec = compression.codec_for(migrated_pool.path)
+    with migrated_pool.connection() as conn, transaction(conn):
+        long_id = add_message(conn, codec, LONG_TEXT)
+        short_id = add_message(conn, codec, 'short µg note')
+        assert stored(conn, long_id) == ('blob', LONG_TEXT)
+        assert stored(conn, short_id) == ('text', 'short µg note')
+        blob = conn.execute("SELECT content FROM chat_history WHERE id = ?", (long_id,)).fetchone()[0]
+        assert len(blob) < len(LONG_TEXT.encode())
+
+
+def test_values_made_with_a_retired_dictionary_stay_readable(migrated_pool):
+    codec = compression.codec_for(migrated_pool.path)
+    with migrated_pool.connection() as conn:
+        with transaction(conn):
+            first = codec.add_dictionary(conn, compression.train_dictionary([LONG_TEXT] * 3))
+            old_id = add_message(conn, codec, LONG_TEXT)
+            second = codec.add_dictionary(conn, b'an unrelated dictionary of other words ' * 20)
+            new_id = add_message(conn, codec, LONG_TEXT)
+        assert first != second and codec.current == second
+
+        # As in a process that loaded its dictionaries before either was trained:
+        # they are read through the connection running zunpack()
+        codec.dictionaries.clear()
+        assert stored(conn, old_id) == ('blob', LONG_TEXT)
+        assert stored(conn, new_id) == ('blob', LONG_TEXT)
+        assert set(codec.dictionaries) == {first, second}
+
+
+def test_recompressing_keeps_the_text(migrated_pool):
+    codec = compression.codec_for(migrated_pool.path)
+    with migrated_pool.connection() as conn:
+        with transaction(conn):
+            # Written before compression was enabled
+            conn.execute("""INSERT INTO chat_history (user_id, session_id, role, content, model_type)
+                            VALUES (1, 's1', 'user', ?, 'researcher')""", (LONG_TEXT,))
+            codec.add_dictionary(conn, compression.train_dictionary([LONG_TEXT] * 3))
+            assert compression.compress_rows(conn, codec, 'chat_history') is not None
+            assert compression.compress_rows(conn, codec, 'chat_history', after_id=1) is None
+        typ, text = stored(conn, 1)
+        assert (typ, text) == ('blob', LONG_TEXT)
+        assert conn.execute("SELECT rowid FROM chat_history_fts WHERE chat_history_fts MATCH 'osteoblast'"
+                            ).fetchall() == [(1,)]
+
+
+def test_full_text_search_reads_through_the_views(migrated_pool):
+    codec = compression.codec_for(migrated_pool.path)
+
+    def matches(conn, query):
+        return [row[0] for row in conn.execute(
+            "SELECT rowid FROM chat_history_fts WHERE chat_history_fts MATCH ? ORDER BY rowid",
+            (query,))]
+
+    with migrated_pool.connection() as conn:
+        with transaction(conn):
+            long_id = add_message(conn, codec, LONG_TEXT)
+            short_id = add_message(conn, codec, 'radiation shielding')
+            conn.execute("""INSERT INTO search_history (user_id, query, model_type, response)
+                            VALUES (1, 'bones', 'researcher', ?)""", (codec.compress(LONG_TEXT),))
+        # Porter stemming applies to the decompressed text
+        assert matches(conn, 'osteoblast') == [long_id]
+        assert matches(conn, 'shield') == [short_id]
+        assert conn.execute("SELECT count(*) FROM search_history_fts WHERE search_history_fts "
+                            "MATCH 'response:microgravity'").fetchone()[0] == 1
+
+        with transaction(conn):
+            conn.execute("UPDATE chat_history SET content = ? WHERE id = ?",
+                         (codec.compress('cosmic rays'), long_id))
+            conn.execute("DELETE FROM chat_history WHERE id = ?", (short_id,))
+        assert matches(conn, 'osteoblast') == []
+        assert matches(conn, 'shield') == []
+        assert matches(conn, 'cosmic') == [long_id]
+
+
+def test_migration_leaves_existing_rows_for_compress_history(tmp_path):
+    import migrations
+    from db import ConnectionPool
+
+    pool = ConnectionPool(str(tmp_path / 'before.db'), size=1)
+    compression.install(pool)
+    with pool.connection() as conn:
+        migrations.migrate(conn, target=10)
+        with transaction(conn):
+            conn.execute("""INSERT INTO chat_history (user_id, session_id, role, content, model_type)
+                            VALUES (1, 's1', 'user', ?, 'researcher')""", (LONG_TEXT,))
+        migrations.migrate(conn)
+        assert stored(conn, 1) == ('text', LONG_TEXT)
+        assert conn.execute("SELECT count(*) FROM compression_dictionaries").fetchone()[0] == 0
+        # The rebuilt index covers rows from before the migration
+        assert conn.execute("SELECT rowid FROM chat_history_fts WHERE chat_history_fts MATCH 'osteoblast'"
+                            ).fetchall() == [(1,)]
+    pool.close_all()
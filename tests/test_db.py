@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from db import ConnectionPool, get_pool, transaction
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=2, timeout=0.1)
+    yield pool
+    pool.close_all()
+
+
+def test_connections_are_configured_once_and_reused(pool):
+    with pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        first = conn
+    with pool.connection() as conn:
+        assert conn is first
+    assert pool.stats() == {'open': 1, 'idle': 1, 'size': 2}
+
+
+def test_pool_size_is_a_bound(pool):
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(sqlite3.OperationalError, match='Timed out'):
+        pool.acquire()
+    for conn in held:
+        pool.release(conn)
+    assert pool.stats()['open'] == 2
+
+
+def test_release_rolls_back_an_open_transaction(pool):
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x)")
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO t VALUES (1)")
+    with pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT count(*) FROM t").fetchone()[0] == 0
+
+
+def test_transaction_commits_or_rolls_back(pool):
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x)")
+        with transaction(conn):
+            conn.execute("INSERT INTO t VALUES (1)")
+        with pytest.raises(ZeroDivisionError):
+            with transaction(conn):
+                conn.execute("INSERT INTO t VALUES (2)")
+                1 / 0
+        assert conn.execute("SELECT x FROM t").fetchall() == [(1,)]
+
+
+def test_forked_process_starts_with_an_empty_pool(pool):
+    with pool.connection() as parent_conn:
+        pass
+    # As seen from a child process after fork()
+    pool._pid = -1
+    with pool.connection() as conn:
+        assert conn is not parent_conn
+    assert pool.stats()['open'] == 1
+
+
+def test_setup_hooks_run_for_each_new_connection(pool):
+    pool.setup.append(lambda conn: conn.create_function('answer', 0, lambda: 42))
+    with pool.connection() as conn:
+        assert conn.execute("SELECT answer()").fetchone()[0] == 42
+
+
+def test_request_connection_is_returned_to_the_pool(app, client):
+    pool = get_pool(app)
+    idle = pool.stats()['idle']
+    assert client.call('GET', '/api/history')[0] == 200
+    assert pool.stats()['idle'] == idle
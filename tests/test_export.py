@@ -0,0 +1,84 @@
+import json
+
+import app as app_module
+
+
+def save_message(client, session_id, content, role='user'):
+    status, body = client.call('POST', '/api/chat/session',
+                               {'session_id': session_id, 'role': role, 'content': content})
+    assert status == 200, body
+
+
+def export(client, url):
+    response = client.client.get(url)
+    try:
+        return response.status_code, response.mimetype, response.get_data(as_text=True)
+    finally:
+        response.close()
+
+
+def test_session_export_streams_valid_json(client, monkeypatch):
+    # Several cursor batches per session
+    monkeypatch.setattr(app_module, 'EXPORT_BATCH_SIZE', 2)
+    session_id = f'export-{client.user_id}'
+    contents = [f'message "{index}"' for index in range(5)]
+    for content in contents:
+        save_message(client, session_id, content)
+
+    status, mimetype, text = export(client, f'/api/chat/export/{session_id}')
+    assert (status, mimetype) == (200, 'application/json')
+    body = json.loads(text)
+    assert body['session_info']['session_id'] == session_id
+    assert body['session_info']['total_messages'] == 5
+    assert [m['content'] for m in body['messages']] == contents
+
+
+def test_export_all_as_ndjson(client):
+    first, second = f'first-{client.user_id}', f'second-{client.user_id}'
+    save_message(client, first, 'question one')
+    save_message(client, second, 'question two')
+    save_message(client, second, 'answer two', role='assistant')
+
+    status, mimetype, text = export(client, '/api/chat/export?format=ndjson')
+    assert (status, mimetype) == (200, 'application/x-ndjson')
+    records = [json.loads(line) for line in text.splitlines()]
+    # Most recently active session first
+    assert [(r['type'], r['session_id']) for r in records] == [
+        ('session', second), ('message', second), ('message', second),
+        ('session', first), ('message', first),
+    ]
+    assert [r['content'] for r in records if r['type'] == 'message'] == [
+        'question two', 'answer two', 'question one']
+
+
+def test_export_all_as_json(client):
+    session_id = f'only-{client.user_id}'
+    save_message(client, session_id, 'hello')
+
+    status, _, text = export(client, '/api/chat/export')
+    assert status == 200
+    sessions = json.loads(text)['sessions']
+    assert [s['session_info']['session_id'] for s in sessions] == [session_id]
+    assert [m['content'] for m in sessions[0]['messages']] == ['hello']
+
+
+def test_export_with_no_sessions_is_empty(client):
+    status, _, text = export(client, '/api/chat/export')
+    assert status == 200
+    assert json.loads(text) == {'sessions': []}
+
+
+def test_export_excludes_deleted_and_foreign_sessions(make_client):
+    client, other = make_client(), make_client()
+    deleted, theirs = f'deleted-{client.user_id}', f'theirs-{other.user_id}'
+    save_message(client, deleted, 'gone')
+    save_message(other, theirs, 'private')
+    assert client.call('DELETE', f'/api/chat/session/{deleted}')[0] == 200
+
+    assert export(client, f'/api/chat/export/{deleted}')[0] == 404
+    assert export(client, f'/api/chat/export/{theirs}')[0] == 404
+    assert json.loads(export(client, '/api/chat/export')[2]) == {'sessions': []}
+
+
+def test_export_rejects_unknown_format(client):
+    assert export(client, '/api/chat/export?format=csv')[0] == 400
@@ -0,0 +1,295 @@
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as app_module
+import llm
+
+# path -> (status, content type, body)
+STUB_RESPONSES = {
+    '/sse': (200, 'text/event-stream',
+             'data: {"delta": "Hel"}\n\ndata: {"delta": "lo"}\n\ndata: [DONE]\n\n'),
+    '/ndjson': (200, 'application/x-ndjson',
+                '{"type": "begin"}\n{"type": "item", "content": "n8n "}\n'
+                '{"type": "item", "content": "answer"}\n{"type": "end"}\n'),
+    '/json': (200, 'application/json', '{"output": "whole answer"}'),
+    '/text': (200, 'text/plain; charset=utf-8', 'plain µg text'),
+    '/sse-error': (200, 'text/event-stream', 'data: {"type": "error", "message": "boom"}\n\n'),
+    '/fail': (500, 'text/plain', 'internal error'),
+}
+
+
+class StubUpstream(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.requests.append((self.client_address, json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))))
+        status, content_type, body = STUB_RESPONSES[self.path]
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubUpstream)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client_for(upstream):
+    clients = []
+
+    def make(path, **options):
+        url = f'http://127.0.0.1:{upstream.server_port}{path}'
+        llm_client = llm.LLMClient({'researcher': url}, **options)
+        clients.append(llm_client)
+        return llm_client
+
+    yield make
+    for llm_client in clients:
+        llm_client.close()
+
+
+@pytest.mark.parametrize('path, chunks', [
+    ('/sse', ['Hel', 'lo']),
+    ('/ndjson', ['n8n ', 'answer']),
+    ('/json', ['whole answer']),
+    ('/text', ['plain µg text']),
+])
+def test_upstream_formats_are_streamed_as_text(client_for, path, chunks):
+    assert list(client_for(path).stream('researcher', 'hi', 's1')) == chunks
+
+
+def test_keep_alive_connection_is_reused(upstream, client_for):
+    llm_client = client_for('/sse')
+    for _ in range(3):
+        assert ''.join(llm_client.stream('researcher', 'hi', 's1')) == 'Hello'
+    assert len({address for address, _ in upstream.requests}) == 1
+    assert upstream.requests[0][1] == {'action': 'sendMessage', 'chatInput': 'hi',
+                                       'sessionId': 's1', 'model': 'researcher'}
+
+
+@pytest.mark.parametrize('path', ['/fail', '/sse-error'])
+def test_upstream_failures_raise(client_for, path):
+    with pytest.raises(llm.UpstreamError):
+        list(client_for(path).stream('researcher', 'hi', 's1'))
+
+
+def test_unreachable_upstream_raises():
+    llm_client = llm.LLMClient({'researcher': 'http://127.0.0.1:9/'}, connect_timeout=1)
+    with pytest.raises(llm.UpstreamError):
+        list(llm_client.stream('researcher', 'hi', 's1'))
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    """Patch the app's upstream call; returns the list of prompts it was sent"""
+    prompts = []
+
+    def stream(model, message, session_id):
+        prompts.append(message)
+        if 'fail' in message:
+            yield 'partial'
+            raise llm.UpstreamError('upstream went away')
+        yield 'Hello'
+        yield ' world'
+
+    monkeypatch.setattr(app_module.llm_client, 'stream', stream)
+    return prompts
+
+
+def sse_events(text):
+    events = []
+    for block in text.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.splitlines())
+        events.append((lines.get('event', 'message'), json.loads(lines['data'])))
+    return events
+
+
+def complete(client, payload):
+    response = client.client.post('/api/chat/complete', json=payload)
+    try:
+        return response.status_code, response.mimetype, response.get_data(as_text=True)
+    finally:
+        response.close()
+
+
+def test_streamed_completion_is_saved_to_the_session(client, fake_upstream):
+    session_id = f'llm-{client.user_id}'
+    prompt = f'question {uuid.uuid4()}'
+    status, mimetype, text = complete(client, {'message': prompt, 'session_id': session_id})
+    assert (status, mimetype) == (200, 'text/event-stream')
+
+    events = sse_events(text)
+    assert events[:2] == [('message', {'token': 'Hello'}), ('message', {'token': ' world'})]
+    done_event, done = events[2]
+    assert done_event == 'done'
+    assert (done['session_id'], done['source'], len(done['message_ids'])) == (session_id, 'upstream', 2)
+
+    status, body = client.call('GET', f'/api/chat/session/{session_id}')
+    assert [(m['role'], m['content']) for m in body['messages']] == [
+        ('user', prompt), ('assistant', 'Hello world')]
+
+
+def test_non_streamed_completion(client, fake_upstream):
+    status, body = client.call('POST', '/api/chat/complete',
+                               {'message': f'q {uuid.uuid4()}', 'stream': False})
+    assert status == 200
+    assert (body['response'], body['source'], len(body['message_ids'])) == ('Hello world', 'upstream', 2)
+
+
+def test_upstream_failure_ends_the_stream_with_an_error(client, fake_upstream):
+    session_id = f'failed-{client.user_id}'
+    _, _, text = complete(client, {'message': f'fail {uuid.uuid4()}', 'session_id': session_id})
+    assert sse_events(text)[-1] == ('error', {'error': 'Upstream model unavailable'})
+    # Nothing is saved for an unfinished answer
+    assert client.call('GET', f'/api/chat/session/{session_id}')[0] == 404
+
+    status, _ = client.call('POST', '/api/chat/complete',
+                            {'message': f'fail {uuid.uuid4()}', 'stream': False})
+    assert status == 502
+
+
+def test_anonymous_completion_is_not_saved(app, fake_upstream):
+    anonymous = app.test_client()
+    response = anonymous.post('/api/chat/complete',
+                              json={'message': f'q {uuid.uuid4()}', 'stream': False})
+    try:
+        assert response.status_code == 200
+        assert response.get_json()['message_ids'] == []
+    finally:
+        response.close()
+
+
+def test_completion_validation(make_client, fake_upstream):
+    client, other = make_client(), make_client()
+    theirs = f'theirs-{other.user_id}'
+    other.call('POST', '/api/chat/session', {'session_id': theirs, 'role': 'user', 'content': 'x'})
+
+    assert client.call('POST', '/api/chat/complete', {'message': ' '})[0] == 400
+    assert client.call('POST', '/api/chat/complete', {'message': 'q', 'model_type': 'nope'})[0] == 400
+    assert client.call('POST', '/api/chat/complete',
+                       {'message': 'q', 'session_id': theirs})[0] == 404
+    assert fake_upstream == []
+
+
+def test_cache_key_normalizes_prompt_and_filter_order():
+    assert llm.cache_key('researcher', '  What is  Microgravity?\n[Filter context: year=2023, author=Lee]') == \
+        llm.cache_key('researcher', 'what is microgravity?\n[Filter context: author=Lee,year=2023]')
+    assert llm.cache_key('student', 'q') != llm.cache_key('researcher', 'q')
+
+
+def lead(cache, key, chunks):
+    state, flight = cache.lookup(key)
+    assert state == 'miss'
+    # Leads wrap LLMClient.stream() generators
+    return llm.Lead(cache, key, flight, (text for text in chunks)), flight
+
+
+def test_finished_answers_are_cached_by_encoded_size():
+    cache = llm.ResponseCache(max_bytes=10)
+    chunks, _ = lead(cache, 'ascii', ['0123', '4567'])
+    assert list(chunks) == ['0123', '4567']
+    assert cache.lookup('ascii') == ('hit', '01234567')
+
+    # Six characters, twelve bytes: over the bound
+    chunks, _ = lead(cache, 'wide', ['µµµ', 'µµµ'])
+    list(chunks)
+    assert cache.lookup('wide')[0] == 'miss'
+    assert cache.stats()['bytes'] == 8
+
+
+def test_cache_evicts_oldest_and_expires():
+    cache = llm.ResponseCache(max_bytes=10)
+    for key in ('a', 'b', 'c'):
+        list(lead(cache, key, ['xxxx'])[0])
+    assert (cache.stats()['entries'], cache.stats()['bytes']) == (2, 8)
+    assert cache.lookup('a')[0] == 'miss'
+
+    expiring = llm.ResponseCache(ttl=0)
+    list(lead(expiring, 'k', ['answer'])[0])
+    assert expiring.lookup('k')[0] == 'miss'
+
+
+def test_followers_get_every_chunk_of_the_shared_call():
+    cache = llm.ResponseCache()
+    chunks, flight = lead(cache, 'k', ['one ', 'two ', 'three'])
+    assert next(chunks) == 'one '
+
+    state, shared = cache.lookup('k')
+    assert (state, shared) == ('shared', flight)
+    followed = []
+    follower = threading.Thread(target=lambda: followed.extend(shared.follow(timeout=5)))
+    follower.start()
+    assert list(chunks) == ['two ', 'three']
+    follower.join(5)
+    assert followed == ['one ', 'two ', 'three']
+    assert cache.stats()['in_flight'] == 0
+
+
+def test_follower_times_out_on_a_stalled_leader():
+    flight = llm.Flight()
+    flight.publish('partial')
+    following = flight.follow(timeout=0.05)
+    assert next(following) == 'partial'
+    with pytest.raises(llm.UpstreamError, match='Timed out'):
+        next(following)
+
+
+def test_leader_failure_reaches_followers_and_is_not_cached():
+    cache = llm.ResponseCache()
+
+    def failing():
+        yield 'partial'
+        raise llm.UpstreamError('connection reset')
+
+    state, flight = cache.lookup('k')
+    chunks = llm.Lead(cache, 'k', flight, failing())
+    with pytest.raises(llm.UpstreamError):
+        list(chunks)
+    with pytest.raises(llm.UpstreamError, match='connection reset'):
+        list(flight.follow(timeout=1))
+    assert cache.lookup('k')[0] == 'miss'
+
+
+def test_lead_that_never_starts_releases_its_flight():
+    cache = llm.ResponseCache()
+    chunks, flight = lead(cache, 'closed', ['never read'])
+    chunks.close()
+    with pytest.raises(llm.UpstreamError, match='abandoned'):
+        list(flight.follow(timeout=1))
+
+    # Dropped without iteration or close(), as when a response is never sent
+    chunks, flight = lead(cache, 'dropped', ['never read'])
+    del chunks
+    with pytest.raises(llm.UpstreamError, match='abandoned'):
+        list(flight.follow(timeout=1))
+    assert cache.stats()['in_flight'] == 0
+    assert cache.lookup('closed')[0] == 'miss'
+
+
+def test_identical_prompts_share_one_upstream_call(client, fake_upstream):
+    prompt = f'canned question {uuid.uuid4()}'
+    first = client.call('POST', '/api/chat/complete', {'message': prompt, 'stream': False})[1]
+    again = client.call('POST', '/api/chat/complete', {'message': prompt.upper(), 'stream': False})[1]
+    fresh = client.call('POST', '/api/chat/complete',
+                        {'message': prompt, 'stream': False, 'cache': False})[1]
+    assert [first['source'], again['source'], fresh['source']] == ['upstream', 'cache', 'upstream']
+    assert again['response'] == 'Hello world'
+    assert len(fake_upstream) == 2
@@ -0,0 +1,66 @@
+import json
+
+import metrics
+from db import ConnectionPool
+
+
+def scrape(app):
+    response = app.test_client().get('/metrics')
+    try:
+        assert response.status_code == 200
+        return response.get_data(as_text=True)
+    finally:
+        response.close()
+
+
+def test_requests_and_statements_are_exported(app, client):
+    client.call('GET', '/api/auth/me')
+    text = scrape(app)
+    assert '# TYPE http_requests_total counter' in text
+    assert 'http_requests_total{endpoint="get_current_user",method="GET",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{endpoint="get_current_user",le="+Inf"}' in text
+    # Registering the client inserted the user; /me was served from the cache
+    assert 'db_statements_total{statement="INSERT INTO users' in text
+    assert 'cache_hits_total{cache="user"}' in text
+    assert 'db_pool_connections{state="open"}' in text
+
+
+def test_metered_cursor_counts_executions_and_rows(tmp_path):
+    registry = metrics.Registry()
+    pool = ConnectionPool(str(tmp_path / 'metered.db'), size=1)
+    pool.factory = type('MeteredConnection', (metrics.MeteredConnection,), {'registry': registry})
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.executemany("INSERT INTO t VALUES (?)", [(1,), (2,), (3,)])
+        assert [row[0] for row in conn.execute("SELECT   x\n FROM t")] == [1, 2, 3]
+        conn.execute("SELECT x FROM t").fetchone()
+    pool.close_all()
+
+    executions, _, rows = registry.statements['INSERT INTO t VALUES (?)']
+    assert (executions, rows) == (3, 3)
+    # Whitespace is collapsed; iterated rows are counted when the cursor is exhausted
+    executions, _, rows = registry.statements['SELECT x FROM t']
+    assert (executions, rows) == (2, 4)
+
+
+def test_snapshots_from_other_workers_are_added_up(app, tmp_path):
+    registry = metrics.Registry()
+    registry.inc('retention_sessions_archived_total', value=2)
+    registry.add_gauge('write_behind_pending', value=1)
+    collector = metrics.Metrics(app, registry, directory=str(tmp_path))
+    other = {'counters': [['retention_sessions_archived_total', [], 3]],
+             'gauges': [['write_behind_pending', [], 7]],
+             'histograms': [], 'buckets': {}}
+    # A pid that can't be running: its counters still count, its gauges don't
+    (tmp_path / '999999999.json').write_text(json.dumps(other))
+    (tmp_path / 'stray.txt').write_text('ignored')
+
+    text = collector.render()
+    assert 'retention_sessions_archived_total 5' in text.splitlines()
+    assert 'write_behind_pending 1' in text.splitlines()
+
+
+def test_label_values_are_escaped():
+    assert metrics.format_labels((('statement', 'a "b"\\\n'),)) == '{statement="a \\"b\\"\\\\\\n"}'
+    assert metrics.format_labels(()) == ''
+    assert metrics.format_value(0.5) == '0.5'
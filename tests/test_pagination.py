@@ -0,0 +1,110 @@
+import base64
+import sqlite3
+
+import pytest
+
+from pagination import (MAX_PAGE_SIZE, CursorError, decode_cursor, encode_cursor,
+                        fetch_page, page_params)
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, owner, timestamp)")
+    # Ids 3-5 share a timestamp; ids are not in timestamp order
+    conn.executemany("INSERT INTO events (id, owner, timestamp) VALUES (?, 1, ?)", [
+        (1, '2024-01-01 10:00:00'), (2, '2024-01-01 09:00:00'),
+        (3, '2024-01-01 11:00:00'), (4, '2024-01-01 11:00:00'), (5, '2024-01-01 11:00:00'),
+        (6, '2024-01-01 12:00:00'), (7, '2024-01-01 08:00:00'),
+    ])
+    conn.execute("INSERT INTO events (id, owner, timestamp) VALUES (8, 2, '2024-01-01 10:30:00')")
+    yield conn
+    conn.close()
+
+
+# Ids in (timestamp, id) order for owner 1
+OLDEST_FIRST = [7, 2, 1, 3, 4, 5, 6]
+
+
+def page(conn, newest_first=True, **args):
+    rows, info = fetch_page(conn, "owner", "events", "owner = ?", (1,), "timestamp",
+                            page_params(args, default_limit=2), newest_first=newest_first)
+    return [row[-1] for row in rows], info
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('2024-01-01 11:00:00', 42)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == ('2024-01-01 11:00:00', 42)
+    # Only the last separator splits the row id off
+    assert decode_cursor(encode_cursor('a|b', 7)) == ('a|b', 7)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64 !',
+    base64.urlsafe_b64encode(b'no separator').decode(),
+    base64.urlsafe_b64encode(b'2024-01-01|not-an-id').decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe|1').decode(),
+])
+def test_tampered_cursors_are_rejected(cursor):
+    with pytest.raises(CursorError):
+        decode_cursor(cursor)
+
+
+def test_page_params_validation():
+    with pytest.raises(CursorError):
+        page_params({'before': encode_cursor('x', 1), 'after': encode_cursor('y', 2)})
+    with pytest.raises(CursorError):
+        page_params({'limit': 'ten'})
+    assert page_params({'limit': '0'})['limit'] == 1
+    assert page_params({'limit': '100000'})['limit'] == MAX_PAGE_SIZE
+
+
+def test_before_walks_every_row_once_across_timestamp_ties(conn):
+    seen, info = page(conn)
+    assert seen == [6, 5]
+    while info['has_more']:
+        ids, info = page(conn, before=info['before'])
+        seen += ids
+    assert seen == OLDEST_FIRST[::-1]
+
+
+def test_after_walks_back_towards_newer_rows(conn):
+    ids, info = page(conn, before=encode_cursor('2024-01-01 09:00:00', 2))
+    assert ids == [7]
+    seen = []
+    while True:
+        ids, info = page(conn, after=info['after'])
+        if not ids:
+            break
+        # Pages stay newest-first whichever way they were fetched
+        assert ids == sorted(ids, key=OLDEST_FIRST.index, reverse=True)
+        seen = ids + seen
+    assert seen == OLDEST_FIRST[:0:-1]
+
+
+def test_oldest_first_pages(conn):
+    ids, info = page(conn, newest_first=False)
+    assert ids == [5, 6]
+    ids, info = page(conn, newest_first=False, before=info['before'])
+    assert ids == [3, 4]
+    ids, _ = page(conn, newest_first=False, after=info['after'])
+    assert ids == [5, 6]
+
+
+def test_empty_page_has_no_cursors(conn):
+    ids, info = page(conn, after=encode_cursor('2024-01-01 12:00:00', 6))
+    assert ids == []
+    assert info == {'limit': 2, 'has_more': False, 'before': None, 'after': None}
+
+
+@pytest.mark.parametrize('url', [
+    '/api/history?before=garbage',
+    '/api/chat/sessions?after=garbage',
+    '/api/chat/session/any?before=garbage',
+    '/api/history?limit=many',
+])
+def test_endpoints_reject_bad_cursors(client, url):
+    status, body = client.call('GET', url)
+    assert status == 400
+    assert 'error' in body
@@ -0,0 +1,26 @@
+import passwords
+
+
+def test_unknown_users_are_padded_to_the_measured_verify_time():
+    hasher = passwords.PasswordHasher(passwords.hash_method('pbkdf2', iterations=1000), workers=0)
+    # Nothing measured yet: a real verification is the padding
+    assert hasher.unknown_user_delay() == 0
+    measured = hasher._verify_seconds
+    assert measured > 0
+    assert hasher.unknown_user_delay() == measured
+
+
+def test_needs_rehash_when_the_method_changes():
+    old = passwords.PasswordHasher(passwords.hash_method('pbkdf2', iterations=1000), workers=0)
+    new = passwords.PasswordHasher(passwords.hash_method('scrypt', n=2 ** 4), workers=0)
+    password_hash = old.hash('secret')
+    assert old.verify(password_hash, 'secret') and not old.verify(password_hash, 'wrong')
+    assert not old.needs_rehash(password_hash)
+    assert new.needs_rehash(password_hash)
+    assert new.verify(password_hash, 'secret')
+
+
+def test_unknown_username_is_rejected_like_a_wrong_password(client):
+    status, body = client.call('POST', '/api/auth/login',
+                               {'username': f'nobody-{client.user_id}', 'password': 'x'})
+    assert (status, body) == (401, {'error': 'Invalid credentials'})
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+
+import pytest
+from flask import Flask, jsonify
+
+import db
+import profiling
+
+
+@pytest.fixture
+def profiled_app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(DATABASE=str(tmp_path / 'profiled.db'), PROFILE_TOKEN='profile-secret',
+                      PROFILE_DIR=str(tmp_path / 'profiles'), PROFILE_MAX_TRACES=2,
+                      SLOW_QUERY_MS=1e-6, SLOW_QUERY_LOG='')
+    db.init_app(app)
+    # Before any connection is opened, so they all report their statements
+    profiling.init_app(app)
+    with db.get_pool(app).connection() as conn:
+        conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+        conn.execute("INSERT INTO items (name) VALUES ('first')")
+        conn.commit()
+
+    @app.route('/items/<int:item_id>')
+    def item(item_id):
+        row = db.get_db().execute("SELECT name FROM items WHERE id = ?", (item_id,)).fetchone()
+        return jsonify({'name': row[0]})
+
+    yield app
+    db.get_pool(app).close_all()
+
+
+def get(app, url, **kwargs):
+    response = app.test_client().get(url, **kwargs)
+    try:
+        assert response.status_code == 200
+        return response.headers.get('X-Profile-Id')
+    finally:
+        response.close()
+
+
+def test_requests_with_the_token_are_traced(profiled_app):
+    assert get(profiled_app, '/items/1') is None
+    assert get(profiled_app, '/items/1', headers={'X-Profile': 'wrong'}) is None
+
+    trace_id = get(profiled_app, '/items/1', headers={'X-Profile': 'profile-secret'})
+    with open(f"{profiled_app.config['PROFILE_DIR']}/{trace_id}.json") as f:
+        trace = json.load(f)
+    assert (trace['trigger'], trace['endpoint'], trace['status']) == ('header', 'item', 200)
+    statement, = [s for s in trace['statements'] if s['sql'].startswith('SELECT name')]
+    assert statement['parameters'] == ['int']
+    assert any('items' in line for line in statement['plan'])
+    assert 'cumulative' in trace['profile']
+
+
+def test_only_the_newest_traces_are_kept(profiled_app):
+    trace_ids = [get(profiled_app, '/items/1', headers={'X-Profile': 'profile-secret'})
+                 for _ in range(3)]
+    assert sorted(os.listdir(profiled_app.config['PROFILE_DIR'])) == \
+        [f'{trace_id}.json' for trace_id in trace_ids[1:]]
+
+
+def test_slow_queries_are_logged_with_parameter_shapes_only(profiled_app):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    profiling.slow_query_logger.addHandler(handler)
+    try:
+        get(profiled_app, '/items/1')
+    finally:
+        profiling.slow_query_logger.removeHandler(handler)
+
+    entries = [json.loads(record.getMessage()) for record in records]
+    entry, = [e for e in entries if e['sql'].startswith('SELECT name')]
+    assert (entry['route'], entry['parameters']) == ('item', ['int'])
+
+
+def test_parameter_shape():
+    assert profiling.parameter_shape((1, 'secret', None, b'xy', 1.5)) == \
+        ['int', 'str[6]', 'null', 'bytes[2]', 'float']
+    assert profiling.parameter_shape({'name': 'abc'}) == {'name': 'str[3]'}
+    assert profiling.parameter_shape([(1, 'a'), (2, 'b')], many=True) == \
+        {'rows': 2, 'first': ['int', 'str[1]']}
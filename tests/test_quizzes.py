@@ -0,0 +1,148 @@
+import uuid
+
+import app as app_module
+from db import get_pool
+
+
+def new_title():
+    return f'Paper {uuid.uuid4().hex[:8]}'
+
+
+def generate(client, paper_title, **options):
+    status, body = client.call('POST', '/api/papers/quiz', dict(options, paper_title=paper_title))
+    assert status == 200, body
+    return body
+
+
+def submit(client, quiz_id, answers):
+    status, body = client.call('POST', '/api/quiz/submit', {'quiz_id': quiz_id, 'answers': answers})
+    assert status == 200, body
+    return body
+
+
+def test_quiz_length_is_clamped_to_what_the_generator_makes(client):
+    title = new_title()
+    available = len(app_module.QUIZ_QUESTION_BANK)
+    longest = generate(client, title, num_questions=available)
+    assert longest['total_questions'] == available
+    # Asking for more can't store the same questions under another quiz
+    assert generate(client, title, num_questions=available + 1)['quiz_id'] == longest['quiz_id']
+    assert generate(client, title, num_questions=100)['quiz_id'] == longest['quiz_id']
+    assert generate(client, title, num_questions=0)['total_questions'] == 1
+    assert title in longest['questions'][0]['question']
+
+
+def test_stored_quiz_is_reused_per_paper_and_length(client):
+    title = new_title()
+    quiz = generate(client, title, num_questions=3)
+    assert generate(client, f'  {title.upper()} ', num_questions=3)['quiz_id'] == quiz['quiz_id']
+    assert generate(client, title, num_questions=2)['quiz_id'] != quiz['quiz_id']
+    assert 'correct' not in quiz['questions'][0]
+
+
+def test_submission_is_graded_against_the_stored_key(client):
+    quiz = generate(client, new_title(), num_questions=3)
+    key = [q['correct'] for q in app_module.QUIZ_QUESTION_BANK[:3]]
+
+    result = submit(client, quiz['quiz_id'], {'0': key[0], '1': key[1], '2': 'Z'})
+    assert (result['score'], result['total'], result['passed']) == (2, 3, False)
+    assert [r['correct'] for r in result['results']] == [True, True, False]
+
+    status, body = client.call('GET', '/api/quiz/history')
+    assert status == 200
+    assert body['history'][0]['quiz_id'] == quiz['quiz_id']
+    assert body['history'][0]['percentage'] == 66.7
+
+
+def test_quiz_validation(client):
+    assert client.call('POST', '/api/papers/quiz', {'paper_title': ' '})[0] == 400
+    assert client.call('POST', '/api/papers/quiz',
+                       {'paper_title': 'x', 'num_questions': 'many'})[0] == 400
+    assert client.call('POST', '/api/quiz/submit', {'quiz_id': 10 ** 9, 'answers': {'0': 'A'}})[0] == 404
+    assert client.call('POST', '/api/quiz/submit', {'quiz_id': 1, 'answers': {}})[0] == 400
+
+
+def test_quiz_history_is_read_from_the_covering_index(app):
+    with get_pool(app).connection() as conn:
+        plan = conn.execute(
+            """EXPLAIN QUERY PLAN SELECT paper_title, score, total_questions, timestamp, quiz_id
+               FROM quiz_results WHERE user_id = ? ORDER BY timestamp DESC LIMIT 50""", (1,)
+        ).fetchall()
+    assert any('COVERING INDEX idx_quiz_results_user_ts' in row[3] for row in plan)
+
+
+def answer_key(count):
+    return {str(i): q['correct'] for i, q in enumerate(app_module.QUIZ_QUESTION_BANK[:count])}
+
+
+def take(client, quiz_id, right, total=4):
+    answers = {index: (option if int(index) < right else 'Z')
+               for index, option in answer_key(total).items()}
+    return submit(client, quiz_id, answers)
+
+
+def test_user_stats_follow_each_submission(make_client):
+    client = make_client()
+    assert client.call('GET', '/api/quiz/stats')[1]['stats']['attempts'] == 0
+
+    quiz = generate(client, new_title(), num_questions=4)
+    take(client, quiz['quiz_id'], right=4)
+    take(client, quiz['quiz_id'], right=1)
+
+    status, body = client.call('GET', '/api/quiz/stats')
+    assert status == 200
+    assert body['stats'] == {'attempts': 2, 'passes': 1, 'pass_rate': 50.0,
+                             'average_percentage': 62.5, 'best_percentage': 100.0,
+                             'average_score': 2.5}
+    assert body['last_attempt_at'] is not None
+
+
+def test_paper_stats_and_leaderboard(make_client):
+    first, second = make_client(), make_client()
+    title = new_title()
+    quiz_id = generate(first, title, num_questions=4)['quiz_id']
+    take(first, quiz_id, right=2)
+    take(first, quiz_id, right=3)
+    take(second, quiz_id, right=4)
+
+    status, body = first.call('GET', f'/api/quiz/stats/papers?paper_title={title.lower()}')
+    assert status == 200
+    [paper] = body['papers']
+    assert (paper['paper_title'], paper['attempts'], paper['passes']) == (title, 3, 2)
+
+    status, body = first.call('GET', f'/api/quiz/leaderboard?paper_title={title}')
+    assert status == 200
+    assert [(e['rank'], e['username'], e['percentage'], e['attempts'])
+            for e in body['leaderboard']] == [(1, second.username, 100.0, 1),
+                                              (2, first.username, 75.0, 2)]
+    body = first.call('GET', f'/api/quiz/leaderboard?paper_title={title}&min_attempts=2')[1]
+    assert [e['username'] for e in body['leaderboard']] == [first.username]
+
+    assert first.call('GET', '/api/quiz/stats/papers?sort=newest')[0] == 400
+
+
+def test_summary_tables_match_the_results(app, make_client):
+    client = make_client()
+    quiz_id = generate(client, new_title(), num_questions=4)['quiz_id']
+    for right in (0, 3, 4):
+        take(client, quiz_id, right=right)
+
+    with get_pool(app).connection() as conn:
+        mismatched = conn.execute(
+            """SELECT count(*) FROM quiz_user_stats s JOIN (
+                   SELECT user_id, count(*) AS attempts, sum(score) AS score_sum,
+                          max(score * 100.0 / total_questions) AS best
+                   FROM quiz_results GROUP BY user_id
+               ) r USING (user_id)
+               WHERE s.attempts != r.attempts OR s.score_sum != r.score_sum
+                  OR abs(s.best_percentage - r.best) > 1e-9"""
+        ).fetchone()[0]
+        users = conn.execute("SELECT count(*) FROM quiz_user_stats").fetchone()[0]
+        result_users = conn.execute("SELECT count(DISTINCT user_id) FROM quiz_results").fetchone()[0]
+    assert mismatched == 0
+    assert users == result_users
+
+    status, body = client.call('GET', '/api/quiz/leaderboard?limit=1000')
+    assert status == 200
+    percentages = [entry['percentage'] for entry in body['leaderboard']]
+    assert percentages == sorted(percentages, reverse=True)
@@ -0,0 +1,69 @@
+from datetime import datetime
+
+import pytest
+
+import catalog
+from ranking import BM25FIndex, analyze, stem
+
+
+@pytest.mark.parametrize('word, expected', [
+    ('studies', 'study'), ('cells', 'cell'), ('analysis', 'analysis'), ('stress', 'stress'),
+    ('mitochondria', 'mitochondrion'), ('bacteria', 'bacterium'), ('stopped', 'stop'),
+    ('growing', 'grow'), ('cultured', 'cultur'), ('culture', 'cultur'), ('dna', 'dna'),
+])
+def test_stem(word, expected):
+    assert stem(word) == expected
+
+
+def test_analyze_lowercases_and_splits_on_punctuation():
+    assert analyze('Cell-Wall Synthesis, 2023') == ['cell', 'wall', 'synthesis', '2023']
+
+
+def index(*documents):
+    return BM25FIndex((doc_id, fields) for doc_id, fields in enumerate(documents, 1))
+
+
+def test_title_matches_outweigh_abstract_matches():
+    scores = index({'title': 'Bone loss', 'abstract': 'Muscles in orbit'},
+                   {'title': 'Muscles in orbit', 'abstract': 'Bone loss'}).score('bone')
+    assert scores[1] > scores[2] > 0
+
+
+def test_rare_terms_weigh_more():
+    scores = index({'title': 'radiation shielding'}, {'title': 'radiation dosimetry'},
+                   {'title': 'radiation biology'}).score('radiation shielding')
+    assert list(scores) == [1]
+    common = index({'title': 'radiation shielding'}, {'title': 'radiation dosimetry'})
+    assert common.idf[stem('radiation')] < common.idf[stem('shielding')]
+
+
+def test_every_query_word_must_match():
+    ranker = index({'title': 'plant growth'}, {'title': 'plant roots'})
+    assert set(ranker.score('plants growing')) == {1}
+    assert ranker.score('plant zebrafish') == {}
+    assert set(ranker.score('plant', allowed={2})) == {2}
+
+
+def test_last_word_matches_as_a_prefix_at_reduced_weight():
+    ranker = index({'title': 'gravitropism'}, {'title': 'gravity'})
+    assert set(ranker.score('grav')) == {1, 2}
+    # Only the word still being typed is expanded
+    assert ranker.score('grav gravity') == {}
+    exact = ranker.score('gravity')
+    assert set(exact) == {2}
+    assert ranker.score('gravit')[2] < exact[2]
+
+
+def test_recent_papers_rank_higher_when_otherwise_equal():
+    year = datetime.now().year
+    paper_index = catalog.PaperIndex([
+        {'id': 1, 'title': 'Spaceflight Anemia', 'authors': [], 'year': year - 20,
+         'abstract': '', 'keywords': [], 'doi': 'old'},
+        {'id': 2, 'title': 'Spaceflight Anemia', 'authors': [], 'year': year,
+         'abstract': '', 'keywords': [], 'doi': 'new'},
+    ])
+    _, papers = paper_index.search('anemia')
+    assert [p['doi'] for p in papers] == ['new', 'old']
+    assert papers[0]['relevance_score'] > papers[1]['relevance_score']
+    assert paper_index.recency_boost(year) == pytest.approx(1 + catalog.RECENCY_WEIGHT)
+    assert paper_index.recency_boost(None) == 1.0
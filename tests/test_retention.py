@@ -0,0 +1,193 @@
+import gzip
+import json
+
+from db import get_pool, transaction
+
+
+def save_history(client, query):
+    status, _ = client.call('POST', '/api/history', {'query': query, 'response': f'{query} answer'})
+    assert status == 200
+
+
+def history_queries(client):
+    status, body = client.call('GET', '/api/history')
+    assert status == 200
+    return [entry['query'] for entry in body['history']]
+
+
+def save_message(client, session_id, content, role='user'):
+    status, body = client.call('POST', '/api/chat/session',
+                               {'session_id': session_id, 'role': role, 'content': content})
+    assert status == 200, body
+    return body['message_id']
+
+
+def session_messages(client, session_id):
+    status, body = client.call('GET', f'/api/chat/session/{session_id}')
+    if status == 404:
+        return None
+    assert status == 200
+    return [message['content'] for message in body['messages']]
+
+
+def session_ids(client):
+    status, body = client.call('GET', '/api/chat/sessions')
+    assert status == 200
+    return [s['session_id'] for s in body['sessions']]
+
+
+def count(app, sql, params=()):
+    with get_pool(app).connection() as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+
+def test_cleared_search_history_is_hidden_then_purged(app, purger, make_client):
+    client, other = make_client(), make_client()
+    for query in ('first', 'second', 'third'):
+        save_history(client, query)
+    save_history(other, 'unrelated')
+
+    assert client.call('DELETE', '/api/history/clear')[0] == 200
+    assert history_queries(client) == []
+    assert history_queries(other) == ['unrelated']
+
+    save_history(client, 'after clear')
+    assert history_queries(client) == ['after clear']
+
+    purger.run_once()
+    assert count(app, "SELECT count(*) FROM search_history WHERE user_id = ?", (client.user_id,)) == 1
+    assert count(app, "SELECT count(*) FROM history_tombstones WHERE user_id = ?", (client.user_id,)) == 0
+    assert history_queries(client) == ['after clear']
+    assert history_queries(other) == ['unrelated']
+
+
+def test_deleted_session_starts_afresh_when_written_again(app, purger, client):
+    save_message(client, 'revived', 'old question')
+    save_message(client, 'revived', 'old answer', role='assistant')
+
+    assert client.call('DELETE', '/api/chat/session/revived')[0] == 200
+    assert session_messages(client, 'revived') is None
+    assert 'revived' not in session_ids(client)
+
+    save_message(client, 'revived', 'new question')
+    assert session_messages(client, 'revived') == ['new question']
+
+    purger.run_once()
+    assert session_messages(client, 'revived') == ['new question']
+    assert count(app, "SELECT count(*) FROM chat_history WHERE session_id = 'revived'") == 1
+    assert count(app, "SELECT message_count FROM chat_sessions WHERE session_id = 'revived'") == 1
+
+
+def test_purge_removes_deleted_session_entirely(app, purger, client):
+    session_id = f'gone-{client.user_id}'
+    for index in range(5):
+        save_message(client, session_id, f'message {index}')
+    assert client.call('DELETE', f'/api/chat/session/{session_id}')[0] == 200
+
+    purger.run_once()
+    assert count(app, "SELECT count(*) FROM chat_history WHERE session_id = ?", (session_id,)) == 0
+    assert count(app, "SELECT count(*) FROM chat_sessions WHERE session_id = ?", (session_id,)) == 0
+    assert session_messages(client, session_id) is None
+
+
+def test_clear_all_keeps_sessions_written_after_the_clear(app, purger, client):
+    kept, cleared = f'kept-{client.user_id}', f'cleared-{client.user_id}'
+    save_message(client, kept, 'before clear')
+    save_message(client, cleared, 'before clear')
+
+    assert client.call('DELETE', '/api/chat/clear-all')[0] == 200
+    assert session_ids(client) == []
+
+    save_message(client, kept, 'after clear')
+    assert session_ids(client) == [kept]
+    assert session_messages(client, kept) == ['after clear']
+
+    purger.run_once()
+    assert session_ids(client) == [kept]
+    assert session_messages(client, kept) == ['after clear']
+    assert count(app, "SELECT count(*) FROM chat_sessions WHERE session_id = ?", (cleared,)) == 0
+
+
+def test_search_history_expires_by_timestamp_not_id(app, purger, client, monkeypatch):
+    # Imported rows: the old one gets the higher id
+    with get_pool(app).connection() as conn:
+        with transaction(conn):
+            conn.executemany(
+                """INSERT INTO search_history (user_id, query, model_type, response, timestamp)
+                   VALUES (?, ?, 'researcher', '', datetime('now', ?))""",
+                [(client.user_id, 'recent', '-1 days'), (client.user_id, 'expired', '-90 days')]
+            )
+    save_history(client, 'current')
+
+    monkeypatch.setattr(purger, 'search_days', 30)
+    purger.run_once()
+    assert sorted(history_queries(client)) == ['current', 'recent']
+
+
+def test_expired_sessions_are_archived_then_purged(app, purger, client, monkeypatch, tmp_path):
+    session_id = f'stale-{client.user_id}'
+    save_message(client, session_id, 'stale question')
+    save_message(client, session_id, 'stale answer', role='assistant')
+    with get_pool(app).connection() as conn:
+        with transaction(conn):
+            conn.execute("UPDATE chat_sessions SET last_activity = datetime('now', '-90 days') "
+                         "WHERE session_id = ?", (session_id,))
+
+    monkeypatch.setattr(purger, 'chat_days', 30)
+    monkeypatch.setattr(purger, 'archive_dir', str(tmp_path))
+    purger.run_once()
+
+    assert session_messages(client, session_id) is None
+    assert count(app, "SELECT count(*) FROM chat_history WHERE session_id = ?", (session_id,)) == 0
+
+    records = []
+    for path in tmp_path.iterdir():
+        with gzip.open(path, 'rt') as f:
+            records += [json.loads(line) for line in f]
+    archived = [r for r in records if r['session_id'] == session_id]
+    assert [r['type'] for r in archived] == ['session', 'message', 'message']
+    assert [r['content'] for r in archived[1:]] == ['stale question', 'stale answer']
+
+
+def test_sessions_from_before_the_migration_stay_visible(tmp_path):
+    import compression
+    import migrations
+    import retention
+    from db import ConnectionPool
+
+    pool = ConnectionPool(str(tmp_path / 'legacy.db'), size=1)
+    compression.install(pool)
+    with pool.connection() as conn:
+        migrations.migrate(conn, target=9)
+        with transaction(conn):
+            conn.execute("INSERT INTO users (id, username, email, password_hash) "
+                         "VALUES (1, 'legacy', 'legacy@example.org', 'x')")
+            # One session with messages, one left empty by the old non-transactional writes
+            conn.executemany("INSERT INTO chat_sessions (user_id, session_id) VALUES (1, ?)",
+                             [('with-messages',), ('empty',)])
+            conn.execute("INSERT INTO chat_history (user_id, session_id, role, content, model_type) "
+                         "VALUES (1, 'with-messages', 'user', 'hello', 'researcher')")
+        migrations.migrate(conn)
+
+        def visible():
+            return sorted(row[0] for row in conn.execute(
+                f"SELECT session_id FROM chat_sessions WHERE user_id = 1 AND {retention.SESSION_VISIBLE}"))
+
+        assert conn.execute("SELECT last_message_id FROM chat_sessions WHERE session_id = 'empty'"
+                            ).fetchone()[0] is None
+        assert visible() == ['empty', 'with-messages']
+
+        with transaction(conn):
+            assert retention.delete_session(conn, 1, 'empty')
+        assert visible() == ['with-messages']
+
+    retention.Purger(pool, batch_pause=0).run_once()
+    with pool.connection() as conn:
+        assert [row[0] for row in conn.execute("SELECT session_id FROM chat_sessions")] == \
+            ['with-messages']
+        # The purger's age scan has an index of its own
+        plan = ' '.join(row[3] for row in conn.execute(
+            f"""EXPLAIN QUERY PLAN SELECT session_id FROM chat_sessions
+                WHERE last_activity < datetime('now', '-30 days') AND {retention.SESSION_VISIBLE}"""))
+        assert 'idx_chat_sessions_last_activity' in plan
+    pool.close_all()
@@ -0,0 +1,53 @@
+def save_history(client, query, response):
+    status, _ = client.call('POST', '/api/history', {'query': query, 'response': response})
+    assert status == 200
+
+
+def save_message(client, session_id, content):
+    status, body = client.call('POST', '/api/chat/session',
+                               {'session_id': session_id, 'role': 'user', 'content': content})
+    assert status == 200, body
+
+
+def search(client, kind, q):
+    status, body = client.call('GET', f'/api/{kind}/search?q={q}')
+    assert status == 200, body
+    return body['results']
+
+
+def test_history_search_marks_matches(client):
+    save_history(client, 'bone density in orbit', 'Bone loss is about 1% per month.')
+    save_history(client, 'plant growth', 'Roots follow light.')
+
+    [result] = search(client, 'history', 'bone')
+    assert result['query'] == '<mark>bone</mark> density in orbit'
+    assert result['snippet'] == '<mark>Bone</mark> loss is about 1% per month.'
+
+
+def test_stored_markup_is_escaped(make_client):
+    client = make_client()
+    save_history(client, '<img src=x onerror=alert(1)> radiation',
+                 '<script>alert("radiation")</script>')
+    save_message(client, f'xss-{client.user_id}', '<b onclick="x()">radiation</b> & dose')
+
+    [result] = search(client, 'history', 'radiation')
+    assert result['query'] == '&lt;img src=x onerror=alert(1)&gt; <mark>radiation</mark>'
+    assert result['snippet'] == '&lt;script&gt;alert(&quot;<mark>radiation</mark>&quot;)&lt;/script&gt;'
+
+    [message] = search(client, 'chat', 'radiation')
+    assert message['snippet'] == ('&lt;b onclick=&quot;x()&quot;&gt;<mark>radiation</mark>'
+                                  '&lt;/b&gt; &amp; dose')
+
+
+def test_search_covers_only_the_users_own_history(make_client):
+    client, other = make_client(), make_client()
+    save_history(other, 'tardigrade survival', 'They survive vacuum.')
+    save_message(other, f'other-{other.user_id}', 'tardigrades again')
+    assert search(client, 'history', 'tardigrade') == []
+    assert search(client, 'chat', 'tardigrade') == []
+    assert len(search(other, 'chat', 'tardigr')) == 1
+
+
+def test_search_requires_a_query(client):
+    assert client.call('GET', '/api/history/search?q=%20')[0] == 400
+    assert client.call('GET', '/api/chat/search?q=x&limit=many')[0] == 400
@@ -0,0 +1,73 @@
+import os
+import stat
+
+import pytest
+from flask import Flask
+
+import auth
+import serve
+
+
+@pytest.mark.parametrize('bind, address', [
+    ('127.0.0.1:5000', ('127.0.0.1', 5000)),
+    (':8000', ('0.0.0.0', 8000)),
+    ('[::1]:8080', ('::1', 8080)),
+])
+def test_parse_bind(bind, address):
+    assert serve.parse_bind(bind) == address
+
+
+def test_secret_key_is_generated_once_and_kept(tmp_path, monkeypatch):
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    app = Flask(__name__)
+    app.config['SECRET_KEY_FILE'] = str(tmp_path / 'secret_key')
+
+    key = auth.load_secret_key(app)
+    assert len(key) == 64
+    assert stat.S_IMODE(os.stat(app.config['SECRET_KEY_FILE']).st_mode) == 0o600
+    # Every worker and every restart signs with the same key
+    assert auth.load_secret_key(app) == key
+    assert os.listdir(tmp_path) == ['secret_key']
+
+    monkeypatch.setenv('SECRET_KEY', 'from-the-environment')
+    assert auth.load_secret_key(app) == 'from-the-environment'
+    app.config['SECRET_KEY'] = 'from-the-config'
+    assert auth.load_secret_key(app) == 'from-the-config'
+
+
+class FakeMaster(serve.Master):
+    """A master that records workers instead of forking them"""
+
+    def __init__(self, size):
+        super().__init__(None, -1, '127.0.0.1', 0, size, graceful_timeout=30)
+        self.next_pid = 100
+        self.signalled = []
+
+    def spawn(self):
+        self.next_pid += 1
+        self.workers[self.next_pid] = self.next_pid
+
+    def drain(self, pid):
+        self.signalled.append(pid)
+        super().drain(pid)
+
+    def log(self, message):
+        pass
+
+
+def test_master_scales_by_draining_the_oldest_workers(monkeypatch):
+    monkeypatch.setattr(serve.os, 'kill', lambda pid, signum: None)
+    master = FakeMaster(3)
+    master.manage_workers()
+    assert sorted(master.workers) == [101, 102, 103]
+
+    master.size = 1
+    master.manage_workers()
+    assert master.signalled == [101, 102]
+    assert list(master.workers) == [103]
+    assert set(master.draining) == {101, 102}
+
+    # Draining workers don't count against the pool size
+    master.size = 2
+    master.manage_workers()
+    assert sorted(master.workers) == [103, 104]
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from summaries import SummaryCache, summary_key
+
+
+class Generator:
+    """Counts calls; each summary records which call made it"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return {'summary': f'generated #{self.calls}'}
+
+
+def test_summary_key_prefers_the_doi():
+    assert summary_key('Any Title', ' 10.1/ABC ') == 'doi:10.1/abc'
+    assert summary_key('  Bone   Loss ', None) == 'title:bone loss'
+    assert summary_key('Bone Loss', '') == summary_key('bone loss')
+
+
+def test_lookups_go_memory_then_database_then_generator(migrated_pool):
+    generate = Generator()
+    cache = SummaryCache(migrated_pool)
+    assert cache.get('k', generate) == ({'summary': 'generated #1'}, False)
+    assert cache.get('k', generate) == ({'summary': 'generated #1'}, True)
+
+    # A new process starts with an empty LRU but shares the table
+    restarted = SummaryCache(migrated_pool)
+    assert restarted.get('k', generate) == ({'summary': 'generated #1'}, True)
+    assert generate.calls == 1
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+    assert (restarted.stats()['db_hits'], restarted.stats()['hits']) == (1, 0)
+
+
+def test_other_versions_and_expired_rows_are_misses(migrated_pool):
+    generate = Generator()
+    SummaryCache(migrated_pool, version='1').get('k', generate)
+    assert SummaryCache(migrated_pool, version='2').get('k', generate) == (
+        {'summary': 'generated #2'}, False)
+
+    expired = SummaryCache(migrated_pool, version='3', ttl=0)
+    expired.get('k', generate)
+    assert expired.get('k', generate) == ({'summary': 'generated #4'}, False)
+
+    # Only the version-3 row is left and it is expired
+    assert SummaryCache(migrated_pool, version='3').purge() == 1
+
+
+def test_memory_tier_is_bounded_by_size(migrated_pool):
+    # Each payload is 27 bytes of JSON
+    cache = SummaryCache(migrated_pool, max_bytes=60)
+    for key in ('a', 'b', 'c'):
+        cache.get(key, Generator())
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes']) == (2, 54)
+    # The oldest entry was evicted, but the table still has it
+    assert cache.get('a', Generator()) == ({'summary': 'generated #1'}, True)
+    assert cache.stats()['db_hits'] == 1
+
+
+def test_concurrent_misses_generate_once(migrated_pool):
+    cache = SummaryCache(migrated_pool)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_generate():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'summary': 'slow'}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('k', slow_generate)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(results, key=lambda r: r[1]) == [({'summary': 'slow'}, False)] + \
+        [({'summary': 'slow'}, True)] * 4
+
+
+def test_failed_generation_is_not_cached(migrated_pool):
+    cache = SummaryCache(migrated_pool)
+
+    def fail():
+        raise RuntimeError('generator down')
+
+    with pytest.raises(RuntimeError):
+        cache.get('k', fail)
+    assert cache.get('k', Generator()) == ({'summary': 'generated #1'}, False)
+
+
+def test_invalidate_drops_both_tiers(migrated_pool):
+    cache = SummaryCache(migrated_pool)
+    cache.get('k', Generator())
+    cache.invalidate('k')
+    assert cache.stats()['entries'] == 0
+    assert cache.get('k', Generator()) == ({'summary': 'generated #1'}, False)
+
+
+def test_summarize_endpoint_reports_cache_hits(client):
+    doi = f'10.1/summary-{client.user_id}'
+    first = client.call('POST', '/api/papers/summarize', {'paper_title': 'Bone Loss', 'doi': doi})
+    second = client.call('POST', '/api/papers/summarize', {'paper_title': 'bone loss', 'doi': doi})
+    assert (first[0], first[1]['cached']) == (200, False)
+    assert (second[0], second[1]['cached']) == (200, True)
+    assert client.call('POST', '/api/papers/summarize', {'paper_title': ' '})[0] == 400
@@ -0,0 +1,209 @@
+import json
+import queue
+import sqlite3
+import threading
+
+import pytest
+
+import writebehind
+from db import get_pool, transaction
+
+
+@pytest.fixture
+def rows(app, monkeypatch):
+    """A 'rows' handler writing into a scratch table; returns the batch sizes it saw"""
+    with get_pool(app).connection() as conn:
+        with transaction(conn):
+            conn.execute("CREATE TABLE IF NOT EXISTS wb_rows (value INTEGER NOT NULL CHECK (value >= 0))")
+            conn.execute("DELETE FROM wb_rows")
+            conn.execute("DELETE FROM write_behind_failures")
+    batches = []
+
+    def store_rows(conn, payloads):
+        batches.append(len(payloads))
+        conn.executemany("INSERT INTO wb_rows (value) VALUES (?)", [(p['value'],) for p in payloads])
+
+    monkeypatch.setitem(writebehind.HANDLERS, 'rows', store_rows)
+    return batches
+
+
+@pytest.fixture
+def make_queue(app):
+    queues = []
+
+    def make(**options):
+        write_queue = writebehind.WriteBehindQueue(get_pool(app), **options)
+        queues.append(write_queue)
+        return write_queue
+
+    yield make
+    for write_queue in queues:
+        write_queue.stop()
+
+
+def hold_writer(write_queue):
+    """Make the writer wait before each batch; returns (entered, release) events"""
+    entered, release = threading.Event(), threading.Event()
+    write = write_queue._write
+
+    def held_write(batch):
+        entered.set()
+        release.wait(5)
+        write(batch)
+
+    write_queue._write = held_write
+    return entered, release
+
+
+def stored_values(app):
+    with get_pool(app).connection() as conn:
+        return sorted(row[0] for row in conn.execute("SELECT value FROM wb_rows"))
+
+
+def dead_letters(app):
+    with get_pool(app).connection() as conn:
+        return conn.execute("SELECT kind, user_id, payload FROM write_behind_failures").fetchall()
+
+
+def submit(write_queue, *values, user_id=1):
+    for value in values:
+        write_queue.submit('rows', user_id, {'user_id': user_id, 'value': value})
+
+
+def test_queued_rows_are_group_committed(app, rows, make_queue):
+    write_queue = make_queue()
+    entered, release = hold_writer(write_queue)
+    submit(write_queue, 0)
+    entered.wait(5)
+    submit(write_queue, 1, 2, 3, 4, 5)
+    release.set()
+
+    assert write_queue.flush(user_id=1)
+    assert rows == [1, 5]
+    assert stored_values(app) == [0, 1, 2, 3, 4, 5]
+
+
+def test_bad_row_is_dead_lettered_and_the_rest_committed(app, rows, make_queue):
+    write_queue = make_queue()
+    entered, release = hold_writer(write_queue)
+    submit(write_queue, 0)
+    entered.wait(5)
+    submit(write_queue, 1, -1, 2)
+    release.set()
+
+    assert write_queue.flush()
+    # The group commit failed, then each row was written on its own
+    assert rows[:2] == [1, 3]
+    assert stored_values(app) == [0, 1, 2]
+    assert write_queue.stats()['failed'] == 1
+    [(kind, user_id, payload)] = dead_letters(app)
+    assert (kind, user_id, json.loads(payload)) == ('rows', 1, {'user_id': 1, 'value': -1})
+
+
+def test_locked_database_is_retried_as_a_batch(app, rows, make_queue, monkeypatch):
+    attempts = []
+    store_rows = writebehind.HANDLERS['rows']
+
+    def flaky(conn, payloads):
+        attempts.append(len(payloads))
+        if len(attempts) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        store_rows(conn, payloads)
+
+    monkeypatch.setitem(writebehind.HANDLERS, 'rows', flaky)
+    write_queue = make_queue(max_retries=3)
+    submit(write_queue, 1)
+
+    assert write_queue.flush()
+    assert attempts == [1, 1]
+    assert stored_values(app) == [1]
+    assert write_queue.stats()['failed'] == 0
+
+
+def test_full_queue_pushes_back(app, client, rows, make_queue, monkeypatch):
+    write_queue = make_queue(max_size=1, put_timeout=0.05)
+    entered, release = hold_writer(write_queue)
+    submit(write_queue, 0)
+    entered.wait(5)
+    submit(write_queue, 1)
+    with pytest.raises(queue.Full):
+        submit(write_queue, 2)
+
+    monkeypatch.setitem(app.extensions, 'write_behind', write_queue)
+    status, body = client.call('POST', '/api/history', {'query': 'q', 'response': 'r'})
+    assert status == 503
+
+    release.set()
+    assert write_queue.flush()
+    assert stored_values(app) == [0, 1]
+
+
+def test_read_waits_for_queued_writes_then_gives_up(app, client, rows, make_queue, monkeypatch):
+    write_queue = make_queue(flush_timeout=0.05)
+    monkeypatch.setitem(app.extensions, 'write_behind', write_queue)
+    entered, release = hold_writer(write_queue)
+
+    assert client.call('POST', '/api/history', {'query': 'queued', 'response': 'r'})[0] == 202
+    entered.wait(5)
+    # The writer is stuck, so the read can't include the user's own write
+    assert not write_queue.flush(client.user_id)
+    assert client.call('GET', '/api/history')[0] == 503
+
+    release.set()
+    status, body = client.call('GET', '/api/history')
+    assert status == 200
+    assert [entry['query'] for entry in body['history']] == ['queued']
+
+
+def test_stop_drains_the_queue(app, rows, make_queue):
+    write_queue = make_queue()
+    entered, release = hold_writer(write_queue)
+    submit(write_queue, 0)
+    entered.wait(5)
+    submit(write_queue, *range(1, 50))
+    release.set()
+
+    write_queue.stop()
+    assert not write_queue._thread.is_alive()
+    assert stored_values(app) == list(range(50))
+
+
+def test_invalid_payloads_are_rejected_before_queueing(app, make_client, make_queue, monkeypatch):
+    client, other = make_client(), make_client()
+    theirs = f'theirs-{other.user_id}'
+    assert other.call('POST', '/api/chat/session',
+                      {'session_id': theirs, 'role': 'user', 'content': 'private'})[0] == 200
+
+    write_queue = make_queue()
+    monkeypatch.setitem(app.extensions, 'write_behind', write_queue)
+    assert client.call('POST', '/api/history', {'query': {'not': 'text'}})[0] == 400
+    assert client.call('POST', '/api/chat/session',
+                       {'session_id': 's', 'role': 'user', 'content': ['x']})[0] == 400
+    assert client.call('POST', '/api/chat/session',
+                       {'session_id': theirs, 'role': 'user', 'content': 'intrusion'})[0] == 403
+    assert write_queue.pending() == 0
+
+
+def test_session_taken_after_the_202_is_dead_lettered(app, client, make_queue, monkeypatch):
+    with get_pool(app).connection() as conn:
+        with transaction(conn):
+            conn.execute("DELETE FROM write_behind_failures")
+    write_queue = make_queue()
+    monkeypatch.setitem(app.extensions, 'write_behind', write_queue)
+    entered, release = hold_writer(write_queue)
+    session_id = f'raced-{client.user_id}'
+
+    status, _ = client.call('POST', '/api/chat/session',
+                            {'session_id': session_id, 'role': 'user', 'content': 'mine'})
+    assert status == 202
+    entered.wait(5)
+    with get_pool(app).connection() as conn:
+        with transaction(conn):
+            conn.execute("INSERT INTO chat_sessions (user_id, session_id) VALUES (?, ?)",
+                         (client.user_id + 1000000, session_id))
+    release.set()
+
+    assert write_queue.flush()
+    assert write_queue.stats()['failed'] == 1
+    [(kind, user_id, payload)] = dead_letters(app)
+    assert (kind, user_id, json.loads(payload)['content']) == ('chat', client.user_id, 'mine')
@@ -0,0 +1,250 @@
+"""Optional write-behind queue for history and chat persistence
+
+With WRITE_BEHIND enabled, save endpoints enqueue rows instead of committing
+inline. A writer thread drains the queue and group-commits up to
+WRITE_BEHIND_BATCH_SIZE rows per transaction. Readers call flush(user_id)
+first so a user sees their own writes.
+
+That guarantee holds only within one process: flush() drains the local
+queue, and a read served by another process doesn't wait on it. serve.py
+therefore turns write-behind off, so use it only with a single-process
+server. flush() gives up after WRITE_BEHIND_FLUSH_TIMEOUT seconds, so a
+wedged writer doesn't hang the requests reading behind it.
+
+Endpoints validate payloads before queueing them. A row that still fails
+once its 202 has been sent (say a chat session taken by another user in
+the meantime) is moved to the write_behind_failures table and counted in
+stats()['failed'].
+"""
+import json
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from db import get_pool, load_config, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'WRITE_BEHIND': False,
+    'WRITE_BEHIND_QUEUE_SIZE': 10000,
+    'WRITE_BEHIND_BATCH_SIZE': 500,
+    'WRITE_BEHIND_FLUSH_INTERVAL': 0.05,
+    'WRITE_BEHIND_PUT_TIMEOUT': 1.0,
+    'WRITE_BEHIND_MAX_RETRIES': 3,
+    'WRITE_BEHIND_FLUSH_TIMEOUT': 5.0,
+}
+
+# kind -> function(conn, payloads) that writes a list of queued payloads
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the function that writes queued payloads of the given kind"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+class WriteBehindQueue:
+    """A bounded in-process queue drained by one group-committing writer thread"""
+
+    def __init__(self, pool, max_size=10000, batch_size=500, flush_interval=0.05,
+                 put_timeout=1.0, max_retries=3, flush_timeout=5.0):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.flush_timeout = flush_timeout
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._seq = 0
+        self._done = 0
+        self._user_seq = {}
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._failed = 0
+
+    def _ensure_started(self):
+        # Started lazily so a preloading parent process never forks a running writer
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def submit(self, kind, user_id, payload):
+        """Queue a payload, blocking up to put_timeout; raises queue.Full when saturated"""
+        if kind not in HANDLERS:
+            raise KeyError(f'No write-behind handler for {kind!r}')
+        self._ensure_started()
+
+        # Sequence numbers are assigned in queue order so the writer can report
+        # progress; the lock is never held while waiting for space
+        deadline = time.monotonic() + self.put_timeout
+        while True:
+            with self._cond:
+                try:
+                    self._queue.put_nowait((self._seq + 1, kind, payload))
+                except queue.Full:
+                    pass
+                else:
+                    self._seq += 1
+                    self._user_seq[user_id] = self._seq
+                    return
+            if time.monotonic() >= deadline:
+                raise queue.Full
+            self._wake.set()
+            time.sleep(0.005)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {'pending': self._queue.qsize(), 'failed': self._failed}
+
+    def flush(self, user_id=None, timeout=None):
+        """Wait until everything queued so far (or just by user_id) is committed
+
+        Waits at most timeout seconds, flush_timeout by default. Returns
+        whether the writes were committed.
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        with self._cond:
+            target = self._user_seq.get(user_id, 0) if user_id is not None else self._seq
+            if self._done >= target:
+                return True
+            if self._thread is None or not self._thread.is_alive():
+                return False
+            self._wake.set()
+            return self._cond.wait_for(lambda: self._done >= target, timeout)
+
+    def stop(self, timeout=10.0):
+        """Drain and commit everything still queued, then stop the writer"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _take_batch(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+
+        # Give a burst a moment to accumulate unless a reader is waiting on it
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            if self._wake.is_set() or self._stopping or time.monotonic() >= deadline:
+                break
+            time.sleep(0.001)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+            elif self._stopping:
+                return
+            if self._queue.empty():
+                self._wake.clear()
+
+    def _write(self, batch):
+        grouped = {}
+        for _, kind, payload in batch:
+            grouped.setdefault(kind, []).append(payload)
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self._commit(grouped)
+                break
+            except sqlite3.OperationalError:
+                # Lock timeouts and I/O errors are worth retrying as a whole batch
+                if attempt < self.max_retries:
+                    time.sleep(0.05 * attempt)
+                    continue
+                logger.exception('Group commit of %d queued writes failed', len(batch))
+                self._write_individually(grouped)
+                break
+            except Exception:
+                logger.exception('Group commit of %d queued writes failed', len(batch))
+                self._write_individually(grouped)
+                break
+
+        with self._cond:
+            self._done = batch[-1][0]
+            if len(self._user_seq) > 10000:
+                self._user_seq = {u: s for u, s in self._user_seq.items() if s > self._done}
+            self._cond.notify_all()
+
+    def _commit(self, grouped):
+        with self.pool.connection() as conn:
+            with transaction(conn):
+                for kind, payloads in grouped.items():
+                    HANDLERS[kind](conn, payloads)
+
+    def _write_individually(self, grouped):
+        # Isolate the bad rows so one invalid payload doesn't drop the whole batch
+        for kind, payloads in grouped.items():
+            for payload in payloads:
+                try:
+                    self._commit({kind: [payload]})
+                except Exception as e:
+                    logger.exception('Queued %s write failed', kind)
+                    self._dead_letter(kind, payload, e)
+
+    def _dead_letter(self, kind, payload, error):
+        with self._cond:
+            self._failed += 1
+        try:
+            with self.pool.connection() as conn:
+                with transaction(conn):
+                    conn.execute(
+                        """INSERT INTO write_behind_failures (kind, user_id, payload, error)
+                           VALUES (?, ?, ?, ?)""",
+                        (kind, payload.get('user_id'), json.dumps(payload, default=str), repr(error))
+                    )
+        except Exception:
+            logger.exception('Could not record failed %s write; it is lost', kind)
+
+
+def init_app(app):
+    """Create the write-behind queue when WRITE_BEHIND is enabled"""
+    load_config(app, DEFAULT_CONFIG)
+    if not app.config['WRITE_BEHIND']:
+        return None
+
+    write_queue = WriteBehindQueue(
+        get_pool(app),
+        max_size=app.config['WRITE_BEHIND_QUEUE_SIZE'],
+        batch_size=app.config['WRITE_BEHIND_BATCH_SIZE'],
+        flush_interval=app.config['WRITE_BEHIND_FLUSH_INTERVAL'],
+        put_timeout=app.config['WRITE_BEHIND_PUT_TIMEOUT'],
+        max_retries=app.config['WRITE_BEHIND_MAX_RETRIES'],
+        flush_timeout=app.config['WRITE_BEHIND_FLUSH_TIMEOUT'],
+    )
+    app.extensions['write_behind'] = write_queue
+    atexit.register(write_queue.stop)
+    return write_queue